@@ -26,6 +26,7 @@ function bulk_registration_by_ajax(bulk_register_form){
   const USER_REGISTER_CSRF_ID = "csrf_token";
   const USER_REGISTER_PROGRESS_ID = "registration-progress";
   const USER_REGISTER_STATUS_ID = "registration-status";
+  const JOB_POLL_INTERVAL_MS = 1000;
   
   const $reg_container = $("#"+USER_REGISTER_PROGRESS_ID);
   const $progress_list = $reg_container.find("ul");
@@ -91,67 +92,70 @@ function bulk_registration_by_ajax(bulk_register_form){
     }
   }
 
-  function register_next(csv_rows_as_dicts, reg_index){
-    reg_index += 1;
-    if (reg_index < qty_reg_total) {
-      register_by_ajax(csv_rows_as_dicts, reg_index);
-    } else {
-      if (qty_reg_total > 0 && qty_reg_ok === qty_reg_total) {
-        update_status("OK, finished!", "alert-success");
+  function show_job_progress(job){
+    qty_reg_total = job.qty_total;
+    qty_reg_fail = job.qty_failed;
+    qty_reg_ok = job.qty_done - job.qty_failed;
+    update_reg_progress();
+    // the job's errors only grow: add any that aren't in the list yet
+    for (let i=$progress_list.children().length; i < job.errors.length; i++) {
+      let $error_element = $("<li>");
+      $error_element.addClass("list-group-item-danger");
+      $error_element.text(job.errors[i]);
+      $progress_list.append($error_element);
+    }
+  }
+
+  function poll_job(job_url){
+    $.get(job_url)
+    .done(function(job) {
+      show_job_progress(job);
+      if (! job.is_finished) {
+        setTimeout(function(){ poll_job(job_url) }, JOB_POLL_INTERVAL_MS);
+      } else {
+        if (job.status === "done" && job.qty_failed === 0) {
+          update_status("OK, finished!", "alert-success");
+        } else {
+          update_status("Finished, but not all users were registered", "alert-danger");
+        }
+        $(bulk_register_form).slideDown("slow");
       }
+    })
+    .fail(function() {
+      update_status("Lost track of the registration: check the users list", "alert-danger");
       $(bulk_register_form).slideDown("slow");
-    }
+    })
   }
 
-  function register_by_ajax(csv_rows_as_dicts, reg_index){
+  function register_by_ajax(csv_rows_as_dicts){
+    // the whole CSV goes up in one request: the server checks it all, and
+    // then registers the users in the background (poll its job for progress)
     qty_reg_total = csv_rows_as_dicts.length;
     update_reg_progress();
-    let userdata = csv_rows_as_dicts[reg_index];
-    let $user_element = $("<li>");
-    let $user_status = $("<span>");
-    $user_element.text(userdata['username']);
-    $user_element.addClass("list-group-item-warning");
-    $user_status.text("?");
-    $user_element.append($user_status);
-    $progress_list.append($user_element);
-    // create CSV with username as the first column
-    let cols = ["username"];
-    let values = [userdata['username']];
-    for (let col in csv_rows_as_dicts[reg_index]){
-      if (col != "username"){
-        cols.push(col);
-        values.push(csv_rows_as_dicts[reg_index][col]);
-      }
-    }
-    let userdata_as_csv = cols.join(",") + "\n" + values.join(",");
+    let cols = Object.keys(csv_rows_as_dicts[0]);
+    let lines = [cols.join(",")];
+    for (let userdata of csv_rows_as_dicts){
+      lines.push(cols.map(col => userdata[col]).join(","));
+    }
     let request_data = {};
     request_data[USER_REGISTER_CSRF_ID] = csrf_token;
     request_data[USER_REGISTER_AUTH_ID] = authcode;
-    request_data[USER_REGISTER_CSV_ID] = userdata_as_csv;
-    let new_status = "danger";
+    request_data[USER_REGISTER_CSV_ID] = lines.join("\n");
     $.post(BULK_REGISTER_URL, request_data)
-    .done(function(data, textStatus, errorThrown) {
-      if (data) {
-        if (data.status === "OK") {
-          new_status = "ok";
-        } else {
-          update_status(data.error, "alert-danger");
+    .done(function(data) {
+      if (data && data.status === "OK") {
+        show_job_progress(data.job);
+        poll_job(data.job_url);
+      } else {
+        for (let error of (data? data.errors : ["Registration failed"])) {
+          update_status(error, "alert-danger");
         }
+        $(bulk_register_form).slideDown("slow");
       }
     })
-    .always(function() {
-      $user_element[0].className = "";
-      if (new_status === "ok") {
-        qty_reg_ok += 1;
-        $user_element.addClass("list-group-item-success");
-        $user_status.text("OK");
-      } else {
-        qty_reg_fail += 1;
-        $user_element.addClass("list-group-item-danger");
-        $user_status.text("fail");
-      }
-      update_reg_progress();
-      register_next(csv_rows_as_dicts, reg_index);
+    .fail(function() {
+      update_status("Registration failed: nobody was registered", "alert-danger");
+      $(bulk_register_form).slideDown("slow");
     })
   }
 
@@ -214,7 +218,7 @@ function bulk_registration_by_ajax(bulk_register_form){
     update_status(err_msg, "alert-danger");
     $(bulk_register_form).slideDown("slow");
   } else {
-    register_by_ajax(csv_rows_as_dicts, 0);
+    register_by_ajax(csv_rows_as_dicts);
   }
 }
 
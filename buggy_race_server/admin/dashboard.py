@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Data for the admin dashboard (and its JSON snapshot, which the admin API
+serves too).
+
+The counts are worked out by the database (with CASE expressions), and the
+only rows that are loaded are the columns that are needed: a few per user,
+and just the lengths of the students' task texts (not the texts). The
+result is plain data, cached for a short time, because the API is polled by
+analytics scripts, and none of it needs to be up to the second.
+"""
+
+from datetime import datetime, time, timedelta, timezone
+
+from sqlalchemy import and_, case, func, select
+
+from buggy_race_server.admin.models import Task, TaskText
+from buggy_race_server.buggy.models import Buggy
+from buggy_race_server.extensions import cache, db
+from buggy_race_server.user.models import User
+
+DASHBOARD_CACHE_TIMEOUT = 30 # seconds
+TASK_NOTE_LENGTH_THRESHOLD = 2 # texts shorter than this are not counted
+
+# the student login buckets, in the order the dashboard shows them
+LOGIN_TODAY = "today"
+LOGIN_THIS_WEEK = "this_week"
+LOGIN_EVER = "ever" # but not in the last week
+LOGIN_NEVER = "never"
+
+def _count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+def _get_login_bucket_expr(today_start, week_start):
+    return case(
+        (User.logged_in_at.is_(None), LOGIN_NEVER),
+        (User.logged_in_at >= today_start, LOGIN_TODAY),
+        (User.logged_in_at >= week_start, LOGIN_THIS_WEEK),
+        else_=LOGIN_EVER,
+    )
+
+def _get_dashboard_data(now, is_storing_texts, want_students):
+    today_start = datetime.combine(now.date(), time.min, tzinfo=timezone.utc)
+    week_start = today_start - timedelta(days=7)
+    is_student_active = and_(User.is_student==True, User.is_active==True)
+    is_staff = and_(
+        User.is_active==True,
+        User.access_level.in_([User.TEACHING_ASSISTANT, User.ADMINISTRATOR]),
+    )
+    is_other = and_(User.is_active==True, User.is_student==False, ~is_staff)
+    login_bucket = _get_login_bucket_expr(today_start, week_start)
+
+    user_counts = db.session.execute(
+        select(
+            func.count(User.id).label("qty_users"),
+            _count_if(User.is_active==False).label("qty_users_deactivated"),
+            _count_if(is_staff).label("qty_staff_users"),
+            _count_if(is_other).label("qty_other_users"),
+            _count_if(is_student_active).label("qty_students_active"),
+            _count_if(and_(is_student_active, User.uploaded_at >= week_start)).label("qty_uploads_week"),
+            _count_if(and_(is_student_active, User.uploaded_at >= today_start)).label("qty_uploads_today"),
+            _count_if(and_(is_student_active, User.submission_deadline.is_not(None))).label("qty_deadlines"),
+            _count_if(and_(is_student_active, func.coalesce(User.submission_link, "") != "")).label("qty_links"),
+            _count_if(and_(is_student_active, func.coalesce(User.project_notice, "") != "")).label("qty_notices"),
+        )
+    ).one()._asdict()
+    qty_students_by_login = {
+        bucket: 0 for bucket in (LOGIN_TODAY, LOGIN_THIS_WEEK, LOGIN_EVER, LOGIN_NEVER)
+    }
+    qty_students_by_login.update(
+        db.session.execute(
+            select(login_bucket, func.count(User.id)).where(is_student_active).group_by(login_bucket)
+        ).all()
+    )
+    qty_buggies = db.session.execute(
+        select(func.count(Buggy.id)).join(User, Buggy.user_id==User.id).where(is_student_active)
+    ).scalar()
+    tasks = [
+        {"id": task_id, "fullname": f"{phase}-{name}"}
+        for (task_id, phase, name) in db.session.execute(
+            select(Task.id, Task.phase, Task.name).where(Task.is_enabled==True).order_by(
+                Task.phase.asc(), Task.sort_position.asc()
+            )
+        )
+    ]
+    fullnames_by_task_id = {task["id"]: task["fullname"] for task in tasks}
+    qty_texts = 0
+    qty_texts_by_task = {}
+    if is_storing_texts:
+        text_counts = db.session.execute(
+            select(
+                TaskText.task_id,
+                func.count(TaskText.id),
+                _count_if(func.length(TaskText.text) > TASK_NOTE_LENGTH_THRESHOLD),
+            ).join(User, TaskText.user_id==User.id).where(is_student_active).group_by(TaskText.task_id)
+        )
+        for (task_id, qty, qty_long_enough) in text_counts:
+            qty_texts += qty
+            if qty_long_enough and task_id in fullnames_by_task_id:
+                qty_texts_by_task[fullnames_by_task_id[task_id]] = qty_long_enough
+    data = {
+        "now": now,
+        "qty_buggies": qty_buggies,
+        "qty_students_by_login": qty_students_by_login,
+        "qty_texts": qty_texts,
+        "qty_texts_by_task": qty_texts_by_task,
+        "tasks": tasks,
+        **user_counts,
+    }
+    if want_students:
+        data["students"] = _get_students_details(is_student_active, fullnames_by_task_id)
+    else:
+        data["usernames"] = _get_usernames_by_group(
+            is_student_active, is_staff, is_other, login_bucket
+        )
+    return data
+
+def _get_usernames_by_group(is_student_active, is_staff, is_other, login_bucket):
+    """ Returns lists of {username, pretty_username} dicts, keyed on the
+    login buckets and "deactivated", "staff" and "other" """
+    usernames = {
+        group: [] for group in (
+            LOGIN_TODAY, LOGIN_THIS_WEEK, LOGIN_EVER, LOGIN_NEVER,
+            "deactivated", "staff", "other",
+        )
+    }
+    rows = db.session.execute(
+        select(
+            User.username,
+            case((is_student_active, login_bucket), else_=None),
+            User.is_active,
+            is_staff,
+            is_other,
+        ).order_by(User.username)
+    )
+    for (username, student_bucket, is_active, is_staff_user, is_other_user) in rows:
+        user = {"username": username, "pretty_username": User.get_pretty_username(username)}
+        if student_bucket is not None:
+            usernames[student_bucket].append(user)
+        if not is_active:
+            usernames["deactivated"].append(user)
+        elif is_staff_user:
+            usernames["staff"].append(user)
+        elif is_other_user:
+            usernames["other"].append(user)
+    return usernames
+
+def _get_students_details(is_student_active, fullnames_by_task_id):
+    """ Returns a dict (keyed on username) of the active students' details
+    for the JSON snapshot: texts are only their lengths and timestamps"""
+    texts_by_user_id = {}
+    text_rows = db.session.execute(
+        select(
+            TaskText.user_id,
+            TaskText.task_id,
+            func.length(TaskText.text),
+            TaskText.created_at,
+            TaskText.modified_at,
+        ).join(User, TaskText.user_id==User.id).where(
+            is_student_active,
+            func.length(TaskText.text) > TASK_NOTE_LENGTH_THRESHOLD,
+        )
+    )
+    for (user_id, task_id, length, created_at, modified_at) in text_rows:
+        if task_id in fullnames_by_task_id:
+            texts_by_user_id.setdefault(user_id, {})[fullnames_by_task_id[task_id]] = {
+                "length": length,
+                "created_at": created_at,
+                "modified_at": modified_at,
+            }
+    students = {}
+    student_rows = db.session.execute(
+        select(
+            User.id,
+            User.username,
+            User.logged_in_at,
+            User.uploaded_at,
+            func.coalesce(func.length(User.latest_json), 0),
+            User.github_username,
+        ).where(is_student_active).order_by(User.username)
+    )
+    for (user_id, username, logged_in_at, uploaded_at, json_length, github_username) in student_rows:
+        texts = texts_by_user_id.get(user_id, {})
+        students[username] = {
+            "last_login": logged_in_at,
+            "last_upload_at": uploaded_at,
+            "json_length": json_length if json_length > 1 else 0, # see User.pretty_json_length
+            "github_username": github_username,
+            "texts": texts,
+            "qty_texts": len(texts),
+        }
+    return students
+
+def get_dashboard_data(is_storing_texts, want_students=False):
+    """ Returns the dashboard's counts, and either the usernames in each
+    group (for the dashboard page) or the active students' details (for the
+    JSON snapshot): the timestamps are datetimes (UTC), and "now" is when
+    the data was put together (it's cached for DASHBOARD_CACHE_TIMEOUT)"""
+    cache_key = "admin/dashboard/{}/{}".format(
+        "texts" if is_storing_texts else "no-texts",
+        "students" if want_students else "usernames",
+    )
+    data = cache.get(cache_key)
+    if data is None:
+        data = _get_dashboard_data(
+            datetime.now(timezone.utc), is_storing_texts, want_students
+        )
+        cache.set(cache_key, data, timeout=DASHBOARD_CACHE_TIMEOUT)
+    return data
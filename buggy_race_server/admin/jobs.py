@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""A small job queue, kept in the database (the jobs table), so it needs no
+broker, and any of the server's processes can run any job.
+
+Requests enqueue jobs (see enqueue_job) instead of doing slow work while
+the browser waits. Each process runs JOB_WORKERS worker threads (started
+by the first request it handles), which claim pending jobs and run them,
+in their own app context. A job's parameters are saved with it, and its
+worker keeps its heartbeat up to date while it runs: if that stops (e.g.,
+gunicorn recycled the process), the job goes back in the queue for another
+worker to pick up. Jobs save their progress, so they can carry on from
+where they were (but anything they do must be safe to repeat).
+
+A job function is called with the job and its parameters (as keyword
+arguments), and returns a message for the admin (or None). If it raises
+an exception, the job fails, with the exception as its last error.
+"""
+
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, select, update
+
+from buggy_race_server.admin.models import DbFile, Job, Task
+from buggy_race_server.admin.registration import register_users
+from buggy_race_server.config import ConfigSettingNames
+from buggy_race_server.database import db
+from buggy_race_server.lib.issues import IssueParser
+from buggy_race_server.user.models import User
+from buggy_race_server.utils import (
+    create_editor_zipfile,
+    join_to_project_root,
+    load_tasks_into_db,
+    publish_task_list,
+    publish_tasks_as_issues_csv,
+    publish_tech_notes,
+    refresh_settings_if_stale,
+    set_and_save_config_setting,
+)
+
+JOB_POLL_INTERVAL = 2 # seconds between idle workers' checks for new jobs
+JOB_HEARTBEAT_INTERVAL = 15 # seconds
+JOB_HEARTBEAT_TIMEOUT = 120 # seconds without a heartbeat: worker has gone
+JOB_CLAIM_BATCH_SIZE = 5 # pending jobs looked at per claim
+
+# GitHub's primary rate limit resets hourly, so injecting issues may have to
+# wait a while (the job keeps its heartbeat up while it does)
+ISSUE_INJECTION_MAX_RATE_LIMIT_WAIT = 60 * 60 # seconds
+
+_workers_lock = threading.Lock()
+_workers_pid = None # the process that started the workers (not its parent)
+_wake_workers = threading.Event()
+
+
+def _utc_now():
+    return datetime.now(timezone.utc)
+
+
+def enqueue_job(job_type, params=None, user=None, qty_total=0, delay=0):
+    """ Saves a new pending job, which will be run by the next worker that's
+    free (but not for delay seconds): params must be JSON-serialisable.
+    Returns the job."""
+    job = Job(
+        type=job_type,
+        params=json.dumps(params or {}),
+        user_id=user.id if user else None,
+        qty_total=qty_total,
+        run_after=_utc_now() + timedelta(seconds=delay),
+    )
+    job.save()
+    _wake_workers.set() # so this process's workers don't wait for the poll
+    return job
+
+
+def _expire_abandoned_jobs(now):
+    """ Running jobs whose heartbeat has stopped are put back in the queue,
+    unless they've already been tried too many times"""
+    is_abandoned = (Job.status==Job.RUNNING) & (
+        Job.heartbeat_at < now - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT)
+    )
+    # not synchronising the session (the commit expires it anyway): SQLite's
+    # datetimes are naive, so they can't be compared with now in Python
+    db.session.execute(
+        update(Job).where(is_abandoned, Job.attempts < Job.MAX_ATTEMPTS).values(
+            status=Job.PENDING, worker=None
+        ).execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(Job).where(is_abandoned, Job.attempts >= Job.MAX_ATTEMPTS).values(
+            status=Job.FAILED,
+            result=f"Gave up: its worker stopped {Job.MAX_ATTEMPTS} times",
+            params=None,
+            finished_at=now,
+        ).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def claim_next_job(worker_name):
+    """ Returns the next pending job that's due, having marked it as running
+    by this worker (or None if there isn't one). The claim is an UPDATE that
+    only succeeds while the job is still pending, so two workers can't both
+    claim it."""
+    now = _utc_now()
+    _expire_abandoned_jobs(now)
+    running_exclusive_types = select(Job.type).where(
+        Job.status==Job.RUNNING, Job.type.in_(Job.EXCLUSIVE_TYPES)
+    )
+    job_ids = db.session.execute(
+        select(Job.id).where(
+            Job.status==Job.PENDING,
+            Job.run_after <= now,
+            Job.type.not_in(running_exclusive_types),
+        ).order_by(Job.id).limit(JOB_CLAIM_BATCH_SIZE)
+    ).scalars().all()
+    for job_id in job_ids:
+        result = db.session.execute(
+            update(Job).where(Job.id==job_id, Job.status==Job.PENDING).values(
+                status=Job.RUNNING,
+                worker=worker_name,
+                attempts=Job.attempts + 1,
+                started_at=func.coalesce(Job.started_at, now),
+                heartbeat_at=now,
+            )
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def _keep_heartbeat(app, job_id, is_finished):
+    with app.app_context():
+        while not is_finished.wait(JOB_HEARTBEAT_INTERVAL):
+            db.session.execute(
+                update(Job).where(Job.id==job_id).values(heartbeat_at=_utc_now())
+            )
+            db.session.commit()
+        db.session.remove()
+
+
+def run_job(app, job):
+    """ Runs a claimed job (in the app context), and saves how it went """
+    is_finished = threading.Event()
+    threading.Thread(
+        target=_keep_heartbeat,
+        args=(app, job.id, is_finished),
+        name=f"job-{job.id}-heartbeat",
+        daemon=True,
+    ).start()
+    try:
+        job_function = JOB_FUNCTIONS[job.type]
+        # settings may have changed since this process last handled a request
+        refresh_settings_if_stale(app)
+        # like autogenerating static content at start-up: publishing pages
+        # uses url_for, which needs a request (so pretend it's to the server)
+        server_url = app.config.get(ConfigSettingNames.BUGGY_RACE_SERVER_URL.name) or "/"
+        with app.test_request_context(server_url):
+            job.result = job_function(job, **job.get_params())
+        job.status = Job.DONE
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(f"Job {job.id} ({job.type}) failed")
+        job.add_errors([f"Job failed: {e}"])
+        job.status = Job.FAILED
+    finally:
+        is_finished.set()
+    job.params = None # e.g., bulk registration's passwords: no longer needed
+    job.finished_at = _utc_now()
+    job.save()
+
+
+def _work(app, worker_name):
+    while True:
+        job = None
+        with app.app_context():
+            try:
+                if job := claim_next_job(worker_name):
+                    run_job(app, job)
+            except Exception:
+                app.logger.exception(f"Job worker {worker_name} hit a problem")
+                time.sleep(JOB_POLL_INTERVAL) # e.g., database is down: don't spin
+            finally:
+                db.session.remove()
+        if job is None:
+            _wake_workers.wait(JOB_POLL_INTERVAL)
+            _wake_workers.clear()
+
+
+def start_job_workers(app):
+    """ Starts this process's job workers, if they haven't been started (it's
+    cheap to call this on every request)"""
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+        for i in range(app.config.get("JOB_WORKERS", 1)):
+            worker_name = f"{socket.gethostname()}:{_workers_pid}:{i}"
+            threading.Thread(
+                target=_work,
+                args=(app, worker_name),
+                name=f"job-worker-{i}",
+                daemon=True,
+            ).start()
+
+
+def _publish_tech_notes(job):
+    output_msg = publish_tech_notes(current_app)
+    return f"{output_msg}\nRe-generated tech notes (static web pages) OK"
+
+
+def _publish_task_list(job):
+    hints_msg = publish_task_list(current_app)
+    publish_tasks_as_issues_csv(current_app)
+    messages = [hints_msg]
+    qty_tasks = Task.query.filter_by(is_enabled=True).count()
+    if qty_tasks == 0:
+        job.add_errors([
+            "Task list page has been generated but there are no unhidden "
+            "tasks in the project yet! You should load some tasks into the "
+            "database before the project can start"
+        ])
+    else:
+        messages.append(f"OK, task list page has been generated with latest data ({qty_tasks} tasks)")
+    if current_app.config[ConfigSettingNames.IS_STORING_TASK_LIST_IN_DB.name]:
+        messages.append(
+            "The task list page is being stored in the database "
+            "(and not written to file as static content)"
+        )
+    return "\n".join(msg for msg in messages if msg)
+
+
+def _load_tasks(job, markdown, pretty_source, want_overwrite=False):
+    # the markdown is in the job (not a file) because this might be running
+    # in a different process (or even on a different host) from the upload
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", suffix=".md", delete=False
+    ) as md_file:
+        md_file.write(markdown)
+    try:
+        qty_tasks_added = load_tasks_into_db(
+            md_file.name, app=current_app, want_overwrite=want_overwrite
+        )
+    finally:
+        os.unlink(md_file.name)
+    return (
+        f"OK, put {qty_tasks_added} {pretty_source} into the database\n"
+        "Remember to publish the task list now! "
+        "...unless you're going to edit any tasks first"
+    )
+
+
+def _create_editor_zipfile(job, readme_contents):
+    create_editor_zipfile(readme_contents, app=current_app)
+    # save this README in database so auto-generation can reproduce it
+    readme_db_file = DbFile.query.filter_by(
+        type=DbFile.README_TYPE
+    ).first() # don't care about item_id: there is only ever one
+    if readme_db_file is None:
+        readme_db_file = DbFile.create(type=DbFile.README_TYPE)
+    readme_db_file.contents = readme_contents
+    readme_db_file.save()
+    set_and_save_config_setting(
+        current_app,
+        name=ConfigSettingNames._EDITOR_ZIP_GENERATED_DATETIME.name,
+        value=_utc_now().strftime("%Y-%m-%d %H:%M")
+    )
+    return "Published buggy editor zipfile OK"
+
+
+def _inject_issues_into_repo(job, repo_name):
+    # Issues appear in most recent order, but they're injected in task order
+    # (if the GitHub API rate-limits us, it's better to lose the last ones).
+    # Progress is saved after each one, so if this job is interrupted, it
+    # carries on from the next issue (rather than repeating any).
+    user = db.session.get(User, job.user_id)
+    if user is None:
+        raise ValueError("User has been deleted")
+    issues_parser = IssueParser(
+        join_to_project_root(
+          current_app.config[ConfigSettingNames._PUBLISHED_PATH.name],
+          current_app.config[ConfigSettingNames._BUGGY_EDITOR_ISSUES_CSV_FILE.name]
+        ),
+        current_app.config[ConfigSettingNames.BUGGY_EDITOR_ISSUES_CSV_HEADER_ROW.name]
+    )
+    issues = issues_parser.parse_issues()
+    job.qty_total = len(issues)
+    job.save()
+    # The client paces the posts, and if GitHub rate-limits us it waits
+    # (for as long as GitHub says) and tries again
+    github = user.github
+    github.max_rate_limit_wait = ISSUE_INJECTION_MAX_RATE_LIMIT_WAIT
+    for issue in issues[job.qty_done:]:
+        response = github.post(
+            f"/repos/{user.github_username}/{repo_name}/issues",
+            {},
+            {
+                'title': issue['title'],
+                'body': issue['body'],
+                'assignees': [user.github_username]
+            }
+        )
+        if response.status >= 300:
+            job.qty_failed += 1
+            job.add_errors([f"\"{issue['title']}\": {response.status} {response.reason}"])
+        job.qty_done += 1
+        job.save()
+    return f"Injected {job.qty_done - job.qty_failed} issues into {repo_name}"
+
+
+JOB_FUNCTIONS = {
+    Job.BULK_REGISTER_TYPE: register_users,
+    Job.EDITOR_ZIP_TYPE: _create_editor_zipfile,
+    Job.INJECT_ISSUES_TYPE: _inject_issues_into_repo,
+    Job.LOAD_TASKS_TYPE: _load_tasks,
+    Job.PUBLISH_TASK_LIST_TYPE: _publish_task_list,
+    Job.PUBLISH_TECH_NOTES_TYPE: _publish_tech_notes,
+}
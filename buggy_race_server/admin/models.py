@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
-"""Admin models: settings and announcements."""
+"""Admin models: settings, announcements and background jobs."""
 
 from collections import defaultdict
 from datetime import datetime
 from enum import Enum, auto
+import gzip
 import re
 import json
 import markdown
-from sqlalchemy import sql
+from markupsafe import escape
+from sqlalchemy import event, orm, sql
 
 from buggy_race_server.database import Column, Model, SurrogatePK, db
+from buggy_race_server.extensions import blob_store
 from buggy_race_server.config import AnnouncementTypes, ConfigSettingNames
 
 class DbFile(SurrogatePK, Model):
@@ -17,6 +20,8 @@ class DbFile(SurrogatePK, Model):
     RACE_FILE_TYPE = "racefile"
     README_TYPE = "readme"
     TASK_LIST = "tasklist"
+    REPLAY_HEADER_TYPE = "rphead" # race file without events, for replays
+    REPLAY_CHUNK_TYPE = "rpchunk" # some of a race's events: name is the index
 
     """Using database to store text files (write once, read many)
     to overcome some limitations of ephemeral file systems (like Heroku).
@@ -25,11 +30,210 @@ class DbFile(SurrogatePK, Model):
     on restart.
     """
     __tablename__ = "db_files"
+    __table_args__ = (
+        db.Index("ix_db_files_type_item_id", "type", "item_id"),
+    )
     id = db.Column(db.Integer, primary_key=True) # not used in practice?
     type = db.Column(db.String(8), unique=False, nullable=False)
     name = db.Column(db.String(64), unique=False, nullable=True)
     item_id = db.Column(db.Integer, db.ForeignKey('races.id'), nullable=True)
-    contents = db.Column(db.Text(), unique=False, nullable=False, default="")
+    contents = db.deferred(db.Column(db.Text(), unique=False, nullable=False, default=""))
+    # if the contents are in the blob store (see set_contents), these are the
+    # hashes of them and of a gzipped copy (so also their strong ETags)
+    etag = db.Column(db.String(64), unique=False, nullable=True)
+    gzip_etag = db.Column(db.String(64), unique=False, nullable=True)
+
+    def set_contents(self, contents):
+        """ Puts the contents, and a gzipped copy of them, in the blob store
+        (instead of in this row), so serving the file doesn't need to load
+        or compress them on every request (it's write once, read many)"""
+        encoded_contents = contents.encode("utf-8")
+        self.contents = ""
+        self.etag = blob_store.put(encoded_contents)
+        # mtime=0: no time in the gzip header, so the same contents always
+        # make the same blob (and ETag)
+        self.gzip_etag = blob_store.put(gzip.compress(encoded_contents, mtime=0))
+
+    def get_blob_hashes(self):
+        """ The hashes of this file's blobs (if any): see delete_unused_blobs"""
+        return [blob_hash for blob_hash in (self.etag, self.gzip_etag) if blob_hash]
+
+    def get_contents(self):
+        if self.etag is None:
+            return self.contents
+        return blob_store.get(self.etag).decode("utf-8")
+
+
+class Blob(Model):
+    """Blob store's table, only used if BLOB_STORE is "db" (see
+    lib/blob_store.py, which reads and writes it without this model)"""
+    __tablename__ = "blobs"
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    data = db.deferred(db.Column(db.LargeBinary(), nullable=False))
+
+
+class CacheVersion(Model):
+    """Version numbers of data that's cached (maybe by many workers, which
+    each have their own copy): put the version in the cache key, and bump
+    it when the data changes, so every worker knows its copy is stale."""
+
+    ANNOUNCEMENTS = "announcements"
+    RACES = "races"
+    SETTINGS = "settings"
+    NAMES = (ANNOUNCEMENTS, RACES, SETTINGS) # each has a row from the start
+
+    __tablename__ = "cache_versions"
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get_version(name):
+        return db.session.execute(
+            sql.select(CacheVersion.version).where(CacheVersion.name==name)
+        ).scalar() or 0
+
+    @staticmethod
+    def get_versions(*names):
+        """ Returns a dict of the versions of all the names (in one query)"""
+        versions = dict.fromkeys(names, 0)
+        versions.update(db.session.execute(
+            sql.select(CacheVersion.name, CacheVersion.version).where(
+                CacheVersion.name.in_(names)
+            )
+        ).all())
+        return versions
+
+    @staticmethod
+    def bump(name, commit=True):
+        """ Increments the version (in the database, so it's atomic even if
+        workers bump it at the same time): the row is already there (it's
+        added with the table), so this is only ever an UPDATE"""
+        result = db.session.execute(
+            sql.update(CacheVersion).where(CacheVersion.name==name).values(
+                version=CacheVersion.version + 1
+            )
+        )
+        if result.rowcount == 0:
+            raise ValueError(f"no cache version called \"{name}\" (is the database up to date?)")
+        if commit:
+            db.session.commit()
+
+@event.listens_for(CacheVersion.__table__, "after_create")
+def add_cache_version_rows(table, connection, **kwargs):
+    """ So bump never has to insert (see the cache_versions migration, which
+    does the same)"""
+    connection.execute(table.insert(), [{"name": name, "version": 0} for name in CacheVersion.NAMES])
+
+
+class Job(SurrogatePK, Model):
+    """A job that's too slow to do while the request waits (e.g., bulk
+    registration, or publishing the tech notes): it's queued here, and run
+    by a job worker (see admin/jobs.py) in whichever process claims it. Its
+    progress and errors are saved here so the admin's browser can keep
+    asking, and so the job isn't lost if its process is recycled."""
+
+    BULK_REGISTER_TYPE = "bulkreg"
+    EDITOR_ZIP_TYPE = "editorzip"
+    INJECT_ISSUES_TYPE = "issues"
+    LOAD_TASKS_TYPE = "loadtasks"
+    PUBLISH_TASK_LIST_TYPE = "tasklist"
+    PUBLISH_TECH_NOTES_TYPE = "technotes"
+
+    DESCRIPTIONS = {
+        BULK_REGISTER_TYPE: "Bulk registration",
+        EDITOR_ZIP_TYPE: "Publish buggy editor zipfile",
+        INJECT_ISSUES_TYPE: "Inject issues into repo",
+        LOAD_TASKS_TYPE: "Load tasks",
+        PUBLISH_TASK_LIST_TYPE: "Publish task list",
+        PUBLISH_TECH_NOTES_TYPE: "Publish tech notes",
+    }
+
+    # these write the same files, so only one of each type runs at a time
+    EXCLUSIVE_TYPES = (
+        EDITOR_ZIP_TYPE,
+        LOAD_TASKS_TYPE,
+        PUBLISH_TASK_LIST_TYPE,
+        PUBLISH_TECH_NOTES_TYPE,
+    )
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    FINISHED_STATUSES = (DONE, FAILED)
+    MAX_ERRORS = 500 # enough to see what's going wrong
+    MAX_ATTEMPTS = 3 # a job whose worker keeps dying isn't tried forever
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        db.Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+    type = db.Column(db.String(16), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=PENDING)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="SET NULL"), nullable=True)
+    params = db.deferred(db.Column(db.Text(), nullable=True)) # JSON, cleared when finished
+    result = db.Column(db.Text(), nullable=True) # message for the admin
+    qty_total = db.Column(db.Integer, nullable=False, default=0)
+    qty_done = db.Column(db.Integer, nullable=False, default=0)
+    qty_failed = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text(), nullable=False, default="[]") # JSON list
+    worker = db.Column(db.String(64), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=sql.func.now())
+    run_after = db.Column(db.DateTime(timezone=True), nullable=False, default=sql.func.now())
+    started_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    # while it's running, its worker keeps this up to date: if it stops, the
+    # worker has gone (see JOB_HEARTBEAT_TIMEOUT in admin/jobs.py)
+    heartbeat_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    finished_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def __init__(self, **kwargs):
+        """Create instance."""
+        db.Model.__init__(self, **kwargs)
+
+    @property
+    def is_finished(self):
+        return self.status in Job.FINISHED_STATUSES
+
+    @property
+    def description(self):
+        return Job.DESCRIPTIONS.get(self.type, self.type)
+
+    def get_params(self):
+        return json.loads(self.params or "{}")
+
+    def get_errors(self):
+        return json.loads(self.errors or "[]")
+
+    def add_errors(self, error_messages):
+        """ Appends the messages to the job's errors (but not past MAX_ERRORS:
+        the failures are still counted in qty_failed) """
+        errors = self.get_errors()
+        errors.extend(error_messages[:max(0, Job.MAX_ERRORS - len(errors))])
+        self.errors = json.dumps(errors)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "description": self.description,
+            "status": self.status,
+            "is_finished": self.is_finished,
+            "result": self.result,
+            "qty_total": self.qty_total,
+            "qty_done": self.qty_done,
+            "qty_failed": self.qty_failed,
+            "errors": self.get_errors(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return f"<Job({self.id!r} {self.type} {self.status} {self.qty_done}/{self.qty_total})>"
 
 
 class LinkedSiteSettings():
@@ -116,6 +320,18 @@ class Announcement(SurrogatePK, Model):
       """Create instance."""
       db.Model.__init__(self, **kwargs)
 
+    def to_dict(self):
+        """ Returns what's needed to display the announcement, as a plain
+        dict (which can be cached and shared, unlike the ORM object): html is
+        ready to go in the page (the text is escaped if it isn't HTML)"""
+        return {
+            "id": self.id,
+            "type": self.type,
+            "is_html": self.is_html,
+            "text": self.text,
+            "html": self.text if self.is_html else str(escape(self.text)),
+        }
+
     def __repr__(self):
         """Represent instance as a unique string."""
         return f"<Announcement({self.id!r} text:{self.text[0:16]}...)>"
@@ -126,6 +342,8 @@ class Task(SurrogatePK, Model):
     ANCHOR_PREFIX = "task-"
     FULLNAME_RE = re.compile(r"^(\d+)-([a-zA-Z][a-zA-Z0-9_]*)$")
 
+    TEXTS_GROUP = "texts" # the deferred text columns (see query_with_texts)
+
     # replaces %KEY% with config setting
     CONFIG_EMBED_RE = re.compile(r"%s*([_A-Z][A-Z0-9_]+)\s*%")
 
@@ -147,10 +365,17 @@ class Task(SurrogatePK, Model):
       return (phase, name)
     
     @staticmethod
-    def get_dict_tasks_by_phase(want_hidden=True):
+    def query_with_texts():
+        """ The task's texts are deferred (lists of tasks mostly only need
+            their names): use this for tasks whose texts will be read"""
+        return Task.query.options(orm.undefer_group(Task.TEXTS_GROUP))
+
+    @staticmethod
+    def get_dict_tasks_by_phase(want_hidden=True, want_texts=False):
         """Returns dict keyed on phase number containing lists of
            tasks (in task sort order)"""
-        tasks = Task.query.order_by(
+        query = Task.query_with_texts() if want_texts else Task.query
+        tasks = query.order_by(
           Task.phase.asc(),
           Task.sort_position.asc()
         ).all()
@@ -223,9 +448,9 @@ class Task(SurrogatePK, Model):
     phase = Column(db.Integer, nullable=False)
     name = Column(db.String(16), unique=False, nullable=False)
     title = Column(db.String(80), unique=False, nullable=False)
-    problem_text = Column(db.Text(), unique=False, nullable=False, default="")
-    solution_text = Column(db.Text(), unique=False, nullable=False, default="")
-    hints_text = Column(db.Text(), unique=False, nullable=False, default="")
+    problem_text = db.deferred(Column(db.Text(), unique=False, nullable=False, default=""), group=TEXTS_GROUP)
+    solution_text = db.deferred(Column(db.Text(), unique=False, nullable=False, default=""), group=TEXTS_GROUP)
+    hints_text = db.deferred(Column(db.Text(), unique=False, nullable=False, default=""), group=TEXTS_GROUP)
     is_enabled = db.Column(db.Boolean(), nullable=False, default=True)
     sort_position = db.Column(db.Integer, nullable=False, default=0)
 
@@ -247,12 +472,22 @@ class TaskText(SurrogatePK, Model):
         #         TaskText.user_id==User.id
         #     ).order_by(User.username.asc()).all()
 
+    @staticmethod
+    def query_with_lengths():
+        """ For lists of texts that only need to know how long they are:
+            the (deferred) text isn't loaded, but its length is"""
+        return TaskText.query.options(
+            orm.with_expression(TaskText.text_length, sql.func.length(TaskText.text))
+        )
+
     @staticmethod
     def get_dict_texts_by_task_id(user_id):
-        """Returns dict of texts keyed on task id"""
+        """Returns dict of texts keyed on task id: for all students (if
+           user_id is None) these are lists without the text (see
+           query_with_lengths), otherwise it's the user's texts"""
         if user_id is None: # all active students
             from buggy_race_server.user.models import User
-            texts = TaskText.query.join(User).filter(
+            texts = TaskText.query_with_lengths().join(User).filter(
                     User.is_student==True
                 ).filter(User.is_active==True).all()
             texts_by_task_id = defaultdict(list)
@@ -261,7 +496,7 @@ class TaskText(SurrogatePK, Model):
             return texts_by_task_id
         return {
             tasktext.task_id: tasktext
-            for tasktext in TaskText.query.filter_by(user_id=user_id).all()
+            for tasktext in TaskText.query.options(orm.undefer(TaskText.text)).filter_by(user_id=user_id).all()
         }
 
     # def to_dict(self):
@@ -279,9 +514,14 @@ class TaskText(SurrogatePK, Model):
     modified_at = Column(db.DateTime(timezone=True), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'), nullable=False)
-    text = Column(db.Text(), unique=False, nullable=False, default="")
+    text = db.deferred(Column(db.Text(), unique=False, nullable=False, default=""))
+    text_length = db.query_expression() # only set by query_with_lengths
 
     __tablename__ = "tasktexts"
+    __table_args__ = (
+        # one text per user per task
+        db.Index("ix_tasktexts_user_id_task_id", "user_id", "task_id", unique=True),
+    )
 
     def __init__(self, **kwargs):
        """Create instance."""
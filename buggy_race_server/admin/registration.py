@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Bulk registration of users (students) from CSV.
+
+The whole CSV is checked first (so a bad line means nobody is registered,
+and all the problems can be fixed at once): then the users are registered
+by a job (see admin/jobs.py), because hashing their passwords with bcrypt
+is slow. The hashing is done in a pool of processes, and the users are
+inserted a chunk at a time as their hashes arrive.
+
+The job's parameters include the passwords (unhashed), because the job
+might be run by another process: but they are encrypted (with a key from
+the app's SECRET_KEY), so they are never in the database (or its backups)
+in plain text, and they are cleared when the job finishes.
+"""
+
+import base64
+import csv
+import hashlib
+
+from cryptography.fernet import Fernet, InvalidToken
+from flask import current_app
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from buggy_race_server.config import ConfigSettings, ConfigSettingNames
+from buggy_race_server.database import db
+from buggy_race_server.lib.passwords import iter_password_hashes
+from buggy_race_server.user.models import User
+
+REGISTRATION_CHUNK_SIZE = 50 # users inserted per commit
+MIN_PASSWORD_LENGTH = 4
+UNIQUE_FIELDNAMES = ("username", "ext_username", "ext_id", "email")
+LOOKUP_CHUNK_SIZE = 500 # values per IN (...) when checking existing users
+
+def _csv_tidy_string(row, fieldname, want_lower=False):
+    # incoming CSV fields might be None (i.e., not "")
+    # e.g. if the row wasn't long enough
+    s = row.get(fieldname)
+    if s is not None:
+        s = str(s).strip()
+        if want_lower:
+            s = s.lower()
+    return s
+
+def _get_existing_values(fieldname, values):
+    column = getattr(User, fieldname)
+    values = list(values)
+    existing = set()
+    for i in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        existing.update(
+            db.session.execute(
+                select(column).where(column.in_(values[i:i+LOOKUP_CHUNK_SIZE]))
+            ).scalars()
+        )
+    return existing
+
+def _get_password_cipher():
+    """ The cipher for passwords in the registration job's parameters: its
+    key is derived from the app's SECRET_KEY (which every process has)"""
+    secret_key = str(current_app.config["SECRET_KEY"])
+    key = hashlib.sha256(f"bulk-registration:{secret_key}".encode("utf-8")).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+def _decrypt_passwords(encrypted_passwords):
+    cipher = _get_password_cipher()
+    try:
+        return [cipher.decrypt(password).decode("utf-8") for password in encrypted_passwords]
+    except InvalidToken:
+        raise ValueError(
+            "couldn't decrypt the passwords (has SECRET_KEY changed since "
+            "the registration started?): nobody else was registered"
+        )
+
+def read_users_from_csv(lines):
+    """ Returns (users, errors): users is a list of [line_no, fields, password]
+    for the users to register (fields are ready to insert, except for the
+    password, which is encrypted, not hashed yet: it's all JSON-serialisable,
+    so it can be the registration job's parameters), and errors is a list of
+    messages about what's wrong with the CSV (if there are any, nobody should
+    be registered)"""
+    if len(lines) < 2:
+        return [], ["Need CSV with a header row, then at least one line of data"]
+    lines = list(lines)
+    lines[0] = ",".join(User.tidy_fieldnames(lines[0].split(",")))
+    reader = csv.DictReader(lines, delimiter=',')
+    if missing := User.get_missing_fieldnames(reader.fieldnames):
+        return [], [f"CSV header row is missing some required fields: {', '.join(missing)}"]
+    is_enabled_dict = ConfigSettings.users_additional_fieldnames_is_enabled_dict(current_app)
+    is_api_secret_otp = current_app.config[ConfigSettingNames.IS_API_SECRET_ONE_TIME_PW.name]
+    cipher = _get_password_cipher()
+    users = []
+    errors = []
+    line_nos_by_value = {fieldname: {} for fieldname in UNIQUE_FIELDNAMES}
+    for row in reader:
+        line_no = reader.line_num
+        fields = {
+            "username": _csv_tidy_string(row, "username", want_lower=True),
+            "ext_username": _csv_tidy_string(row, "ext_username", want_lower=True),
+            "ext_id": _csv_tidy_string(row, "ext_id"),
+            "email": _csv_tidy_string(row, "email", want_lower=True),
+            "first_name": _csv_tidy_string(row, "first_name"),
+            "last_name": _csv_tidy_string(row, "last_name"),
+            "is_active": True,
+            "is_admin": False,
+            "is_student": True,
+            "access_level": User.NO_STAFF_ROLE, # to convert to staff, must edit
+            "is_api_secret_otp": is_api_secret_otp,
+            "latest_json": "",
+            "comment": _csv_tidy_string(row, "comment"),
+        }
+        # disallow optional fields to be set unless they are explicitly enabled
+        for fieldname in is_enabled_dict:
+            if fieldname in fields and not is_enabled_dict[fieldname]:
+                fields[fieldname] = None
+        password = _csv_tidy_string(row, "password")
+        if not fields["username"]:
+            errors.append(f"Line {line_no}: missing username")
+        if not password or len(password) < MIN_PASSWORD_LENGTH:
+            errors.append(f"Line {line_no}: password must be at least {MIN_PASSWORD_LENGTH} characters long")
+        for fieldname in UNIQUE_FIELDNAMES:
+            if value := fields[fieldname]:
+                if value in line_nos_by_value[fieldname]:
+                    errors.append(
+                        f"Line {line_no}: {fieldname} \"{value}\" is already on "
+                        f"line {line_nos_by_value[fieldname][value]}"
+                    )
+                else:
+                    line_nos_by_value[fieldname][value] = line_no
+        if password:
+            password = cipher.encrypt(password.encode("utf-8")).decode("ascii")
+        users.append([line_no, fields, password])
+    if not users:
+        errors.append("Need CSV with a header row, then at least one line of data")
+    for fieldname in UNIQUE_FIELDNAMES:
+        for value in sorted(_get_existing_values(fieldname, line_nos_by_value[fieldname])):
+            errors.append(
+                f"Line {line_nos_by_value[fieldname][value]}: there is already "
+                f"a user with {fieldname} \"{value}\""
+            )
+    return users, errors
+
+def _get_db_error_message(e):
+    # risky but frustratingly no easy way to get the specific database
+    # error as it's coming back from the connection: e.g.,
+    # (mysql.connector.errors.IntegrityError) 1062 (23000): Duplicate entry 'aaaa' for key 'username'
+    return str(e).split("\n")[0] # mySQL sends the SQL back too after a newline: don't want
+
+def _insert_users(job, rows):
+    """ Inserts the rows in one go, or, if that fails, one at a time (so
+    only the bad ones fail), and saves the job's progress: in one go, that's
+    the same commit as the insert (so if the job is interrupted and resumed,
+    its progress is right)"""
+    errors = []
+    try:
+        db.session.execute(insert(User.__table__), rows)
+    except SQLAlchemyError:
+        db.session.rollback()
+        for row in rows:
+            try:
+                db.session.execute(insert(User.__table__), [row])
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                errors.append(f"\"{row['username']}\": {_get_db_error_message(e)}")
+    job.qty_done += len(rows)
+    job.qty_failed += len(errors)
+    job.add_errors(errors)
+    job.save()
+
+def register_users(job, users):
+    """ The bulk registration job: users are from read_users_from_csv. If
+    the job is resumed, it starts after the last chunk it inserted."""
+    job.qty_total = len(users)
+    job.save()
+    users = users[job.qty_done:]
+    password_hashes = iter_password_hashes(
+        _decrypt_passwords([password for (_, _, password) in users]),
+        # same settings as the bcrypt extension, so check_password works
+        log_rounds=current_app.config.get("BCRYPT_LOG_ROUNDS", 12),
+        prefix=current_app.config.get("BCRYPT_HASH_PREFIX", "2b"),
+        is_long_password_hashed=current_app.config.get("BCRYPT_HANDLE_LONG_PASSWORDS", False),
+    )
+    try:
+        for i in range(0, len(users), REGISTRATION_CHUNK_SIZE):
+            _insert_users(job, [
+                {**fields, "password": next(password_hashes)}
+                for (_, fields, _) in users[i:i+REGISTRATION_CHUNK_SIZE]
+            ])
+    finally:
+        password_hashes.close() # shuts down the pool
+    return f"Registered {job.qty_done - job.qty_failed} users"
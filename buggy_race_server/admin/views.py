@@ -6,7 +6,7 @@ import csv
 import json
 import io  # for CSV dump
 import random  # for API tests
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import os
 from collections import defaultdict
 import markdown
@@ -29,7 +29,7 @@ from flask import (
     url_for,
 )
 from flask_login import current_user, login_required, login_user, logout_user
-from sqlalchemy import bindparam, select, delete, insert, update
+from sqlalchemy import and_, case, select, delete, func, update
 
 from flask_wtf import FlaskForm
 from werkzeug.utils import secure_filename
@@ -54,14 +54,25 @@ from buggy_race_server.admin.forms import (
     UploadTaskTextsForm,
     UserTypesForLogin,
 )
+from buggy_race_server.admin.dashboard import (
+    LOGIN_EVER,
+    LOGIN_NEVER,
+    LOGIN_THIS_WEEK,
+    LOGIN_TODAY,
+    get_dashboard_data,
+)
+from buggy_race_server.admin.jobs import enqueue_job
 from buggy_race_server.admin.models import (
     Announcement,
+    CacheVersion,
     DbFile,
+    Job,
     TaskText,
     Setting,
     LinkedSiteSettings,
     Task
 )
+from buggy_race_server.admin.registration import read_users_from_csv
 from buggy_race_server.buggy.models import Buggy
 from buggy_race_server.buggy.views import show_buggy as show_buggy_by_user
 from buggy_race_server.buggy.views import delete_buggy as delete_buggy_by_user
@@ -76,32 +87,30 @@ from buggy_race_server.config import (
 )
 from buggy_race_server.database import db
 from buggy_race_server.extensions import csrf, bcrypt
+from buggy_race_server.lib.race_specs import BuggySpecs
+from buggy_race_server.lib.race_specs_bulk import evaluate_specs, get_violation_names
 from buggy_race_server.user.forms import UserForm, RegisterForm, UserCommentForm
 from buggy_race_server.user.models import User
 from buggy_race_server.utils import (
     _get_buggy_editor_kwargs,
     admin_only,
     create_default_task_markdown_file,
-    create_editor_zipfile,
     flash_errors,
     get_day_of_week,
     get_download_filename,
     get_flag_color_css_defs,
     get_pretty_approx_duration,
+    get_settings_as_dict,
     get_tasks_as_issues_csv,
     join_to_project_root,
     load_config_setting,
-    load_settings_from_db,
-    load_tasks_into_db,
     most_recent_timestamp,
     prettify_form_field_name,
-    publish_task_list,
-    publish_tasks_as_issues_csv,
-    publish_tech_notes,
     purge_task_list,
     quote_string,
     redact_password_in_database_url,
     refresh_global_announcements,
+    save_config_settings,
     servertime_str,
     set_and_save_config_setting,
     staff_only,
@@ -116,11 +125,7 @@ blueprint = Blueprint(
 )
 
 SETTING_PREFIX = "settings" # the name of settings subform
-
-def _is_from_dashboard():
-    if ref := request.referrer:
-        return ref.endswith("/admin/") or ref.endswith("/admin")
-    return False
+MAX_JOBS_LISTED = 50
 
 def _is_task_list_published():
     if current_app.config[ConfigSettingNames.IS_STORING_TASK_LIST_IN_DB.name]:
@@ -177,9 +182,8 @@ def _update_settings_in_db(form):
     """ Used by setup and settings: returns boolean success.
         Check the form has validated OK *before* calling this.
     """
-    settings_as_dict = Setting.get_dict_from_db(Setting.query.all())
-    config_data_insert = []
-    config_data_update = []
+    settings_as_dict = get_settings_as_dict(current_app)
+    changed_settings = {}
     qty_settings_changed = 0
     has_changed_secret_key = False
     is_in_setup_mode = bool(current_app.config[ConfigSettingNames._SETUP_STATUS.name])
@@ -225,10 +229,7 @@ def _update_settings_in_db(form):
                     pretty_new = ConfigSettings.prettify(name, value)
                     changed_msg = f"Changed {name} from \"{pretty_old}\" to \"{pretty_new}\""
                 flash(changed_msg, "info")
-                config_data_update.append({
-                    "name": name,
-                    "value": value
-                })
+                changed_settings[name] = value
                 is_changed_value = True
         else:
             # config not in settings table: unexpected but roll with it: INSERT
@@ -237,41 +238,20 @@ def _update_settings_in_db(form):
             else:
                 changed_msg = f"Setting {name} to \"{ConfigSettings.prettify(name, value)}\""
             flash(changed_msg, "info")
-            config_data_insert.append({
-                "id": name,
-                "value": value
-            })
+            changed_settings[name] = value
             is_changed_value = True
         if is_changed_value:
             qty_settings_changed += 1
             has_changed_secret_key = name == ConfigSettingNames.SECRET_KEY.name
 
     if qty_settings_changed:
-        settings_table = Setting.__table__
-        if config_data_update:
-            try:
-              result = db.session.execute(
-                update(settings_table)
-                  .where(settings_table.c.id == bindparam("name"))
-                  .values(value=bindparam("value")),
-                  config_data_update
-              )
-              db.session.commit()
-            except Exception as e:
-                flash(str(e), "danger")
-                is_update_ok = False
-        if config_data_insert:
-            try:
-              result = db.session.execute(
-                  insert(settings_table),
-                  config_data_insert
-              )
-              db.session.commit()
-            except Exception as e:
-                flash(str(e), "danger")
-                is_update_ok = False
-        # we've changed config, try to update config too
-        load_settings_from_db(current_app)
+        # one transaction for the whole group (which also updates the config)
+        try:
+            save_config_settings(current_app, changed_settings)
+        except Exception as e:
+            db.session.rollback()
+            flash(str(e), "danger")
+            is_update_ok = False
         if has_changed_secret_key:
             # this is problematic: because the existing token will now fail
             # as well as any existing sessions probably
@@ -295,16 +275,6 @@ def _user_summary(username_list):
     else:
         return f"{len(username_list)} users"
 
-def _csv_tidy_string(row, fieldname, want_lower=False):
-  # incoming CSV fields might be None (i.e., not "")
-  # e.g. if the row wasn't long enough
-  s = row[fieldname] if fieldname in row else None
-  if s is not None:
-      s = str(s).strip()
-      if want_lower:
-          s = s.lower()
-  return s
-
 def _flash_errors(form):
   """ Flash errors in form, which may include settings subform """
   # if hasattr(form, SETTING_PREFIX) and form.settings.errors:
@@ -349,9 +319,9 @@ def setup_summary():
     qty_announcements_login = 0
     qty_announcements_tagline = 0
     for ann in current_app.config[ConfigSettingNames._CURRENT_ANNOUNCEMENTS.name]:
-        if ann.type == AnnouncementTypes.LOGIN.value:
+        if ann["type"] == AnnouncementTypes.LOGIN.value:
             qty_announcements_login += 1
-        elif ann.type == AnnouncementTypes.TAGLINE.value:
+        elif ann["type"] == AnnouncementTypes.TAGLINE.value:
             qty_announcements_tagline += 1
         else:
             qty_announcements_global += 1
@@ -514,7 +484,7 @@ def setup():
         flash("Setup complete: you can now publish tech notes, add/edit tasks, and register users", "success")
         return setup_summary()
     group_name = ConfigSettings.SETUP_GROUPS[setup_status-1]
-    settings_as_dict = Setting.get_dict_from_db(Setting.query.all())
+    settings_as_dict = get_settings_as_dict(current_app)
     html_descriptions = { 
         setting: markdown.markdown(ConfigSettings.DESCRIPTIONS[setting])
         for setting in ConfigSettings.DESCRIPTIONS
@@ -563,57 +533,17 @@ def setup():
 def get_admin_dashboard_data_response(want_json=False):
     """ The dashboard code is broken out into its own function so it is
         available via the API (which doesn't use session (@login_required)
-        to determine whether or not the user is authorised. """
-    TASK_NOTE_LENGTH_THRESHOLD = 2 # texts shorter than this are not counted
-    now = datetime.now(timezone.utc)
-    today = now.date()
-    one_week_ago = today - timedelta(days=7)
-    users = User.query.order_by(User.username).all()
-    buggies = Buggy.query.join(User).filter(
-                User.is_student==True
-              ).filter(User.is_active==True).all()
-    students_active = [s for s in users if s.is_student and s.is_active]
-    students_never_logged_in = [s for s in students_active if s.logged_in_at is None ]
-    students_logged_in_ever = [s for s in students_active if s not in students_never_logged_in]
-    students_logged_in_today = [s for s in students_logged_in_ever if s.logged_in_at.date() >= today]
-    students_logged_in_this_week = [s for s in students_logged_in_ever
-                                        if s not in students_logged_in_today
-                                        and s.logged_in_at.date() >= one_week_ago
-                                    ]
-    students_logged_in_ever = [s for s in students_logged_in_ever if s.logged_in_at.date() < one_week_ago ]
-    students_uploaded_this_week = [s for s in students_active if s.uploaded_at and s.uploaded_at.date() >= one_week_ago]
-    users_deactivated = [u for u in users if not u.is_active]
-    staff_users = [u for u in users if u.is_active and u.is_staff]
-    other_users = [u for u in users if u.is_active and not (u in students_active or u in staff_users)]
-    tasks = Task.query.filter_by(is_enabled=True).order_by(Task.phase.asc(), Task.sort_position.asc()).all()
-    qty_tasks = len(tasks)
-    tasks_by_id = {task.id: task.fullname for task in tasks}
-    qty_texts_by_task = defaultdict(int)
-    qty_texts = 0
-    texts_by_author_id = defaultdict(list) # used in the JSON
-    if is_storing_texts := current_app.config[ConfigSettingNames.IS_STORING_STUDENT_TASK_TEXTS.name]:
-        texts = TaskText.query.join(User).filter(
-            User.is_student==True).filter(User.is_active==True
-        ).all()
-        qty_texts = len(texts)
-        for text in texts:
-            if len(text.text) > TASK_NOTE_LENGTH_THRESHOLD:
-                qty_texts_by_task[tasks_by_id[text.task_id]] += 1
-                texts_by_author_id[text.user_id].append( text ) # this could be big
+        to determine whether or not the user is authorised. The data
+        itself comes from get_dashboard_data (so is cached briefly). """
+    is_storing_texts = current_app.config[ConfigSettingNames.IS_STORING_STUDENT_TASK_TEXTS.name]
+    data = get_dashboard_data(is_storing_texts, want_students=want_json)
     submission_deadline=current_app.config[ConfigSettingNames.PROJECT_SUBMISSION_DEADLINE.name]
-    qty_buggies=len(buggies)
-    qty_other_users=len(other_users)
-    qty_staff_users=len(staff_users)
-    qty_students_active=len(students_active)
-    qty_students_logged_in_this_week=len(students_logged_in_this_week)
-    qty_students_logged_in_today=len(students_logged_in_today)
-    qty_students_logged_in_ever=len(students_logged_in_ever)
-    qty_students_never_logged_in=len(students_never_logged_in)
-    qty_students=len(students_active)
-    qty_uploads_today=len([s for s in students_uploaded_this_week if s.uploaded_at.date() >= today])
-    qty_uploads_week=len(students_uploaded_this_week)
-    qty_users_deactivated=len(users_deactivated)
-    qty_users=len(users)
+    qty_students_by_login = data["qty_students_by_login"]
+    qty_students_logged_in_this_week=qty_students_by_login[LOGIN_THIS_WEEK]
+    qty_students_logged_in_today=qty_students_by_login[LOGIN_TODAY]
+    qty_students_logged_in_ever=qty_students_by_login[LOGIN_EVER]
+    qty_students_never_logged_in=qty_students_by_login[LOGIN_NEVER]
+    qty_students_active=data["qty_students_active"]
     if want_json:
         """Provide the data that's available in the dashboard in a JSON format
         so staff can collect these and run analytics. This is pushing the
@@ -621,42 +551,42 @@ def get_admin_dashboard_data_response(want_json=False):
         it in the database."""
         server_timezone = current_app.config[ConfigSettingNames.BUGGY_RACE_SERVER_TIMEZONE.name]
         payload = {
-            "timestamp": servertime_str(server_timezone, now),
+            "timestamp": servertime_str(server_timezone, data["now"]),
             "submission_deadline": servertime_str(server_timezone, submission_deadline),
             "quantitites": {
-                "qty_buggies": qty_buggies,
-                "qty_other_users": qty_other_users,
-                "qty_staff_users": qty_staff_users,
+                "qty_buggies": data["qty_buggies"],
+                "qty_other_users": data["qty_other_users"],
+                "qty_staff_users": data["qty_staff_users"],
                 "qty_students_active": qty_students_active,
                 "qty_students_logged_in_ever": qty_students_logged_in_ever,
                 "qty_students_logged_in_this_week": qty_students_logged_in_this_week,
                 "qty_students_logged_in_today": qty_students_logged_in_today,
                 "qty_students_never_logged_in": qty_students_never_logged_in,
-                "qty_students": qty_students,
-                "qty_tasks": qty_tasks,
-                "qty_texts_by_task": qty_texts_by_task,
-                "qty_texts": qty_texts,
-                "qty_uploads_today": qty_uploads_today,
-                "qty_uploads_week": qty_uploads_week,
-                "qty_users_deactivated": qty_users_deactivated,
-                "qty_users": qty_users
+                "qty_students": qty_students_active,
+                "qty_tasks": len(data["tasks"]),
+                "qty_texts_by_task": data["qty_texts_by_task"],
+                "qty_texts": data["qty_texts"],
+                "qty_uploads_today": data["qty_uploads_today"],
+                "qty_uploads_week": data["qty_uploads_week"],
+                "qty_users_deactivated": data["qty_users_deactivated"],
+                "qty_users": data["qty_users"]
             },
             "students_active": {
-                s.username: {
-                    "last_login": servertime_str(server_timezone, s.logged_in_at),
-                    "last_upload_at": servertime_str(server_timezone, s.uploaded_at),
-                    "json_length": s.pretty_json_length,
-                    "github_username": s.github_username,
+                username: {
+                    "last_login": servertime_str(server_timezone, s["last_login"]),
+                    "last_upload_at": servertime_str(server_timezone, s["last_upload_at"]),
+                    "json_length": s["json_length"],
+                    "github_username": s["github_username"],
                     "texts": {
-                        tasks_by_id[t.task_id]: {
-                            "length": len(t.text) if t.text else 0,
-                            "created_at": servertime_str(server_timezone, t.created_at),
-                            "modified_at": servertime_str(server_timezone, t.modified_at)
-                        } for t in texts_by_author_id[s.id]
+                        task_fullname: {
+                            "length": t["length"],
+                            "created_at": servertime_str(server_timezone, t["created_at"]),
+                            "modified_at": servertime_str(server_timezone, t["modified_at"])
+                        } for (task_fullname, t) in s["texts"].items()
                     },
-                    "qty_texts": len(texts_by_author_id[s.id])
+                    "qty_texts": s["qty_texts"]
                 }
-                for s in students_active
+                for (username, s) in data["students"].items()
             }
         }
         filename = get_download_filename("dashboard-snapshot.json", want_datestamp=True)
@@ -666,11 +596,12 @@ def get_admin_dashboard_data_response(want_json=False):
         return response
     project_customisable_details_dict = {}
     if current_app.config[ConfigSettingNames.IS_PROJECT_SUBMISSION_DEADLINE_PER_USER.name]:
-        project_customisable_details_dict["deadlines"] = sum([1 for s in students_active if s.submission_deadline])
+        project_customisable_details_dict["deadlines"] = data["qty_deadlines"]
     if current_app.config[ConfigSettingNames.IS_PROJECT_SUBMISSION_LINK_PER_USER.name]:
-        project_customisable_details_dict["links"] = sum([1 for s in students_active if s.submission_link])
+        project_customisable_details_dict["links"] = data["qty_links"]
     if current_app.config[ConfigSettingNames.IS_PROJECT_NOTICE_PER_USER.name]:
-        project_customisable_details_dict["notices"] = sum([1 for s in students_active if s.project_notice])
+        project_customisable_details_dict["notices"] = data["qty_notices"]
+    usernames = data["usernames"]
     return render_template(
         "admin/dashboard.html",
         form=GeneralSubmitForm(), # for publish submit buttons
@@ -686,38 +617,37 @@ def get_admin_dashboard_data_response(want_json=False):
           current_app.config[ConfigSettingNames.BUGGY_RACE_SERVER_TIMEZONE.name],
           current_app.config[ConfigSettingNames._TECH_NOTES_GENERATED_DATETIME.name]
         ),
-        other_users=other_users,
+        other_users=usernames["other"],
         project_customisable_details_dict=project_customisable_details_dict,
         purge_form = GeneralSubmitForm(),
-        qty_buggies=qty_buggies,
-        qty_other_users=qty_other_users,
-        qty_staff_users=qty_staff_users,
+        qty_buggies=data["qty_buggies"],
+        qty_other_users=data["qty_other_users"],
+        qty_staff_users=data["qty_staff_users"],
         qty_students_active=qty_students_active,
         qty_students_logged_in_this_week=qty_students_logged_in_this_week,
         qty_students_logged_in_today=qty_students_logged_in_today,
         qty_students_logged_in_ever=qty_students_logged_in_ever,
         qty_students_never_logged_in=qty_students_never_logged_in,
-        qty_students=qty_students,
-        qty_tasks=qty_tasks,
-        qty_texts_by_task=qty_texts_by_task,
-        qty_texts=qty_texts,
-        qty_uploads_today=qty_uploads_today,
-        qty_uploads_week=qty_uploads_week,
-        qty_users_deactivated=qty_users_deactivated,
-        qty_users=qty_users,
-        staff_users=staff_users,
-        students_active = students_active,
-        students_logged_in_this_week=students_logged_in_this_week,
-        students_logged_in_today=students_logged_in_today,
-        students_logged_in_ever=students_logged_in_ever,
-        students_never_logged_in=students_never_logged_in,
+        qty_students=qty_students_active,
+        qty_tasks=len(data["tasks"]),
+        qty_texts_by_task=data["qty_texts_by_task"],
+        qty_texts=data["qty_texts"],
+        qty_uploads_today=data["qty_uploads_today"],
+        qty_uploads_week=data["qty_uploads_week"],
+        qty_users_deactivated=data["qty_users_deactivated"],
+        qty_users=data["qty_users"],
+        staff_users=usernames["staff"],
+        students_logged_in_this_week=usernames[LOGIN_THIS_WEEK],
+        students_logged_in_today=usernames[LOGIN_TODAY],
+        students_logged_in_ever=usernames[LOGIN_EVER],
+        students_never_logged_in=usernames[LOGIN_NEVER],
         submission_deadline=submission_deadline,
         submission_deadline_day=get_day_of_week(submission_deadline),
-        tasks=tasks,
+        tasks=data["tasks"],
         task_list_updated_timestamp=current_app.config[ConfigSettingNames._TASK_LIST_GENERATED_DATETIME.name],
         tech_notes_generated_at=current_app.config[ConfigSettingNames._TECH_NOTES_GENERATED_DATETIME.name],
         unexpected_config_settings=current_app.config[ConfigSettings.UNEXPECTED_SETTINGS_KEY],
-        users_deactivated=users_deactivated,
+        users_deactivated=usernames["deactivated"],
     )
 
 @blueprint.route("/", strict_slashes=False)
@@ -738,7 +668,7 @@ def download_dashboard_summary_json():
 @staff_only
 def list_users(data_format=None, want_detail=True):
     """Admin list-of-uses/students page (which is the admin home page too)."""
-    users = User.query.all()
+    users = User.query_summaries(User.comment, User.project_notice).all()
     users = sorted(users, key=lambda user: (user.is_staff, user.username))
     students = [s for s in users if s.is_student]
     qty_teaching_assistants = len([u for u in users if u.is_teaching_assistant])
@@ -796,7 +726,7 @@ def list_users(data_format=None, want_detail=True):
             qty_students_enabled=len([s for s in students if s.is_active]),
             qty_students_github=len([s for s in students if s.github_username]),
             qty_students_logged_in=len([s for s in students if s.logged_in_at]),
-            qty_students_uploaded_json=len([s for s in students if len(s.latest_json)>1]),
+            qty_students_uploaded_json=len([s for s in students if s.pretty_json_length]),
             qty_students_logged_in_first=len([s for s in students if s.first_logged_in_at]),
             qty_students=len(students),
             qty_teaching_assistants=qty_teaching_assistants,
@@ -831,70 +761,22 @@ def bulk_register(data_format=None):
                     with open(csv_filename_with_path) as uploaded_file:
                       lines = uploaded_file.readlines()
                 except Exception as e:
-                    err_msgs.append(f"Error reading CSV file: {e}", "danger")
+                    err_msgs.append(f"Error reading CSV file: {e}")
         else:
             lines = form.userdata.data.splitlines()
-        if len(lines):
-            lines[0] = ",".join(User.tidy_fieldnames(lines[0].split(",")))
-        reader = csv.DictReader(lines, delimiter=',')
-        qty_users = 0
-        line_no = 0
-        problem_lines = []
-        clean_user_data = []
-        if len(lines) < 2:
-            err_msgs.append("Need CSV with a header row, then at least one line of data")
-        elif missing := User.get_missing_fieldnames(reader.fieldnames):
-            err_msgs.append(f"CSV header row is missing some required fields: {', '.join(missing)}")
-        else:
-            usernames = []
-            for row in reader:
-                line_no += 1
-                username = row['username'].strip().lower() if 'username' in row else None
-                if username is not None:
-                    usernames.append(username)
-                new_user = User(
-                    username=username,
-                    ext_id=row['ext_id'].strip() if 'ext_id' in row else None,
-                    ext_username=row['ext_username'].strip().lower() if 'ext_username' in row else None,
-                    email=_csv_tidy_string(row, 'email', want_lower=True),
-                    password=_csv_tidy_string(row, 'password', want_lower=False),
-                    first_name=_csv_tidy_string(row, 'first_name', want_lower=False),
-                    last_name=_csv_tidy_string(row, 'last_name', want_lower=False),
-                    created_at=datetime.now(timezone.utc),
-                    is_active=True,
-                    is_student=True,
-                    access_level=User.NO_STAFF_ROLE, # to convert to staff, must edit
-                    latest_json="",
-                    comment=_csv_tidy_string(row, 'comment', want_lower=False),
-                    is_api_secret_otp=current_app.config[ConfigSettingNames.IS_API_SECRET_ONE_TIME_PW.name],
-                )
-                #current_app.logger.info("{}, pw:{}".format(username, password))
-                if new_user.password and len(new_user.password) >= 4: # passwords longer than 4
-                    qty_users += 1
-                    clean_user_data.append(new_user.get_fields_as_dict_for_insert())
-                else:
-                    problem_lines.append(line_no)
-            if len(problem_lines) > 0:
-                pl = "s" if len(problem_lines)>1 else ""
-                line_nos = ", ".join(map(str,problem_lines))
-                err_msgs.append(f"Bulk registration aborted with {len(problem_lines)} problem{pl}: see line{pl}: {line_nos}")
-            else:
-              try:
-                result = db.session.execute(
-                    insert(User.__table__),
-                    clean_user_data
-                )
-                db.session.commit()
-              except Exception as e:
-                  # risky but frustratingly no easy way to get the specific database
-                  # error as it's coming back from the connection: e.g.,
-                  # (mysql.connector.errors.IntegrityError) 1062 (23000): Duplicate entry 'aaaa' for key 'username'
-                  ex_str = str(e).split("\n")[0] # mySQL sends the SQL back too after a newline: don't want
-                  # for JSON, users are being updated one user(name) at a time
-                  bad_username = f"\"{usernames[0]}\": " if len(usernames) == 1 else ""
-                  err_msgs.append(f"{bad_username}{ex_str}")
-              if not is_json:
-                   flash(f"Bulk registered {qty_users} users", "warning")
+        job = None
+        if not err_msgs:
+            users, csv_errors = read_users_from_csv(lines)
+            err_msgs.extend(csv_errors)
+        if not err_msgs:
+            job = enqueue_job(
+                Job.BULK_REGISTER_TYPE,
+                params={"users": users},
+                user=current_user,
+                qty_total=len(users),
+            )
+            if not is_json:
+                flash(f"Bulk registration of {len(users)} users has started", "warning")
         if delete_path:
             try:
                 os.unlink(delete_path)
@@ -908,11 +790,17 @@ def bulk_register(data_format=None):
                   'errors': err_msgs
                 }
             else:
-                payload = {"status": "OK"}
+                payload = {
+                    "status": "OK",
+                    "job": job.to_dict(),
+                    "job_url": url_for("admin.show_job", job_id=job.id, data_format="json"),
+                }
             return jsonify(payload)
         else:
             for err_msg in err_msgs:
                 flash(err_msg, "danger")
+            if job is not None:
+                return redirect(url_for("admin.show_job", job_id=job.id))
     else:
         if is_json:
           errors = []
@@ -938,6 +826,34 @@ def bulk_register(data_format=None):
         form=form,
     )
 
+@blueprint.route("/jobs", methods=["GET"], strict_slashes=False)
+@blueprint.route("/jobs/<data_format>", methods=["GET"])
+@login_required
+@admin_only
+def list_jobs(data_format=None):
+    """Recent background jobs (the JSON is polled while any are running)."""
+    jobs = Job.query.order_by(Job.id.desc()).limit(MAX_JOBS_LISTED).all()
+    if data_format == "json":
+        return jsonify([job.to_dict() for job in jobs])
+    return render_template(
+        "admin/jobs.html",
+        jobs=jobs,
+        is_any_job_unfinished=any(not job.is_finished for job in jobs),
+    )
+
+@blueprint.route("/jobs/<int:job_id>", methods=["GET"])
+@blueprint.route("/jobs/<int:job_id>/<data_format>", methods=["GET"])
+@login_required
+@admin_only
+def show_job(job_id, data_format=None):
+    """Progress of a background job (the JSON is polled while it runs)."""
+    job = db.session.get(Job, job_id)
+    if job is None:
+        abort(404)
+    if data_format == "json":
+        return jsonify(job.to_dict())
+    return render_template("admin/job.html", job=job)
+
 @blueprint.route("/user/<user_id>", methods=['GET'])
 @login_required
 @staff_only
@@ -1089,14 +1005,18 @@ def bulk_delete_users():
             "warning"
         )
         abort(403)
-    users = User.query.all()
     # note: can't use User.is_staff etc because those also require is_active
     #       and the bulk delete is more simplistic
-    qty_students = len([s for s in users if s.is_student and not (
-        s.access_level in [User.TEACHING_ASSISTANT, User.ADMINISTRATOR]
-    )])
-    qty_tas = len([s for s in users if s.access_level == User.TEACHING_ASSISTANT])
-    qty_non_admin = len([s for s in users if s.access_level < User.ADMINISTRATOR])
+    (qty_students, qty_tas, qty_non_admin) = db.session.execute(
+        select(
+            func.count(case((and_(
+                User.is_student == True,
+                User.access_level.not_in([User.TEACHING_ASSISTANT, User.ADMINISTRATOR])
+            ), 1))),
+            func.count(case((User.access_level == User.TEACHING_ASSISTANT, 1))),
+            func.count(case((User.access_level < User.ADMINISTRATOR, 1))),
+        )
+    ).one()
 
     form = BulkDeleteUsersForm(request.form)
     if request.method == "POST":
@@ -1447,6 +1367,47 @@ def list_buggies(want_students_only=True):
         want_students_only=want_students_only
     )
 
+@blueprint.route("/buggies/scrutineer/all", strict_slashes=False)
+@login_required
+@staff_only
+def scrutineer_buggies_all():
+    return scrutineer_buggies(want_students_only=False)
+
+@blueprint.route("/buggies/scrutineer", strict_slashes=False)
+@login_required
+@staff_only
+def scrutineer_buggies(want_students_only=True):
+    """Checks every buggy against the race rules (for the cost limit in the
+    query string, or the default race cost limit)."""
+    cost_limit = request.args.get("cost_limit", type=int)
+    if cost_limit is None or cost_limit < 0:
+        cost_limit = current_app.config[ConfigSettingNames.DEFAULT_RACE_COST_LIMIT.name]
+    specs = Buggy.get_all_buggy_specs(want_students_only=want_students_only)
+    results = evaluate_specs(specs, cost_limit=cost_limit)
+    buggies = [
+        {
+            "username": username,
+            "user_id": user_id,
+            "total_cost": total_cost,
+            "mass": mass,
+            "is_stale": (total_cost, mass) != (stored_cost, stored_mass),
+            "violations": get_violation_names(violations),
+        }
+        for (username, user_id, total_cost, mass, violations, stored_cost, stored_mass) in zip(
+            specs["username"], specs["user_id"],
+            results["total_cost"], results["mass"], results["violations"],
+            specs["total_cost"], specs["mass"],
+        )
+    ]
+    return render_template(
+        "admin/buggies_scrutineer.html",
+        buggies=buggies,
+        cost_limit=cost_limit,
+        qty_violators=sum(1 for buggy in buggies if buggy["violations"] or buggy["total_cost"] is None),
+        rules=BuggySpecs.RULES,
+        want_students_only=want_students_only,
+    )
+
 @blueprint.route("/settings/<group_name>", methods=['GET','POST'])
 @blueprint.route("/settings", methods=['GET','POST'], strict_slashes=False)
 @login_required
@@ -1454,15 +1415,14 @@ def list_buggies(want_students_only=True):
 def settings(group_name=None):
     """Admin settings check page."""
     form = SettingForm(request.form)
-    settings_as_dict = Setting.get_dict_from_db(Setting.query.all())
+    settings_as_dict = get_settings_as_dict(current_app)
     was_storing_task_list_in_db = settings_as_dict[ConfigSettingNames.IS_STORING_TASK_LIST_IN_DB.name]
     link_settings = LinkedSiteSettings.get_linked_sites_from_config(settings_as_dict, want_all=True)
     if request.method == "POST":
         # group_name = form['group'].data
         if form.is_submitted() and form.validate():
             _update_settings_in_db(form)
-            # inefficient, but update to reflect changes
-            settings_as_dict = Setting.get_dict_from_db(Setting.query.all())
+            settings_as_dict = get_settings_as_dict(current_app)
             link_settings = LinkedSiteSettings.get_linked_sites_from_config(settings_as_dict, want_all=True)
             if (
                 (settings_as_dict[ConfigSettingNames.IS_STORING_TASK_LIST_IN_DB.name]
@@ -1613,6 +1573,7 @@ def edit_announcement(announcement_id=None):
                 announcement.type = form.type.data
                 announcement.is_visible = form.is_visible.data
                 announcement.is_html = form.is_html.data
+                CacheVersion.bump(CacheVersion.ANNOUNCEMENTS, commit=False)
                 announcement.save()
                 flash("OK, updated announcement", "success")
                 refresh_global_announcements(current_app)
@@ -1658,6 +1619,7 @@ def publish_announcement(announcement_id):
             flash("Error: coudldn't find announcement", "danger")
         else:
             announcement.is_visible = want_to_display
+            CacheVersion.bump(CacheVersion.ANNOUNCEMENTS, commit=False)
             announcement.save()
             if want_to_display:
                 flash("OK, unhid an announcement and displayed it", "success")
@@ -1683,6 +1645,7 @@ def delete_announcement(announcement_id=None):
         if announcement is None:
             flash("Error: coudldn't find announcement to delete", "danger")
         else:
+            CacheVersion.bump(CacheVersion.ANNOUNCEMENTS, commit=False)
             announcement.delete()
             flash("OK, deleted announcement", "success")
             refresh_global_announcements(current_app)
@@ -1727,20 +1690,12 @@ def tech_notes_publish():
 @login_required
 @admin_only
 def tech_notes_admin():
-  error_msg = None
   form = GeneralSubmitForm(request.form) # no auth required
   if request.method == "POST":
       if form.is_submitted() and form.validate():
-          try:
-              output_msg = publish_tech_notes(current_app)
-          except Exception as e:
-              error_msg = f"Error: {e}"
-              flash(error_msg, "danger")
-          else:
-              flash(output_msg, "info")
-              flash("Re-generated tech notes (static web pages) OK", "success")
-              if _is_from_dashboard():
-                  return redirect(url_for('admin.admin'))
+          job = enqueue_job(Job.PUBLISH_TECH_NOTES_TYPE, user=current_user)
+          flash("Re-generating tech notes (static web pages) in the background", "info")
+          return redirect(url_for("admin.show_job", job_id=job.id))
       else:
           flash_errors(form)
   return render_template(
@@ -1774,27 +1729,9 @@ def tasks_generate():
     form = GeneralSubmitForm(request.form) # no auth required
     if form.is_submitted() and form.validate():
         # render the template and save it as _task_list.html
-        try:
-            hints_msg = publish_task_list(current_app)
-            publish_tasks_as_issues_csv(current_app)
-        except IOError as e:
-            flash(f"Failed to create task list: problem with file: {e}", "danger")
-        else:
-            if hints_msg:
-                flash(hints_msg, "info")
-            qty_tasks = Task.query.filter_by(is_enabled=True).count()
-            if qty_tasks == 0:
-                flash("Task list page has been generated but there are no unhidden tasks in the project yet!", "danger")
-                flash("You should load some tasks into the database before the project can start", "warning")
-            else:
-                flash(f"OK, task list page has been generated with latest data ({qty_tasks} tasks)", "success")
-                if current_app.config[ConfigSettingNames.IS_STORING_TASK_LIST_IN_DB.name]:
-                    flash(
-                        "The task list page is being stored in the database "
-                        "(and not written to file as static content)", "info"
-                    )
-            if _is_from_dashboard():
-                return redirect(url_for('admin.admin'))
+        job = enqueue_job(Job.PUBLISH_TASK_LIST_TYPE, user=current_user)
+        flash("Generating the task list page in the background", "info")
+        return redirect(url_for("admin.show_job", job_id=job.id))
     return redirect(url_for('admin.tasks_admin'))
 
 @blueprint.route("/tasks/all", methods=["GET"], strict_slashes=False)
@@ -1817,7 +1754,7 @@ def tasks_load():
                 )
                 delete_path = None
                 pretty_source = "default tasks"
-                is_success = False
+                job = None
                 if "markdown_file" in request.files and request.files['markdown_file']:
                     md_file = request.files['markdown_file']
                     if md_file.filename:
@@ -1841,31 +1778,29 @@ def tasks_load():
                     pretty_source += f" (with distribution method: \"{distrib_method}\")"
                     delete_path = md_filename_with_path
                 try:
-                    qty_tasks_added = load_tasks_into_db(
-                        join_to_project_root(md_filename_with_path),
-                        app=current_app,
-                        want_overwrite=want_overwrite,
-                    )
-                    flash(
-                        f"OK, put {qty_tasks_added} {pretty_source} into the database",
-                        "success"
-                    )
-                    flash(
-                        "Remember to publish the task list now! "
-                        "...unless you're going to edit any tasks first",
-                        "info"
+                    with open(join_to_project_root(md_filename_with_path), encoding="utf-8") as md_file:
+                        markdown = md_file.read()
+                except (IOError, UnicodeDecodeError) as e:
+                    flash(f"Error reading tasks: {e}", "danger")
+                else:
+                    job = enqueue_job(
+                        Job.LOAD_TASKS_TYPE,
+                        params={
+                            "markdown": markdown,
+                            "pretty_source": pretty_source,
+                            "want_overwrite": want_overwrite,
+                        },
+                        user=current_user,
                     )
-                    is_success = True
-                except Exception as e:
-                    flash(f"Error parsing/adding tasks: {e}", "danger")
+                    flash(f"Loading {pretty_source} into the database in the background", "info")
                 if delete_path:
                     try:
                         os.unlink(delete_path)
                     except os.error as e:
                         # could sanitise this, but the diagnostic might be useful
                         flash(f"Problem deleting uploaded file: {e}", "warning")
-                if is_success:
-                    return redirect(url_for('admin.tasks_admin'))
+                if job is not None:
+                    return redirect(url_for("admin.show_job", job_id=job.id))
             else:
                 flash(f"Did not not load tasks because you did not explicity confirm it", "danger")
         else:
@@ -1979,7 +1914,7 @@ def download_tasks(type=None, format=None):
     elif type == CURRENT:
         if format == FORMAT_CSV:
             want_reversed = current_app.config[ConfigSettingNames.IS_ISSUES_CSV_IN_REVERSE_ORDER.name]
-            tasks = Task.query.filter_by(is_enabled=True).order_by(
+            tasks = Task.query_with_texts().filter_by(is_enabled=True).order_by(
                 Task.phase.desc() if want_reversed else Task.phase.asc(),
                 Task.sort_position.desc() if want_reversed else Task.sort_position.asc(),
             ).all()
@@ -1989,7 +1924,7 @@ def download_tasks(type=None, format=None):
                 is_line_terminator_crlf=current_app.config[ConfigSettingNames.IS_ISSUES_CSV_CRLF_TERMINATED.name]
             )
         else:
-            tasks = Task.query.filter_by(is_enabled=True).order_by(
+            tasks = Task.query_with_texts().filter_by(is_enabled=True).order_by(
                 Task.phase.asc(),
                 Task.sort_position.asc()
             ).all()
@@ -2057,7 +1992,7 @@ def edit_task(task_id=None):
 
 @blueprint.route("/tasks/check-tech-notes", methods=["GET"])
 def check_tasks_for_tech_notes():
-    tasks = Task.query.filter_by(is_enabled=True).order_by(
+    tasks = Task.query_with_texts().filter_by(is_enabled=True).order_by(
         Task.phase.asc(),
         Task.sort_position.asc()
     ).all()
@@ -2157,10 +2092,10 @@ def task_texts():
     if not tasks:
         flash("Cannot display texts because there are no tasks — maybe you need to load them into the database?", "warning")
         return redirect(url_for("admin.admin"))
-    students = User.query.filter_by(is_active=True, is_student=True).order_by(User.username.asc()).all()
+    students = User.query_summaries().filter_by(is_active=True, is_student=True).order_by(User.username.asc()).all()
     usernames_by_id = {student.id: student.username for student in students}
     texts_by_username = {student.username: {} for student in students}
-    for text in TaskText.query.all():
+    for text in TaskText.query_with_lengths().all():
         if text.user_id in usernames_by_id: # TODO in lieu of a JOIN on active students
             texts_by_username[usernames_by_id[text.user_id]][text.task_id] = text
     buggies_by_username = {student.username: {} for student in students}
@@ -2342,49 +2277,22 @@ def publish_editor_zip():
     if request.method == "POST":
         readme_contents = form.readme_contents.data
         is_writing_server_url_in_editor = form.is_writing_server_url_in_editor.data
-        # save setting as config (so autogeneration can reproduce it)
-        # this is also about to be used by the create_editor_zipfile()
-        set_and_save_config_setting(
-            current_app,
-            name=ConfigSettingNames.IS_WRITING_SERVER_URL_IN_EDITOR.name,
-            value=1 if is_writing_server_url_in_editor else 0
-        )
-        current_app.config[ConfigSettingNames.IS_WRITING_SERVER_URL_IN_EDITOR.name] = is_writing_server_url_in_editor
-
         is_writing_host_in_editor = form.is_writing_host_in_editor.data
-        set_and_save_config_setting(
-            current_app,
-            name=ConfigSettingNames.IS_WRITING_HOST_IN_EDITOR.name,
-            value=1 if is_writing_host_in_editor else 0
-        )
-        current_app.config[ConfigSettingNames.IS_WRITING_HOST_IN_EDITOR.name] = is_writing_host_in_editor
-
         is_writing_port_in_editor = form.is_writing_port_in_editor.data
-        set_and_save_config_setting(
-            current_app,
-            name=ConfigSettingNames.IS_WRITING_PORT_IN_EDITOR.name,
-            value=1 if is_writing_port_in_editor else 0
-        )
-        current_app.config[ConfigSettingNames.IS_WRITING_PORT_IN_EDITOR.name] = is_writing_port_in_editor
-
-        try:
-            create_editor_zipfile(readme_contents, app=current_app)
-        except (FileNotFoundError, IOError) as e:
-            flash("Failed to save zip file: {e}", "danger")
-            return redirect(url_for("admin.show_buggy_editor_info"))
-
-        # save this README in database so auto-generation can reproduce it
-        readme_db_file = DbFile.query.filter_by(
-            type=DbFile.README_TYPE
-        ).first() # don't care about item_id: there is only ever one
-        if readme_db_file is None:
-            readme_db_file = DbFile.create(type=DbFile.README_TYPE)
-        readme_db_file.contents = readme_contents
-        readme_db_file.save()
-        set_and_save_config_setting(
-            current_app,
-            name=ConfigSettingNames._EDITOR_ZIP_GENERATED_DATETIME.name,
-            value=datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M")
+        # save settings as config (so autogeneration can reproduce it)
+        # this is also about to be used by the create_editor_zipfile()
+        save_config_settings(current_app, {
+            ConfigSettingNames.IS_WRITING_SERVER_URL_IN_EDITOR.name: is_writing_server_url_in_editor,
+            ConfigSettingNames.IS_WRITING_HOST_IN_EDITOR.name: is_writing_host_in_editor,
+            ConfigSettingNames.IS_WRITING_PORT_IN_EDITOR.name: is_writing_port_in_editor,
+        })
+
+        # the job also saves this README in database so auto-generation can
+        # reproduce it
+        job = enqueue_job(
+            Job.EDITOR_ZIP_TYPE,
+            params={"readme_contents": readme_contents},
+            user=current_user,
         )
 
         if is_writing_server_url_in_editor:
@@ -2409,9 +2317,9 @@ def publish_editor_zip():
             f"Wrote {qty_lines_in_readme} lines into {readme_filename}",
             "info"
         )
-        flash("OK, editor files now zipped up and published", "success")
+        flash("Zipping up and publishing the editor files in the background", "success")
         flash("You should download the zip file, unzip it and check its contents before you distribute it to students!", "info")
-        return redirect(url_for("admin.show_buggy_editor_info"))
+        return redirect(url_for("admin.show_job", job_id=job.id))
     else:
         readme_contents = render_template(
             "admin/_buggy_editor_readme.txt",
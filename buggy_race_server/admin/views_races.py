@@ -26,9 +26,12 @@ from buggy_race_server.admin.forms import (
     SubmitWithConfirmForm,
 )
 
+from buggy_race_server.admin.models import CacheVersion
 from buggy_race_server.config import ConfigSettingNames
 from buggy_race_server.database import db
-from buggy_race_server.race.models import Race, Racetrack, RaceResult
+from buggy_race_server.lib.race_events import is_gzip_data, load_results, load_results_stream
+from buggy_race_server.lib.race_specs import BuggySpecs
+from buggy_race_server.race.models import Race, Racetrack, RaceResult, delete_unused_blobs
 from buggy_race_server.race.forms import (
     RaceDeleteForm,
     RaceForm,
@@ -114,11 +117,13 @@ def serve_temporary_race_file_json():
     temp_filename = temp_race_file_info.get("filename_with_path")
     if not (temp_filename or temp_race_file_info.get("is_available")):
         abort(404)
-    with open(temp_filename, "r") as temp_race_file:
+    with open(temp_filename, "rb") as temp_race_file:
         json_data = temp_race_file.read()
     output = make_response(json_data, 200)
     # no Content-Disposition of attachment, because this is served for previews
     output.headers["Content-type"] = "application/json"
+    if is_gzip_data(json_data): # browser unzips it
+        output.headers["Content-Encoding"] = "gzip"
     output.headers["Content-length"] = len(json_data)
     return output
 
@@ -150,6 +155,10 @@ def view_race(race_id):
     server_protocol = get_url_protocol(
                 current_app.config[ConfigSettingNames.BUGGY_RACE_SERVER_URL.name]
     )
+    # before the race has been run, show who'd be excluded if it ran now
+    scrutineering = None
+    if not (all_results or race.is_abandoned):
+        scrutineering = race.get_scrutineering()
     return render_template(
         "admin/race.html",
         flag_color_css_defs=flag_color_css_defs,
@@ -162,6 +171,8 @@ def view_race(race_id):
         results_finishers=results_finishers,
         results_nonfinishers=results_nonfinishers,
         results=all_results,
+        rules=BuggySpecs.RULES,
+        scrutineering=scrutineering,
         server_protocol=server_protocol,
         track_image_url=race.track_image_url, # separated for image file
         track_svg_url=race.track_svg_url, # separated for SVG include file
@@ -248,6 +259,7 @@ def edit_race(race_id=None):
                 race.save()
                 pretty_title =  f"\"{race.title}\"" if race.title else "untitled race"
                 success_msg = f"OK, updated {pretty_title}" 
+            CacheVersion.bump(CacheVersion.RACES)
             flash(success_msg, "success")
             return redirect(url_for("admin_race.list_races"))
         else:
@@ -302,6 +314,7 @@ def abandon_race(race_id):
                 race.buggies_finished = 0
                 race.save()
                 db.session.execute(delete(RaceResult).where(RaceResult.race_id==race.id))
+                CacheVersion.bump(CacheVersion.RACES, commit=False)
                 db.session.commit()
                 flash("OK, race abandoned", "info")
                 return redirect(url_for('admin_race.view_race', race_id=race.id))
@@ -341,9 +354,11 @@ def upload_race_file(race_id):
                         f"results-{str(race_id).zfill(4)}.json"
                     )
                     json_file.save(json_filename_with_path)
+                    result_data = None
                     try:
-                        with open(json_filename_with_path, "r") as read_file:
-                            result_data = json.load(read_file)
+                        # events (the bulk of the file) are kept unparsed
+                        with open(json_filename_with_path, "rb") as read_file:
+                            result_data = load_results_stream(read_file)
                     except UnicodeDecodeError as e:
                         flash(
                             "Encoding error (maybe that wasn't a JSON file you uploaded, "
@@ -354,6 +369,9 @@ def upload_race_file(race_id):
                         flash("Failed to parse JSON data", "danger")
                         flash(str(e), "warning")
                         flash("No data was accepted", "info")
+                    except ValueError as e: # e.g., bad gzip
+                        flash(f"Failed to read race file: {e}", "danger")
+                        flash("No data was accepted", "info")
                     if result_data:
                         try:
                             warnings = race.load_race_results(
@@ -378,6 +396,8 @@ def upload_race_file(race_id):
                                     )
                                 race.results_uploaded_at = datetime.now(timezone.utc) 
                                 race.save()
+                                # load_race_results bumped it, but the race has changed since
+                                CacheVersion.bump(CacheVersion.RACES)
                                 flash("OK, updated race results", "success")
                                 if not (race.is_visible and race.is_result_visible):
                                     flash(
@@ -439,7 +459,10 @@ def delete_race(race_id):
         if race is None:
             flash("Error: coudldn't find race to delete", "danger")
         else:
+            blob_hashes = race.get_blob_hashes()
             race.delete()
+            delete_unused_blobs(blob_hashes)
+            CacheVersion.bump(CacheVersion.RACES)
             flash("OK, deleted race", "success")
     else:
         flash("Error: incorrect button wiring, nothing deleted", "danger")
@@ -577,7 +600,9 @@ def delete_track(track_id):
             if not form.is_confirmed.data:
                 flash("Did not delete track (you didn't confirm it)", "danger")
                 return redirect(url_for('admin_race.edit_track', track_id=track_id))
+            image_hash = track.track_image_hash
             track.delete()
+            delete_unused_blobs([image_hash])
             flash("OK, deleted racetrack", "success")
         else:
             flash("Error: incorrect button wiring, nothing deleted", "danger")
@@ -656,7 +681,8 @@ def edit_track(track_id):
                 custom_img_url = make_race_server_url(
                     url_for("race.serve_racetrack_custom_image", track_id=track.id)
                 )
-                track.track_image = new_track_image_bytes
+                replaced_image_hash = track.track_image_hash
+                track.set_track_image(new_track_image_bytes)
                 if new_track_image_bytes is None: # actually deleting it
                     track.image_media_type = None
                     if track.track_image_url and track.track_image_url == custom_img_url:
@@ -684,6 +710,8 @@ def edit_track(track_id):
             track.svg_path_length = form.svg_path_length.data
             track.start_offset = form.start_offset.data
             track.save()
+            if is_uploading_new_image:
+                delete_unused_blobs([replaced_image_hash])
             pretty_title = f"\"{track.title}\"" if track.title else "untitled track"
             if is_new_racetrack:
                 success_msg = f"OK, created {pretty_title}"
@@ -729,8 +757,8 @@ def race_preview_tool():
                     json_file.filename = tmp_file_name
                     json_file.save(tmp_file_name)
                     try:
-                        with open(tmp_file_name, "r") as read_file:
-                            result_data = json.load(read_file)
+                        with open(tmp_file_name, "rb") as read_file:
+                            result_data = load_results(read_file.read())
                         # if there are different URLs there may be CORS errors
                         # in the player, so check for any URLs that don't
                         # match this server url and report with a danger flash?
@@ -746,6 +774,10 @@ def race_preview_tool():
                         flash(str(e), "warning")
                         flash("No temporary race file available", "info")
                         want_delete = True
+                    except ValueError as e: # e.g., bad gzip
+                        flash(f"Failed to read race file: {e}", "danger")
+                        flash("No temporary race file available", "info")
+                        want_delete = True
                     if result_data is not None:
                         if track_image_url := result_data.get("track_image_url"):
                             if server_url := get_alien_server_url(track_image_url):
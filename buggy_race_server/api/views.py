@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 """API views."""
 
+import hmac
 import json
 from datetime import datetime, timezone, timedelta
 
 from flask import Blueprint, Response, request, current_app, render_template, after_this_request
+from sqlalchemy import update
 
 from buggy_race_server.buggy.forms import BuggyJsonForm
-from buggy_race_server.buggy.views import handle_uploaded_json
+from buggy_race_server.buggy.views import handle_uploaded_json, save_uploaded_buggies
 from buggy_race_server.user.models import User
 from buggy_race_server.config import ConfigSettingNames
+from buggy_race_server.database import db
 from buggy_race_server.admin.views import get_admin_dashboard_data_response
 
 blueprint = Blueprint("api", __name__, url_prefix="/api", static_folder="../static")
@@ -20,6 +23,9 @@ API_KEY_USER = "user"
 API_KEY_KEY = "key" # API key for the API key, heh
 API_KEY_SECRET = "secret"
 API_KEY_JSON = "buggy_json"
+API_KEY_BUGGIES = "buggies" # batch upload: JSON array or NDJSON
+
+MAX_BATCH_UPLOADS = 1000 # buggies per batch upload
 
 def get_json_error_response(msg, status=401):
   response = Response(
@@ -38,8 +44,16 @@ def describe_api():
     buggy_race_server_url=current_app.config[ConfigSettingNames.BUGGY_RACE_SERVER_URL.name],
   )
 
+def _is_same_secret(given, expected):
+    """ compares in constant time (so the time taken doesn't give away how
+    much of the secret was right)"""
+    return hmac.compare_digest(given.encode("utf-8"), expected.encode("utf-8"))
+
 def get_user_or_response_from_api_post(request):
-    """ returns either"""
+    """ returns either the user (with only the columns authentication needs
+    loaded: see User.query_api_auth) or an error response. If the user's
+    secret is a one-time password, it's used up in the session's current
+    transaction: the caller must commit it (with whatever else it does)."""
     username = ""
     api_key = ""
     secret = ""
@@ -55,16 +69,16 @@ def get_user_or_response_from_api_post(request):
         secret = request.form[API_KEY_SECRET].strip()
     if not secret:
         return get_json_error_response("missing secret")
-    user = User.query.filter_by(username=username).first()
+    user = User.query_api_auth().filter_by(username=username).first()
     if user is None:
         return get_json_error_response("not authorised (bad user)")
-    if user.api_key != api_key:
+    if user.api_key is None or not _is_same_secret(api_key, user.api_key):
         return get_json_error_response("not authorised (wrong API key for this user)")
     if user.api_secret is None:
         return get_json_error_response("not authorised (missing secret)")
     if user.api_secret_at is None:
         return get_json_error_response("not authorised (missing secret timestamp)")
-    if user.api_secret != secret:
+    if not _is_same_secret(secret, user.api_secret):
         return get_json_error_response(f"not authorised (bad secret)")
     now_utc = datetime.now(timezone.utc)
     api_secret_at_utc = user.api_secret_at.replace(tzinfo=timezone.utc)
@@ -77,8 +91,17 @@ def get_user_or_response_from_api_post(request):
     if user.is_api_secret_otp:
         if user.api_secret_count > 0:
             return get_json_error_response("one-time secret has already been used")
-        user.api_secret_count += 1
-        user.save()
+        # a single UPDATE, which only succeeds if the secret is still unused:
+        # so if the same secret arrives twice at once, only one gets through
+        result = db.session.execute(
+            update(User).where(
+                User.id==user.id, User.api_secret_count==0
+            ).values(
+                api_secret_count=User.api_secret_count + 1
+            ).execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return get_json_error_response("one-time secret has already been used")
     return user
 
 @blueprint.route("/upload", methods=["POST", "OPTIONS"], strict_slashes=True)
@@ -105,11 +128,14 @@ def create_buggy_with_json_via_api():
   if not isinstance(user_or_response, User): # unexpected: should be Resonse or User
       return get_json_error_response("bad request") # didn't get a user
   user = user_or_response
+  buggy_json = ""
   if API_KEY_JSON in request.form:
       buggy_json = request.form[API_KEY_JSON].strip()
   if not buggy_json:
+      db.session.commit() # a one-time secret has still been used
       return get_json_error_response(f"no JSON ({API_KEY_JSON}) provided", status=200)
-  # now send 200 even when response is an error (e.g., JSON parse fail)
+  # now send 200 even when response is an error (e.g., JSON parse fail):
+  # the upload is saved in one transaction, with the secret being used
   response = Response(
     json.dumps(handle_uploaded_json(BuggyJsonForm(request.form), user, True)),
     status=200,
@@ -137,11 +163,62 @@ def dashboard_data_via_api():
         if isinstance(user_or_response, Response):
             return user_or_response
         user = user_or_response
-        if not user.is_administrator:
+        is_administrator = user.is_administrator
+        db.session.commit() # a one-time secret has been used
+        if not is_administrator:
             return get_json_error_response("not authorised (user not an administrator)")
         return get_admin_dashboard_data_response(want_json=True)
     return Response(
         json.dumps(payload) if payload else None, # None results in empty body
         status=status,
         mimetype="application/json"
-    )
\ No newline at end of file
+    )
+
+def _get_batch_uploads(buggies_text):
+    """ returns the (username, buggy_json) pairs from a batch upload, which
+    is either a JSON array or NDJSON (one JSON object per line): each object
+    has a username and buggy_json (a string, or the buggy's JSON object)"""
+    buggies_text = buggies_text.strip()
+    if buggies_text.startswith("["):
+        items = json.loads(buggies_text)
+    else:
+        items = [json.loads(line) for line in buggies_text.splitlines() if line.strip()]
+    uploads = []
+    for item in items:
+        if not isinstance(item, dict) or "username" not in item or API_KEY_JSON not in item:
+            raise ValueError(f"each buggy needs a username and {API_KEY_JSON}")
+        uploads.append((str(item["username"]).strip(), item[API_KEY_JSON]))
+    return uploads
+
+@blueprint.route("/admin/buggies", methods=["POST"], strict_slashes=True)
+def upload_buggies_via_api():
+    """ API call for staff (and test harnesses) to upload many users' buggies
+    in one go: as well as the user, key and secret (of an administrator),
+    the buggies field is a batch of buggies (see _get_batch_uploads). The
+    response has a result for each buggy, in the same order."""
+    if not current_app.config[ConfigSettingNames.IS_ADMIN_API_ENABLED.name]:
+        return Response(status=404)
+    user_or_response = get_user_or_response_from_api_post(request)
+    if isinstance(user_or_response, Response):
+        return user_or_response
+    is_administrator = user_or_response.is_administrator
+    db.session.commit() # a one-time secret has been used
+    if not is_administrator:
+        return get_json_error_response("not authorised (user not an administrator)")
+    try:
+        uploads = _get_batch_uploads(request.form.get(API_KEY_BUGGIES, ""))
+    except ValueError as e: # includes JSONDecodeError
+        return get_json_error_response(f"bad {API_KEY_BUGGIES}: {e}", status=400)
+    if len(uploads) > MAX_BATCH_UPLOADS:
+        return get_json_error_response(
+            f"too many buggies (max {MAX_BATCH_UPLOADS} per batch)", status=400
+        )
+    results = save_uploaded_buggies(
+        uploads,
+        current_app.config[ConfigSettingNames.DEFAULT_FLAG_COLOR.name]
+    )
+    return Response(
+        json.dumps({"results": results}),
+        status=200,
+        mimetype="application/json"
+    )
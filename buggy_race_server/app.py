@@ -14,8 +14,10 @@ from flask import Flask, make_response, render_template, request, redirect, url_
 from flask_login import current_user
 
 from buggy_race_server import admin, api, buggy, commands, config, oauth, public, race, user
+from buggy_race_server.admin.jobs import start_job_workers
 from buggy_race_server.utils import (
     create_editor_zipfile,
+    refresh_announcements_if_stale,
     refresh_global_announcements,
     publish_tasks_as_issues_csv,
     publish_task_list,
@@ -23,14 +25,16 @@ from buggy_race_server.utils import (
     purge_task_list,
     save_config_env_overrides_to_db,
     load_settings_from_db,
+    refresh_settings_if_stale,
     servertime_str,
     join_to_project_root,
     has_settings_table,
 )
-from buggy_race_server.admin.models import Announcement
+from buggy_race_server.admin.models import Announcement, CacheVersion
 from buggy_race_server.config import ConfigSettings, ConfigSettingNames, DistribMethods
 from buggy_race_server.extensions import (
     bcrypt,
+    blob_store,
     cache,
     csrf,
     db,
@@ -187,6 +191,28 @@ def create_app():
                     create_editor_zipfile(None, app=app)
                     print(f"* published buggy editor zipfile", flush=True)
 
+    @app.before_request
+    def refresh_stale_settings():
+        """ Another worker may have changed the settings or announcements
+            since this one loaded them (see refresh_settings_if_stale): both
+            versions are fetched in one query"""
+        if not request.path.startswith(app.static_url_path):
+            if app.config.get(ConfigSettings.SETTINGS_VERSION_KEY) is None:
+                return # nothing loaded from the database (e.g., no table yet)
+            versions = CacheVersion.get_versions(
+                CacheVersion.SETTINGS, CacheVersion.ANNOUNCEMENTS
+            )
+            refresh_settings_if_stale(app, versions[CacheVersion.SETTINGS])
+            refresh_announcements_if_stale(app, versions[CacheVersion.ANNOUNCEMENTS])
+
+    @app.before_request
+    def start_job_workers_once():
+        """ Each process runs its own job workers: they're started here (not
+            when the app is created) so they're in the process that serves the
+            requests (e.g., gunicorn's worker), and not in CLI commands"""
+        if app.config.get(ConfigSettings.SETTINGS_VERSION_KEY) is not None:
+            start_job_workers(app)
+
     @app.before_request
     def force_setup_on_new_installs():
         """ Prevent access to any pages other than setup or login.
@@ -252,16 +278,27 @@ def create_app():
     return app
 
 
+# cache types that aren't shared between processes (see CACHE_TYPE)
+PER_PROCESS_CACHE_TYPES = ("null", "NullCache", "simple", "SimpleCache")
+
 def register_extensions(app):
     """Register Flask extensions."""
     bcrypt.init_app(app)
     cache.init_app(app)
+    if app.config.get("GUNICORN_WORKERS", 1) > 1 and app.config.get("CACHE_TYPE") in PER_PROCESS_CACHE_TYPES:
+        print(
+            f"[!] WARNING: CACHE_TYPE is {app.config['CACHE_TYPE']}, so each of the "
+            f"{app.config['GUNICORN_WORKERS']} workers has its own cache (e.g., each "
+            "asks GitHub about course repos): use a shared one, like redis",
+            file=sys.stderr
+        )
     db.init_app(app)
     csrf.init_app(app)
     login_manager.init_app(app)
     debug_toolbar.init_app(app)
     migrate.init_app(app, db)
     flask_static_digest.init_app(app)
+    blob_store.init_app(app)
     return None
 
 
@@ -7,31 +7,29 @@ from sqlalchemy import event, sql
 from buggy_race_server.database import Column, Model, SurrogatePK, db
 from buggy_race_server.user.models import User
 from buggy_race_server.lib.race_specs import BuggySpecs
+from buggy_race_server.lib.race_specs_bulk import SPEC_COLUMNS
 from buggy_race_server.utils import stringify_datetime
 
 class Buggy(SurrogatePK, Model, BuggySpecs):
     """A buggy ready to race."""
 
-    # set column ("varchar") max lengths here: this is useful because
-    # it's actually quite fiddly to get this info back out of the model
-    # when we want to truncate user's input
-    STRING_COL_LENGTH = {
-        "algo": 16,
-        "armour": 16,
-        "attack": 16,
-        "aux_power_type": 16,
-        "flag_color_secondary": 32,
-        "flag_color": 32,
-        "flag_pattern": 8,
-        "power_type": 16,
-        "tyres": 16,
-    }
+    # column ("varchar") max lengths are in the specs (so uploads can be
+    # truncated to fit without the model: see lib/buggy_validator.py)
+    STRING_COL_LENGTH = BuggySpecs.STRING_COL_LENGTH
 
     __tablename__ = "buggies"
     id = db.Column(db.Integer, primary_key=True)
     created_at = Column(
         db.DateTime(timezone=True), nullable=False, default=sql.func.now()
     )
+    # set whenever the buggy is saved (in Python, not with the database's
+    # now(), which can be to the second): race scrutineering is cached on it
+    modified_at = Column(
+        db.DateTime(timezone=True),
+        nullable=True,
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+        onupdate=lambda: datetime.datetime.now(datetime.timezone.utc),
+    )
     buggy_id = Column(db.Integer(), default=1) # TODO risky default?
     qty_wheels = Column(
         db.Integer(),
@@ -112,7 +110,9 @@ class Buggy(SurrogatePK, Model, BuggySpecs):
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id'),
-        nullable=False
+        nullable=False,
+        index=True,
+        unique=True # one buggy per user
     )
     total_cost = db.Column(db.Integer(), default=0)
     mass = db.Column(db.Integer(), default=0)
@@ -179,6 +179,25 @@ class Buggy(SurrogatePK, Model, BuggySpecs):
             query = query.filter(User.is_student==True)
         return query.all()
 
+    @staticmethod
+    def get_all_buggy_specs(want_students_only=True):
+        """ Like get_all_buggies_with_users, but returns the usernames and the
+        buggies' settings (with their stored total_cost and mass) as columns,
+        ready for lib/race_specs_bulk.py: doesn't load any objects"""
+        col_names = ("username", "user_id", *SPEC_COLUMNS, "total_cost", "mass")
+        query = db.select(
+            User.username, *(getattr(Buggy, name) for name in col_names[1:])
+        ).join(User, Buggy.user_id==User.id).filter(
+            User.is_active==True
+        ).order_by(User.username.asc())
+        if want_students_only:
+            query = query.filter(User.is_student==True)
+        columns = {name: [] for name in col_names}
+        for row in db.session.execute(query):
+            for (name, value) in zip(col_names, row):
+                columns[name].append(value)
+        return columns
+
 @event.listens_for(Buggy, 'before_update')
 def receive_before_update(mapper, connection, target):
     target.calculate_totals()
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 """Buggy views."""
 import json
-import string
 from datetime import datetime, timezone
 
 from flask import (
@@ -15,25 +14,39 @@ from flask import (
   url_for,
 )
 from flask_login import current_user, login_required
+from sqlalchemy import insert, select, update
 
 from buggy_race_server.config import ConfigSettingNames
 from buggy_race_server.admin.forms import SubmitWithConfirmForm
 from buggy_race_server.buggy.forms import BuggyJsonForm
 from buggy_race_server.buggy.models import Buggy
+from buggy_race_server.database import db
+from buggy_race_server.lib.buggy_validator import NOTHING_TO_CHANGE_MSG, buggy_validator
+from buggy_race_server.lib.race_specs import BuggySpecs
+from buggy_race_server.race.models import Race
 from buggy_race_server.user.models import User
 from buggy_race_server.utils import flash_errors, active_user_required, get_flag_color_css_defs
 
 
 blueprint = Blueprint("buggy", __name__, url_prefix="/buggy", static_folder="../static")
 
+MAX_UPCOMING_RACES_SCRUTINEERED = 3 # on the buggy page
+
 # if is_api responds differently
 def handle_uploaded_json(form, user, is_api=False):
+  # everything the upload changes (the user's JSON and their buggy, and
+  # maybe their one-time API secret) is committed in one transaction
+  response = _handle_uploaded_json(form, user, is_api=is_api)
+  db.session.commit()
+  return response
+
+def _handle_uploaded_json(form, user, is_api=False):
   # is_api validation doesn't work:
   # so we're checking buggy_json field explicitly before getting here
   if (form.is_submitted() and form.validate()) or is_api:
     user.latest_json = form.buggy_json.data
     user.uploaded_at = datetime.now(timezone.utc)
-    user.save()
+    user.save(commit=False)
     try:
       dirty_buggy_data = json.loads(form.buggy_json.data)
     except json.decoder.JSONDecodeError as e:
@@ -44,112 +57,27 @@ def handle_uploaded_json(form, user, is_api=False):
         flash(str(e), "warning")
         flash("No data was accepted", "info")
         return redirect(url_for("user.submit_buggy_data"))
-    clean_buggy_data = {}
-    word_too = ""
-    is_multi_buggy_suspected = type(dirty_buggy_data) == list
-    for key in dirty_buggy_data:
-      key_type = type(key)
-      if key_type != str:
-          flash(f"Make sure your buggy JSON only contains keys which are strings: ignoring {key_type}", "warning")
-          is_multi_buggy_suspected = is_multi_buggy_suspected or key_type in (dict, list)
-      elif key == 'id': # user's buggy's id becomes buggy_id here
-          try:
-            clean_buggy_data['buggy_id'] = int(dirty_buggy_data[key])
-          except ValueError:
-            if not is_api:
-              flash("Value for id was ignored because it wasn't an integer", "warning")
-      elif key in Buggy.DEFAULTS:
-        if Buggy.DEFAULTS[key] == False and isinstance(Buggy.DEFAULTS[key], bool):
-            if isinstance(dirty_buggy_data[key], bool):
-              clean_buggy_data[key] = int(dirty_buggy_data[key])
-            else:
-              dirty_buggy_data[key] = str(dirty_buggy_data[key]).strip().lower()
-              was_ok_boolean = True
-              if dirty_buggy_data[key] == 'true':
-                clean_buggy_data[key] = True
-              elif dirty_buggy_data[key] == 'false':
-                clean_buggy_data[key] = False
-              elif dirty_buggy_data[key] == "1":
-                clean_buggy_data[key] = True
-              elif dirty_buggy_data[key] == "0":
-                clean_buggy_data[key] = False
-              else:
-                was_ok_boolean = False
-                if not is_api:
-                  flash(f"Value for {key} was ignored because it wasn't true or false", "warning")
-              if not is_api and was_ok_boolean:
-                flash(f"Value for {key} wasn't a JSON boolean, but OK: \"{dirty_buggy_data[key]}\" accepted as {str(clean_buggy_data[key]).lower()}", "info")
-        elif isinstance(Buggy.DEFAULTS[key], int):
-          try:
-            clean_buggy_data[key] = int(dirty_buggy_data[key])
-          except ValueError:
-            if not is_api:
-              flash(f"Value for {key} was ignored because it wasn't an integer", "warning")
-        else:
-          dirty_buggy_data[key] = str(dirty_buggy_data[key]).strip().lower()
-          s = "#" if dirty_buggy_data[key].startswith("#") else ""
-          STRING_CHARS = string.digits + string.ascii_letters
-          s += "".join(c for c in dirty_buggy_data[key] if c in STRING_CHARS)
-          if s == "":
-              if not is_api:
-                  flash(f"Value for {key} was ignored because it didn't have any alphanumeric characters in it", "warning")
-          else:
-            # check lengths:
-            if max_str_len := Buggy.STRING_COL_LENGTH.get(key):
-                if len(s) > max_str_len:
-                  s = s[:max_str_len]
-                  if not is_api:
-                    flash(f"Value for {key} was truncated to {max_str_len} characters", "warning")
-            if key in Buggy.GAME_DATA:
-                if s not in Buggy.GAME_DATA[key]:
-                    flash(f"Value for {key} was ignored because \"{s}\" is not a valid choice", "warning")
-                else:
-                    clean_buggy_data[key] = s # it's a value in a list 
-            else:
-                clean_buggy_data[key] = s # free-form string (e.g., flag_color)
-      else:
-        if not is_api:
-          flash("Unrecognised setting \"{}\" was ignored {}".format(key, word_too), "warning")
-          word_too = "too"
-    if is_multi_buggy_suspected:
-        flash("Maybe you tried to upload more than one buggy? You can only upload a single JSON object here!", "danger")
-    qty_defaults = 0
-    qty_explicits = 0
-    for field_name in Buggy.DEFAULTS:
-        if field_name in clean_buggy_data:
-            qty_explicits += 1
-        else:
-            if field_name == "flag_color":
-                clean_buggy_data[field_name] = current_app.config[
-                    ConfigSettingNames.DEFAULT_FLAG_COLOR.name
-                ]
-            else:
-                clean_buggy_data[field_name] = Buggy.DEFAULTS[field_name]
-            qty_defaults += 1
-    if qty_explicits == 0:
-        msg = "Nothing to change: no buggy settings were found in the uploaded data"
+    clean_buggy_data, messages = buggy_validator.validate(
+      dirty_buggy_data,
+      current_app.config[ConfigSettingNames.DEFAULT_FLAG_COLOR.name]
+    )
+    if not is_api:
+      for (text, category) in messages:
+        flash(text, category)
+    if clean_buggy_data is None:
         if is_api:
-            return {"error": msg}
-        flash(msg, "danger")
+            return {"error": NOTHING_TO_CHANGE_MSG}
     else:
-        (s, was) = ("s", "were") if qty_explicits > 1 else ("", "was")
-        flash(f"{qty_explicits} setting{s} {was} specified", "info")
-        if qty_defaults > 0:
-            if not is_api:
-                (s, was) = ("s", "were") if qty_defaults > 1 else ("", "was")
-                flash(f"{qty_defaults} setting{s} {was} not specified and got default value{s} instead", "info")
-        if 'buggy_id' not in clean_buggy_data:
-            clean_buggy_data['buggy_id'] = 1 # TODO not sure
         users_buggy = Buggy.query.filter_by(user_id=user.id).first()
         if users_buggy is None:
-            Buggy.create(user_id = user.id, **clean_buggy_data)
+            Buggy(user_id = user.id, **clean_buggy_data).save(commit=False)
             if is_api:
                 return {"ok": "buggy created OK"}
             flash("JSON data for your racing buggy saved OK", "success")
         else:
           for field_name in clean_buggy_data:
               setattr(users_buggy, field_name, clean_buggy_data[field_name])
-          users_buggy.save()
+          users_buggy.save(commit=False)
           if not is_api:
               flash("JSON data for your racing buggy updated OK", "success")
         if is_api:
@@ -165,6 +93,75 @@ def handle_uploaded_json(form, user, is_api=False):
   else:
       return render_template("user/submit_buggy_data.html", form=form)
 
+def save_uploaded_buggies(uploads, default_flag_color):
+  """ Saves a batch of buggies (e.g., replaying a cohort's, or seeding a
+  demo server): uploads are (username, buggy_json) pairs, where the JSON
+  can be a string or already parsed. Each buggy is cleaned just like a
+  single upload, but they are all saved together: one bulk UPDATE for the
+  buggies that exist, one bulk INSERT for those that don't (and one for the
+  users' JSON), in one transaction. If a username appears more than once,
+  the last one wins. Returns a result (a dict with "ok" or "error", and any
+  warnings) for each upload, in order."""
+  now = datetime.now(timezone.utc)
+  usernames = {username for (username, _) in uploads}
+  user_ids = dict(
+    db.session.execute(
+      select(User.username, User.id).where(User.username.in_(usernames))
+    ).all()
+  ) if usernames else {}
+  buggy_ids = dict(
+    db.session.execute(
+      select(Buggy.user_id, Buggy.id).where(Buggy.user_id.in_(user_ids.values()))
+    ).all()
+  ) if user_ids else {}
+  results = []
+  buggies = {} # user_id: buggy's data, so the last upload for a user wins
+  users = {}
+  for (username, buggy_json) in uploads:
+    user_id = user_ids.get(username)
+    if user_id is None:
+      results.append({"username": username, "error": "no such user"})
+      continue
+    if not isinstance(buggy_json, str):
+      buggy_json = json.dumps(buggy_json)
+    users[user_id] = {"id": user_id, "latest_json": buggy_json, "uploaded_at": now}
+    try:
+      dirty_buggy_data = json.loads(buggy_json)
+    except json.decoder.JSONDecodeError:
+      results.append({"username": username, "error": "Failed to parse JSON data"})
+      continue
+    clean_buggy_data, messages = buggy_validator.validate(
+      dirty_buggy_data, default_flag_color
+    )
+    result = {
+      "username": username,
+      "warnings": [
+        text for (text, category) in messages
+        if category in ("warning", "danger") and text != NOTHING_TO_CHANGE_MSG
+      ]
+    }
+    if clean_buggy_data is None:
+      result["error"] = NOTHING_TO_CHANGE_MSG
+    else:
+      # bulk statements skip the ORM (so Buggy's events): work out the totals
+      buggy = Buggy(**clean_buggy_data)
+      clean_buggy_data.update(total_cost=buggy.total_cost, mass=buggy.mass)
+      if user_id in buggy_ids:
+        buggies[user_id] = {"id": buggy_ids[user_id], **clean_buggy_data}
+        result["ok"] = "buggy updated OK"
+      else:
+        buggies[user_id] = {"user_id": user_id, **clean_buggy_data}
+        result["ok"] = "buggy created OK"
+    results.append(result)
+  if users:
+    db.session.execute(update(User), list(users.values()))
+  if buggies_to_update := [data for data in buggies.values() if "id" in data]:
+    db.session.execute(update(Buggy), buggies_to_update)
+  if buggies_to_insert := [data for data in buggies.values() if "id" not in data]:
+    db.session.execute(insert(Buggy), buggies_to_insert)
+  db.session.commit()
+  return results
+
 @blueprint.route("/json", methods=["POST"], strict_slashes=False)
 @login_required
 @active_user_required
@@ -197,6 +194,19 @@ def show_buggy(username=None):
     else:
         is_plain_flag = buggy.flag_pattern == 'plain'
     flag_color_css_defs = get_flag_color_css_defs([buggy])
+    race_eligibilities = []
+    if buggy and user.is_student:
+        # each race's scrutineering is cached, so this is cheap
+        upcoming_races = Race.query.filter(
+            Race.is_visible==True,
+            Race.is_abandoned==False,
+            Race.start_at > datetime.now(timezone.utc),
+        ).order_by(Race.start_at.asc()).limit(MAX_UPCOMING_RACES_SCRUTINEERED).all()
+        for race in upcoming_races:
+            for entrant in race.get_scrutineering()["buggies"]:
+                if entrant["user_id"] == user.id:
+                    race_eligibilities.append((race, entrant))
+                    break
     if buggy and (
       current_app.config[ConfigSettingNames.IS_BUGGY_DELETE_ALLOWED.name]
       or current_user.is_administrator
@@ -217,6 +227,8 @@ def show_buggy(username=None):
         flag_color_css_defs=flag_color_css_defs,
         is_own_buggy=user==current_user,
         is_plain_flag=is_plain_flag,
+        race_eligibilities=race_eligibilities,
+        rules=BuggySpecs.RULES,
         user=user,
     )
 
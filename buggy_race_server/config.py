@@ -1077,9 +1077,11 @@ class ConfigSettings:
           """If you enable the admin API, then admin users can download a JSON
           dump of "dashboard" data if they provide a valid API key and secret.
           This may be helpful if you are monitoring engagement data and want to
-          schedule regular data downloads. Only enable the admin API if you are
-          accessing the server over https. If this is set to `No`, the admin
-          endpoint will return a 404 response.""",
+          schedule regular data downloads. They can also upload a batch of
+          users' buggies in one go (e.g., for seeding a demo server, or load
+          testing). Only enable the admin API if you are accessing the server
+          over https. If this is set to `No`, the admin endpoints will return
+          a 404 response.""",
 
         ConfigSettingNames.IS_ALL_CONFIG_IN_TECH_NOTES.name:
           """Choose `Yes` if all the config settings' values should be
@@ -1898,6 +1900,16 @@ class ConfigSettings:
     # config key for cachebuster: a number expected to be different each run
     CACHEBUSTER_KEY = "_CACHEBUSTER"
 
+    # config keys for the settings (as stored in the database) this worker
+    # last loaded, and the settings version they were (see CacheVersion):
+    # another worker may have changed them since
+    LOADED_SETTINGS_KEY = "_LOADED_SETTINGS"
+    SETTINGS_VERSION_KEY = "_SETTINGS_VERSION"
+
+    # the announcements version (see CacheVersion) of the worker's copy of
+    # the current announcements (which are in _CURRENT_ANNOUNCEMENTS)
+    ANNOUNCEMENTS_VERSION_KEY = "_ANNOUNCEMENTS_VERSION"
+
     # config keys for forcing the database URI's password to be rewritten
     # and adding sslmode=require
     # as a query variables (which are not stored in the database: must be read
@@ -2079,6 +2091,7 @@ class ConfigSettings:
         "FLASK_DEBUG",
         "FLASK_ENV",
         "GUNICORN_WORKERS",
+        "JOB_WORKERS",
         "LOG_LEVEL",
         "SEND_FILE_MAX_AGE_DEFAULT",
         "SQLALCHEMY_TRACK_MODIFICATIONS",
@@ -2328,10 +2341,22 @@ class ConfigFromEnv():
 
     UPLOAD_FOLDER = "buggy_race_server/uploads"
 
+    # big files (race files, racetrack images) go in the blob store: use
+    # "db" if files written by the server don't persist (e.g., on Heroku,
+    # which sets DYNO, so that's the default there)
+    BLOB_STORE = env.str(
+        "BLOB_STORE",
+        default="db" if env.str("DYNO", default=None) else "filesystem"
+    )
+    BLOB_STORE_DIR = env.str("BLOB_STORE_DIR", default="buggy_race_server/blobs")
+
     LOG_LEVEL = env.str("LOG_LEVEL", default="debug")
     BCRYPT_LOG_ROUNDS = env.int("BCRYPT_LOG_ROUNDS", default=13)
     DEBUG_TB_ENABLED = DEBUG
     DEBUG_TB_INTERCEPT_REDIRECTS = env.bool("DEBUG_TB_INTERCEPT_REDIRECTS", default=False)
+    # "simple" is per-process: with more than one worker (GUNICORN_WORKERS),
+    # use a shared cache (e.g., "redis"), especially if students fork the
+    # course repo with the GitHub API (see User.has_course_repository)
     CACHE_TYPE = env.str("CACHE_TYPE", default="simple") # Can be "memcached", "redis", etc.
 
     SQLALCHEMY_TRACK_MODIFICATIONS = env.bool("BCRYPT_LOG_ROUNDS", default=False)
@@ -2349,6 +2374,7 @@ class ConfigFromEnv():
         raise
 
     GUNICORN_WORKERS = env.int("GUNICORN_WORKERS", default=1)
+    JOB_WORKERS = env.int("JOB_WORKERS", default=1) # per process (see admin/jobs.py)
     
     _UNEXPECTED_CONFIG_SETTINGS = []
 
@@ -9,6 +9,8 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_static_digest import FlaskStaticDigest
 from flask_wtf.csrf import CSRFProtect
 
+from buggy_race_server.lib.blob_store import BlobStore
+
 bcrypt = Bcrypt()
 csrf = CSRFProtect()
 login_manager = LoginManager()
@@ -17,3 +19,4 @@ migrate = Migrate()
 cache = Cache()
 debug_toolbar = DebugToolbarExtension()
 flask_static_digest = FlaskStaticDigest()
+blob_store = BlobStore(db)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed blob store, for big files (race files, racetrack images)
+that would otherwise be in table rows.
+
+A blob is stored (once) under the SHA-256 hash of its bytes, and that hash
+is all a model needs to keep: so loading a row doesn't load the blob, and
+the hash is a ready-made (strong) ETag when it's served.
+
+There are two places blobs can go:
+
+  * "filesystem" (the default): files in a directory (BLOB_STORE_DIR),
+    which can be served directly (with sendfile) by the web server
+  * "db": the blobs table, for hosts with ephemeral filesystems (like
+    Heroku), where files written by the app don't survive a restart
+
+BlobStore is the extension that picks one of these from the app's config
+(BLOB_STORE). The stores themselves don't need Flask, so migrations can
+use them too (see DatabaseBlobs).
+"""
+
+import hashlib
+import os
+import tempfile
+
+import sqlalchemy as sa
+
+BLOBS_TABLE = sa.table(
+    "blobs",
+    sa.column("hash", sa.String),
+    sa.column("size", sa.Integer),
+    sa.column("data", sa.LargeBinary),
+)
+
+def get_blob_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FilesystemBlobs():
+    """Blobs as files: the first two characters of the hash are the name of
+    a subdirectory, so no one directory gets too big"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def has(self, blob_hash):
+        return os.path.isfile(self.path_for(blob_hash))
+
+    def get(self, blob_hash):
+        try:
+            with open(self.path_for(blob_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, data, blob_hash=None):
+        blob_hash = blob_hash or get_blob_hash(data)
+        if not self.has(blob_hash):
+            path = self.path_for(blob_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file and then rename it, so a reader (in
+            # another worker, maybe) never sees a half-written blob
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return blob_hash
+
+    def delete(self, blob_hash):
+        try:
+            os.remove(self.path_for(blob_hash))
+        except FileNotFoundError:
+            pass
+
+
+class DatabaseBlobs():
+    """Blobs in the blobs table: get_executor returns something to execute
+    SQLAlchemy statements with (the app's db.session, or a migration's
+    connection)"""
+
+    def __init__(self, get_executor):
+        self.get_executor = get_executor
+
+    def path_for(self, blob_hash):
+        return None # not a file: has to be served from memory
+
+    def has(self, blob_hash):
+        return self.get_executor().execute(
+            sa.select(BLOBS_TABLE.c.hash).where(BLOBS_TABLE.c.hash == blob_hash)
+        ).first() is not None
+
+    def get(self, blob_hash):
+        row = self.get_executor().execute(
+            sa.select(BLOBS_TABLE.c.data).where(BLOBS_TABLE.c.hash == blob_hash)
+        ).first()
+        return None if row is None else bytes(row[0])
+
+    def put(self, data, blob_hash=None):
+        blob_hash = blob_hash or get_blob_hash(data)
+        if not self.has(blob_hash):
+            self.get_executor().execute(
+                sa.insert(BLOBS_TABLE).values(hash=blob_hash, size=len(data), data=data)
+            )
+        return blob_hash
+
+    def delete(self, blob_hash):
+        self.get_executor().execute(
+            sa.delete(BLOBS_TABLE).where(BLOBS_TABLE.c.hash == blob_hash)
+        )
+
+
+class BlobStore():
+    """Extension (see extensions.py) for the app's blob store: db is the
+    SQLAlchemy extension, which is only used if the blobs are in the database"""
+
+    FILESYSTEM = "filesystem"
+    DATABASE = "db"
+
+    def __init__(self, db=None):
+        self.db = db
+        self.blobs = None
+
+    def init_app(self, app):
+        self.blobs = BlobStore.get_blobs_for_app(app, lambda: self.db.session)
+
+    @staticmethod
+    def get_blobs_for_app(app, get_executor):
+        """ Returns the blobs the app's config says to use: get_executor is
+        for DatabaseBlobs (so migrations can use their own connection)"""
+        store_type = app.config.get("BLOB_STORE") or BlobStore.FILESYSTEM
+        if store_type == BlobStore.FILESYSTEM:
+            blob_dir = app.config["BLOB_STORE_DIR"]
+            if not os.path.isabs(blob_dir): # relative to the project root
+                blob_dir = os.path.join(os.path.dirname(app.root_path), blob_dir)
+            return FilesystemBlobs(blob_dir)
+        if store_type == BlobStore.DATABASE:
+            return DatabaseBlobs(get_executor)
+        raise ValueError(f"unknown BLOB_STORE \"{store_type}\" (expected "
+                         f"\"{BlobStore.FILESYSTEM}\" or \"{BlobStore.DATABASE}\")")
+
+    def path_for(self, blob_hash):
+        """ Returns the path of the blob's file, or None if blobs aren't files"""
+        return self.blobs.path_for(blob_hash)
+
+    def has(self, blob_hash):
+        return self.blobs.has(blob_hash)
+
+    def get(self, blob_hash):
+        """ Returns the blob's bytes, or None if there's no such blob"""
+        return self.blobs.get(blob_hash)
+
+    def put(self, data):
+        """ Stores the bytes (if they aren't already stored) and returns their hash"""
+        return self.blobs.put(data)
+
+    def delete(self, blob_hash):
+        """ Only safe if nothing else has the same contents (blobs are shared)"""
+        self.blobs.delete(blob_hash)
@@ -0,0 +1,135 @@
+"""Cleans the buggy data students upload (as JSON) before it's saved.
+
+The rules for each setting come from BuggySpecs (its defaults, the valid
+choices in GAME_DATA, and the string lengths), and are compiled once, into
+a function for each setting, so cleaning a buggy is just a dictionary
+lookup and a call per setting. There are no side effects (such as Flask's
+flash), so the same validator is used by the upload form, the API, and
+batch uploads; and it doesn't need Flask (or the database).
+"""
+
+import string
+
+from buggy_race_server.lib.race_specs import BuggySpecs
+
+NOTHING_TO_CHANGE_MSG = "Nothing to change: no buggy settings were found in the uploaded data"
+
+# bytes to delete from strings: anything that isn't a letter or a digit
+_NOT_ALPHANUMERIC = bytes(
+    b for b in range(128) if chr(b) not in string.ascii_letters + string.digits
+)
+
+_BOOLEAN_STRINGS = {"true": True, "false": False, "1": True, "0": False}
+
+
+def get_alphanumeric(value):
+    """ Returns the lowercase letters and digits in the value (and a leading
+    "#", e.g., for a hex colour): anything else is dropped, including
+    non-ASCII letters (lowercasing first, as some of those become ASCII)"""
+    value = str(value).strip().lower()
+    alphanumeric = value.encode("ascii", "ignore").translate(None, _NOT_ALPHANUMERIC).decode("ascii")
+    return "#" + alphanumeric if value.startswith("#") else alphanumeric
+
+
+# Each coercer takes the (dirty) key and value, and returns the clean value
+# (or None, if it must be ignored) and any (text, category) messages
+
+def _coerce_boolean(key, value):
+    if isinstance(value, bool):
+        return value, ()
+    dirty_value = str(value).strip().lower()
+    if (clean_value := _BOOLEAN_STRINGS.get(dirty_value)) is None:
+        return None, ((f"Value for {key} was ignored because it wasn't true or false", "warning"),)
+    return clean_value, ((
+        f"Value for {key} wasn't a JSON boolean, but OK: \"{dirty_value}\" "
+        f"accepted as {str(clean_value).lower()}",
+        "info"
+    ),)
+
+def _coerce_integer(key, value):
+    try:
+        return int(value), ()
+    except (TypeError, ValueError, OverflowError):
+        return None, ((f"Value for {key} was ignored because it wasn't an integer", "warning"),)
+
+def _compile_string_coercer(max_length, choices):
+    def coerce_string(key, value):
+        clean_value = get_alphanumeric(value)
+        if clean_value == "":
+            return None, ((f"Value for {key} was ignored because it didn't have any alphanumeric characters in it", "warning"),)
+        messages = ()
+        if max_length and len(clean_value) > max_length:
+            clean_value = clean_value[:max_length]
+            messages = ((f"Value for {key} was truncated to {max_length} characters", "warning"),)
+        if choices is not None and clean_value not in choices:
+            return None, messages + ((f"Value for {key} was ignored because \"{clean_value}\" is not a valid choice", "warning"),)
+        return clean_value, messages
+    return coerce_string
+
+
+class BuggyValidator:
+    """ Compiled rules for cleaning buggy data: see validate """
+
+    def __init__(
+        self,
+        defaults=BuggySpecs.DEFAULTS,
+        game_data=BuggySpecs.GAME_DATA,
+        string_lengths=BuggySpecs.STRING_COL_LENGTH,
+    ):
+        self.defaults = dict(defaults)
+        # each key that can be uploaded: (the setting it's for, its coercer)
+        self.coercers = {"id": ("buggy_id", _coerce_integer)} # user's own id
+        for name, default in defaults.items():
+            if isinstance(default, bool): # (before int: bools are ints)
+                coercer = _coerce_boolean
+            elif isinstance(default, int):
+                coercer = _coerce_integer
+            else:
+                choices = frozenset(game_data[name]) if name in game_data else None
+                coercer = _compile_string_coercer(string_lengths.get(name), choices)
+            self.coercers[name] = (name, coercer)
+
+    def validate(self, dirty_buggy_data, default_flag_color=None):
+        """ Cleans buggy data (already parsed from its JSON): returns the
+        clean data (with defaults for any settings it didn't specify) and
+        messages explaining what was done, as (text, category) tuples, in
+        the order they should be shown. If no settings were specified, the
+        clean data is None, and the last message says so."""
+        clean_buggy_data = {}
+        messages = []
+        word_too = ""
+        is_multi_buggy_suspected = isinstance(dirty_buggy_data, list)
+        if not isinstance(dirty_buggy_data, dict):
+            dirty_buggy_data = {} # e.g., a list of buggies: no settings in it
+        for key, value in dirty_buggy_data.items():
+            if (coercion := self.coercers.get(key)) is None:
+                messages.append((f"Unrecognised setting \"{key}\" was ignored {word_too}", "warning"))
+                word_too = "too"
+                continue
+            (name, coercer) = coercion
+            clean_value, coercion_messages = coercer(key, value)
+            messages.extend(coercion_messages)
+            if clean_value is not None:
+                clean_buggy_data[name] = clean_value
+        if is_multi_buggy_suspected:
+            messages.append(("Maybe you tried to upload more than one buggy? You can only upload a single JSON object here!", "danger"))
+        qty_explicits = sum(name in clean_buggy_data for name in self.defaults)
+        if qty_explicits == 0:
+            messages.append((NOTHING_TO_CHANGE_MSG, "danger"))
+            return None, messages
+        qty_defaults = len(self.defaults) - qty_explicits
+        for name, default in self.defaults.items():
+            if name not in clean_buggy_data:
+                if name == "flag_color" and default_flag_color is not None:
+                    default = default_flag_color
+                clean_buggy_data[name] = default
+        (s, was) = ("s", "were") if qty_explicits > 1 else ("", "was")
+        messages.append((f"{qty_explicits} setting{s} {was} specified", "info"))
+        if qty_defaults > 0:
+            (s, was) = ("s", "were") if qty_defaults > 1 else ("", "was")
+            messages.append((f"{qty_defaults} setting{s} {was} not specified and got default value{s} instead", "info"))
+        clean_buggy_data.setdefault("buggy_id", 1) # TODO not sure
+        return clean_buggy_data, messages
+
+
+buggy_validator = BuggyValidator()
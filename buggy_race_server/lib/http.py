@@ -1,10 +1,33 @@
 # -*- coding: utf-8 -*-
-"""Http Library because the python ecosystem for this is pants."""
+"""Http Library because the python ecosystem for this is pants.
 
+Connections are kept alive and pooled (per host, shared by every Http
+client in the process), so a job making lots of API calls doesn't pay for
+a new TLS handshake each time. GitHub's rate limits are respected: if a
+response says we've been rate-limited, the client waits for as long as it's
+told to (X-RateLimit-Reset or Retry-After) and tries again, rather than
+dropping the request. GETs are conditional: responses with an ETag are
+cached, and a 304 Not Modified (which doesn't count against GitHub's rate
+limit) is answered from the cache.
+"""
+
+from collections import OrderedDict
 import json
-from http.client import HTTPConnection, HTTPSConnection
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+import threading
+import time
 from urllib.parse import urlencode, urlparse
 
+HTTP_TIMEOUT = 30 # seconds
+MAX_IDLE_CONNECTIONS_PER_HOST = 4
+ETAG_CACHE_SIZE = 256 # responses
+
+# if there's no Retry-After, GitHub says wait at least a minute after
+# hitting a secondary rate limit
+SECONDARY_RATE_LIMIT_WAIT = 60 # seconds
+
+_sleep = time.sleep # (so tests don't have to wait)
+
 
 class Url:
     def of(url_string, params={}):
@@ -30,24 +53,38 @@ class Url:
             return f"{self.path}?{self.query}"
         return self.path
 
+    @property
+    def host_key(self):
+        return (self.scheme, self.hostname, self.port)
+
     def __str__(self):
-        if (not self.port) or self.port in ['80', '443']:
+        if (not self.port) or self.port in [80, 443]:
             return f"{self.scheme}://{self.hostname}{self.path_and_query}"
 
         return f"{self.scheme}://{self.hostname}:{self.port}{self.path_and_query}"
 
 class Http:
     class Response:
-        def of(connection):
-            response = connection.getresponse()
-            body = ""
-            while chunk := response.read():
-                body = body + chunk.decode('utf-8')
-            return Http.Response(response, body)
-
-        def __init__(self, raw_response, body):
+        def of(raw_response):
+            # read() returns the whole body, however it was sent (e.g.,
+            # chunked): it must all be read before the connection is reused
+            return Http.Response(raw_response, raw_response.read().decode('utf-8'))
+
+        def __init__(self, raw_response, body, is_from_cache=False):
             self.raw_response = raw_response
             self.body = body
+            self.is_from_cache = is_from_cache
+
+        @property
+        def status(self):
+            return self.raw_response.status
+
+        @property
+        def reason(self):
+            return self.raw_response.reason
+
+        def header(self, name, default=None):
+            return self.raw_response.getheader(name, default)
 
         def json(self):
             return json.loads(self.body)
@@ -58,29 +95,112 @@ class Http:
 
         def of(url):
             if url.scheme == 'http':
-                return Http.Connection(HTTPConnection(url.hostname), url)
+                return Http.Connection(HTTPConnection(url.hostname, url.port, timeout=HTTP_TIMEOUT), url)
             elif url.scheme == 'https':
-                return Http.Connection(HTTPSConnection(url.hostname), url)
+                return Http.Connection(HTTPSConnection(url.hostname, url.port, timeout=HTTP_TIMEOUT), url)
             else:
-                # TODO: use better error message
-                raise Http.Connection.UnknownSchemeError(f"Yo, no idea what scheme this is man. {url.scheme}")
+                raise Http.Connection.UnknownSchemeError(f"Unknown URL scheme (expected http or https): {url.scheme}")
 
         def __init__(self, connection, url):
             self.connection = connection
             self.url = url
+            self.is_reused = False
 
-        def request(self, method, headers=None, body=None):
+        def request(self, method, url, headers=None, body=None):
+            """Returns the raw response, having read its body (so it's ready
+            to go back in the pool)"""
             self.connection.request(
                 method,
-                self.url.path_and_query,
-                headers=headers,
+                url.path_and_query,
+                headers=headers or {},
                 body=body
             )
-            return Http.Response.of(self.connection)
+            return Http.Response.of(self.connection.getresponse())
+
+        def close(self):
+            self.connection.close()
+
+    class ConnectionPool:
+        """Idle keep-alive connections, by host: a connection is taken out
+        while it's being used, so each is only used by one thread at a time"""
+
+        def __init__(self, max_idle_per_host=MAX_IDLE_CONNECTIONS_PER_HOST):
+            self.max_idle_per_host = max_idle_per_host
+            self._idle = {}
+            self._lock = threading.Lock()
+
+        def take(self, url):
+            with self._lock:
+                if idle := self._idle.get(url.host_key):
+                    connection = idle.pop()
+                    connection.is_reused = True
+                    return connection
+            return Http.Connection.of(url)
+
+        def put_back(self, connection):
+            with self._lock:
+                idle = self._idle.setdefault(connection.url.host_key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append(connection)
+                    return
+            connection.close()
+
+        def clear(self):
+            with self._lock:
+                idle_lists, self._idle = list(self._idle.values()), {}
+            for idle in idle_lists:
+                for connection in idle:
+                    connection.close()
 
-    def __init__(self, headers, base_url=None):
+    class ETagCache:
+        """The most recent GET responses that had an ETag (keyed by the URL
+        and the client's headers, because responses depend on who's asking)"""
+
+        def __init__(self, size=ETAG_CACHE_SIZE):
+            self.size = size
+            self._responses = OrderedDict()
+            self._lock = threading.Lock()
+
+        def get(self, key):
+            with self._lock:
+                if response := self._responses.get(key):
+                    self._responses.move_to_end(key)
+                return response
+
+        def put(self, key, response):
+            with self._lock:
+                self._responses[key] = response
+                self._responses.move_to_end(key)
+                while len(self._responses) > self.size:
+                    self._responses.popitem(last=False)
+
+        def clear(self):
+            with self._lock:
+                self._responses.clear()
+
+    pool = None # shared by all clients: set below
+    etag_cache = None
+
+    def __init__(
+        self,
+        headers,
+        base_url=None,
+        max_rate_limit_wait=60,
+        max_retries=3,
+        write_interval=0,
+    ):
+        """max_rate_limit_wait is the longest (in seconds) this client will
+        wait for a rate limit to reset before giving up (and returning the
+        response that says it was rate-limited); write_interval is the
+        minimum time between its POST/PATCH/PUT/DELETE requests (which GitHub
+        asks for, to avoid its secondary rate limits)"""
         self.headers = headers
         self.base_url = base_url
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.max_retries = max_retries
+        self.write_interval = write_interval
+        self._last_write_at = None
+        self._rate_limited_until = 0
 
     def full_url(self, url_string):
         if not self.base_url:
@@ -88,17 +208,91 @@ class Http:
 
         return self.base_url + url_string
 
-    def post(self, url_string, params={}, body={}):
+    def _send(self, method, url, headers, body):
+        # If a pooled connection has been closed by the server while it was
+        # idle, we only find out when we try to use it: so try again (once)
+        # on a new connection
+        connection = Http.pool.take(url)
+        try:
+            response = connection.request(method, url, headers, body)
+        except (ConnectionError, HTTPException):
+            connection.close()
+            if not connection.is_reused:
+                raise
+            connection = Http.Connection.of(url)
+            try:
+                response = connection.request(method, url, headers, body)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+        if response.raw_response.will_close:
+            connection.close()
+        else:
+            Http.pool.put_back(connection)
+        return response
+
+    def _get_rate_limit_wait(self, response):
+        """Returns how long to wait (in seconds) before trying again, or None
+        if the response isn't a rate limit"""
+        if response.status not in (403, 429):
+            return None
+        if retry_after := response.header("Retry-After"):
+            try:
+                return max(0, int(retry_after))
+            except ValueError:
+                pass
+        if response.header("X-RateLimit-Remaining") == "0":
+            try:
+                return max(0, int(response.header("X-RateLimit-Reset")) - time.time())
+            except (TypeError, ValueError):
+                pass
+        if response.status == 429 or "rate limit" in response.body.lower():
+            return SECONDARY_RATE_LIMIT_WAIT
+        return None # e.g., a 403 that really is forbidden
+
+    def _wait_for_rate_limit(self, is_write):
+        wait = self._rate_limited_until - time.time()
+        if is_write and self.write_interval and self._last_write_at is not None:
+            wait = max(wait, self._last_write_at + self.write_interval - time.monotonic())
+        if wait > 0:
+            _sleep(wait)
+
+    def request(self, method, url_string, params={}, body=None):
         url = Url.of(self.full_url(url_string), params)
-        connection = Http.Connection.of(url)
-        return connection.request("POST", self.headers, json.dumps(body))
+        headers = dict(self.headers)
+        cache_key = None
+        cached_response = None
+        if method == "GET":
+            cache_key = (str(url), tuple(sorted(self.headers.items())))
+            if cached_response := Http.etag_cache.get(cache_key):
+                headers["If-None-Match"] = cached_response.header("ETag")
+        is_write = method in ("POST", "PATCH", "PUT", "DELETE")
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit(is_write)
+            response = self._send(method, url, headers, body)
+            if is_write:
+                self._last_write_at = time.monotonic()
+            wait = self._get_rate_limit_wait(response)
+            if wait is None or wait > self.max_rate_limit_wait or attempt == self.max_retries:
+                break
+            self._rate_limited_until = time.time() + wait
+        if response.status == 304 and cached_response is not None:
+            return Http.Response(cached_response.raw_response, cached_response.body, is_from_cache=True)
+        if cache_key and response.status == 200 and response.header("ETag"):
+            Http.etag_cache.put(cache_key, response)
+        return response
+
+    def post(self, url_string, params={}, body={}):
+        return self.request("POST", url_string, params, json.dumps(body))
 
     def get(self, url_string, params={}):
-        url = Url.of(self.full_url(url_string), params)
-        connection = Http.Connection.of(url)
-        return connection.request("GET", self.headers)
+        return self.request("GET", url_string, params)
 
     def patch(self, url_string, params={}, body={}):
-        url = Url.of(self.full_url(url_string), params)
-        connection = Http.Connection.of(url)
-        return connection.request("PATCH", self.headers, json.dumps(body))
+        return self.request("PATCH", url_string, params, json.dumps(body))
+
+Http.pool = Http.ConnectionPool()
+Http.etag_cache = Http.ETagCache()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Incremental JSON reading, for big files (like race results) that are
+mostly one value that doesn't need to be parsed.
+
+JsonStreamReader reads JSON text from a stream a chunk at a time. Values are
+parsed as usual, unless the caller asks for them raw: then they are only
+scanned (to find where they end) and kept as the JSON text they came in as
+(a RawJSON string), without building any Python objects. dumps_with_raw
+writes them back out, unchanged. Scanning only counts brackets, so it does
+not check that raw values are valid JSON: anything that keeps them must
+check them first (e.g., race_events.check_events parses them a step at a
+time).
+
+For example, race results are mostly events (see race_events.py), which the
+server stores and serves but never looks inside.
+"""
+
+import io
+import json
+import re
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+STRUCTURE_RE = re.compile(r'["\[\]{}]')
+STRING_SPECIAL_RE = re.compile(r'["\\]')
+SCALAR_END_RE = re.compile(r'[,\]}\s]')
+NOT_WHITESPACE_RE = re.compile(r'\S')
+
+
+class RawJSON(str):
+    """JSON text that has not been parsed"""
+
+
+class JsonStreamReader():
+
+    def __init__(self, stream, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+
+    def _fill(self):
+        """ reads the next chunk (dropping what's already been read): returns
+        False if there's nothing left"""
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skips whitespace and returns the next character (but doesn't
+        consume it): returns an empty string at the end of the stream"""
+        while True:
+            if m := NOT_WHITESPACE_RE.search(self.buf, self.pos):
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if (found := self.peek()) != char:
+            raise ValueError(f"expected '{char}' in JSON but found '{found}'")
+        self.pos += 1
+
+    def read_raw_value(self):
+        """ Returns the JSON text of the next value, without parsing it """
+        first_char = self.peek()
+        if first_char == "":
+            raise ValueError("unexpected end of JSON data")
+        pieces = []
+        if first_char not in '{["': # number, true, false, or null
+            while not (m := SCALAR_END_RE.search(self.buf, self.pos)):
+                pieces.append(self.buf[self.pos:])
+                self.pos = len(self.buf)
+                if not self._fill():
+                    return RawJSON("".join(pieces))
+            pieces.append(self.buf[self.pos:m.start()])
+            self.pos = m.start()
+            return RawJSON("".join(pieces))
+        depth = 0
+        is_in_string = False
+        is_escaped = False # a backslash can be the last character of a chunk
+        while True:
+            buf = self.buf
+            i = self.pos
+            end = None
+            while i < len(buf):
+                if is_in_string:
+                    if is_escaped:
+                        is_escaped = False
+                        i += 1
+                        continue
+                    if not (m := STRING_SPECIAL_RE.search(buf, i)):
+                        break
+                    i = m.end()
+                    if m.group() == "\\":
+                        is_escaped = True
+                    else:
+                        is_in_string = False
+                        if depth == 0: # value was a string
+                            end = i
+                            break
+                else:
+                    if not (m := STRUCTURE_RE.search(buf, i)):
+                        break
+                    i = m.end()
+                    char = m.group()
+                    if char == '"':
+                        is_in_string = True
+                    elif char in "[{":
+                        depth += 1
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            end = i
+                            break
+            if end is not None:
+                pieces.append(buf[self.pos:end])
+                self.pos = end
+                return RawJSON("".join(pieces))
+            pieces.append(buf[self.pos:])
+            self.pos = len(buf)
+            if not self._fill():
+                raise ValueError("unexpected end of JSON data")
+
+    def read_value(self):
+        return json.loads(self.read_raw_value())
+
+    def read_object(self, readers=None):
+        """ Reads a JSON object and returns it as a dict: readers maps keys to
+        functions that are called (with this reader) to read the value for
+        that key instead (e.g., read_raw, to keep it as JSON text)"""
+        readers = readers or {}
+        obj = {}
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return obj
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("expected a string for key in JSON object")
+            self.expect(":")
+            if key in readers:
+                obj[key] = readers[key](self)
+            else:
+                obj[key] = self.read_value()
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return obj
+            if char != ",":
+                raise ValueError(f"expected ',' or '}}' in JSON object but found '{char}'")
+
+    def iter_array_raw(self):
+        """ Reads a JSON array, yielding the JSON text of each item """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.read_raw_value()
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' in JSON array but found '{char}'")
+
+    def expect_end(self):
+        if self.peek() != "":
+            raise ValueError("unexpected extra data after JSON")
+
+def read_raw(reader):
+    """ For JsonStreamReader.read_object's readers: keeps the value raw """
+    return reader.read_raw_value()
+
+def iter_raw_items(array):
+    """ Yields the JSON text of each item in an array, which is either a list
+    or a RawJSON array (which is scanned, not parsed)"""
+    if isinstance(array, RawJSON):
+        yield from JsonStreamReader(io.StringIO(array)).iter_array_raw()
+    else:
+        for item in array:
+            yield RawJSON(dumps_with_raw(item))
+
+def dumps_with_raw(obj):
+    """ Like json.dumps (compact), but RawJSON values are written as they are """
+    if isinstance(obj, RawJSON):
+        return str(obj)
+    if isinstance(obj, dict):
+        return "{" + ",".join(
+            f"{json.dumps(str(key))}:{dumps_with_raw(value)}" for key, value in obj.items()
+        ) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(dumps_with_raw(value) for value in obj) + "]"
+    return json.dumps(obj, separators=(",", ":"))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Password hashing for lots of passwords at once (e.g., registering a whole
+cohort of students), in a pool of processes.
+
+bcrypt is deliberately slow (that's the point of it), so hashing hundreds of
+passwords one after another takes minutes. The hashes are the same as the
+ones the app's bcrypt extension (Flask-Bcrypt) makes, so check_password
+works on them: but this doesn't need Flask, because it runs in processes
+that don't have the app.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
+import multiprocessing
+
+import bcrypt
+
+DEFAULT_PREFIX = "2b" # same defaults as Flask-Bcrypt
+MIN_PASSWORDS_FOR_POOL = 4 # fewer than this: not worth starting processes
+
+def hash_password(password, log_rounds, prefix=DEFAULT_PREFIX, is_long_password_hashed=False):
+    """ Returns the bcrypt hash (bytes) of the password, as Flask-Bcrypt's
+    generate_password_hash would (with the same settings)"""
+    if not password:
+        raise ValueError("Password must be non-empty.")
+    password = password.encode("utf-8")
+    if is_long_password_hashed: # Flask-Bcrypt's BCRYPT_HANDLE_LONG_PASSWORDS
+        password = hashlib.sha256(password).hexdigest().encode("utf-8")
+    salt = bcrypt.gensalt(rounds=log_rounds, prefix=prefix.encode("utf-8"))
+    return bcrypt.hashpw(password, salt)
+
+def iter_password_hashes(passwords, log_rounds, prefix=DEFAULT_PREFIX,
+                         is_long_password_hashed=False, max_workers=None):
+    """ Yields the hash of each password, in order, hashing them in a pool
+    of processes (max_workers defaults to the number of CPUs). The processes
+    are spawned, not forked, because the caller may well have threads."""
+    hasher = partial(
+        hash_password,
+        log_rounds=log_rounds,
+        prefix=prefix,
+        is_long_password_hashed=is_long_password_hashed,
+    )
+    passwords = list(passwords)
+    if len(passwords) < MIN_PASSWORDS_FOR_POOL or max_workers == 1:
+        yield from map(hasher, passwords)
+        return
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        yield from pool.map(hasher, passwords)
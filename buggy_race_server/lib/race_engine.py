@@ -0,0 +1,786 @@
+# -*- coding: utf-8 -*-
+"""Race engine: the buggy race simulation, without any of the prompting.
+
+This is the importable core of utils/run-buggy-race.py: like race_specs.py it
+does not require access to the database (or Flask), so it can be run from a
+script, in a process pool, or under a profiler without a human at the keyboard.
+
+The entry point is simulate(race_data, params, seed), which runs one race and
+returns the results dictionary that gets written out as JSON (and uploaded to
+the race server).
+"""
+
+import math
+import random
+import re
+from datetime import datetime, timezone
+from enum import Enum
+from functools import lru_cache
+
+from buggy_race_server.lib.race_specs import BuggySpecs
+
+RESULTS_VERSION = "1.1"
+MAX_SEED = 2**32 # new seeds are less than this (but any int >= 0 will do)
+
+# these defaults are only used if there's no race file:
+# (because if there is a race file, it should contain all this information,
+# and deviating from it will (at least) generate warnings when you upload the
+# results and (at worst) create a race that doesn't match the declared race
+# -- in particular, changing cost limit or lap length from what's up on the
+# race server is going to get you into trouble
+DEFAULT_COST_LIMIT = 250
+DEFAULT_INITIAL_STEPS = 100
+DEFAULT_MORE_STEPS =  50
+DEFAULT_MAX_STEPS = 1000 # headless races don't get asked "add more steps?"
+DEFAULT_MAX_LAPS = 2
+DEFAULT_LAP_LENGTH = 464
+DEFAULT_IS_DNF_A_POSITION = True
+
+DEFAULT_REPAIR_DICE = "2d3"
+DEFAULT_ATTACK_RANGE = 2
+DEFAULT_PK_OF_KARMIC_INJURY = 42
+
+DEFAULT_PUNCTURE_MULTIPLIER = 1
+
+DEFAULT_PK_OF_PUNCTURE = {
+    "knobbly":   3 * DEFAULT_PUNCTURE_MULTIPLIER,
+    "slick":     6 * DEFAULT_PUNCTURE_MULTIPLIER,
+    "steelband": 2 * DEFAULT_PUNCTURE_MULTIPLIER,
+    "reactive":  1 * DEFAULT_PUNCTURE_MULTIPLIER,
+    "maglev":    0
+}
+
+# later... F=ma, but for now, just move like Ludo
+POWER_DATA = {
+    "bio": {
+      "delta": "3d6",
+      "rate": 0.2,
+    },
+    "electric": {
+      "delta": "3d4",
+      "rate": 0.06,
+    },
+    "fusion": {
+      "delta": "3d6",
+      "rate": 0,
+    },
+    "hamster": {
+      "delta": "1d6+2",
+      "rate": 0.3,
+    },
+    "none": {
+      "delta": "0d6",
+      "rate": 0,
+    },
+    "petrol": {
+      "delta": "3d6+2",
+      "rate": 0.2,
+    },
+    "rocket": {
+      "delta": "8d6",
+      "rate": 1,
+    },
+    "solar": {
+      "delta": "1d8",
+      "rate": 0,
+    },
+    "steam": {
+      "delta": "3d4",
+      "rate": 0.2,
+    },
+    "thermo": {
+      "delta": "5d6",
+      "rate": 0,
+    },
+    "wind": {
+      "delta": "1d10",
+      "rate": 0,
+    }
+}
+
+DICE_STR_RE = re.compile(r"(\d+)d(\d+)\+?(\d+)?")
+
+@lru_cache(maxsize=None)
+def compile_dice(dstring):
+    """ Parses a dice string like "3d6+2" once: returns (qty, faces, modifier)
+    where faces is the range of scores on one die (the qty is 0 for strings
+    that aren't dice, which always score 0)"""
+    if m := re.match(DICE_STR_RE, dstring):
+        return (int(m.group(1)), range(1, int(m.group(2)) + 1), int(m.group(3) or 0))
+    return (0, range(1, 2), 0)
+
+def roll_dice(dice, rng):
+    """ Score from compiled dice (see compile_dice): rolls all the dice in one
+    go with the rng (a random.Random, or anything with its choices method)"""
+    (qty, faces, modifier) = dice
+    if qty == 0:
+        return modifier
+    if qty == 1:
+        return modifier + rng.choices(faces)[0]
+    return modifier + sum(rng.choices(faces, k=qty))
+
+def score_from_dice(dstring, rng=random):
+    return roll_dice(compile_dice(dstring), rng)
+
+# the dice used during every step of the race, compiled up front
+POWER_DICE = {pwr: compile_dice(data["delta"]) for pwr, data in POWER_DATA.items()}
+REPAIR_DICE = compile_dice(DEFAULT_REPAIR_DICE)
+DAMAGE_DICE = compile_dice("3d6")
+DAMAGE_SLOWDOWN_DICE = compile_dice("1d2")
+HAMSTER_BOOST_DICE = compile_dice("1d6+10")
+FINISH_NUDGE_DICE = compile_dice("1d4")
+
+def get_pretty_position(n):
+    if n == 1:
+        return "FIRST PLACE"
+    elif n == 2:
+        return "SECOND PLACE"
+    elif n == 3:
+        return "THIRD PLACE"
+    if n in [11, 12, 13]:
+        suffix = "th"
+    else:
+        last_digit = n % 10
+        if last_digit == 1:
+            suffix = "st"
+        elif last_digit == 2:
+            suffix = "nd"
+        elif last_digit == 3:
+            suffix = "rd"
+        else:
+            suffix = "th"
+    return f"{n}{suffix} place"
+
+class EventType(Enum):
+    ATTACK_BIOHAZARD = "ab"
+    ATTACK_CHARGE = "ac"
+    ATTACK_FLAME = "af"
+    ATTACK_SPIKE = "as"
+    CHASSIS_FAIL = "xc"
+    FINISH = "f"
+    MESSAGE = "s" # actually "String message"
+    PUNCTURE = "p"
+
+EVENT_BY_ATTACK = {
+    "biohazard": EventType.ATTACK_BIOHAZARD,
+    "charge": EventType.ATTACK_CHARGE,
+    "flame": EventType.ATTACK_FLAME,
+    "spike": EventType.ATTACK_SPIKE
+}
+
+PK_SPIKE_VS_ARMOUR = {
+    "none":       950,
+    "wood":       800,
+    "aluminium":  600,
+    "thinsteel":  400,
+    "thicksteel": 200,
+    "titanium":   100,
+}
+
+PK_DECIDE_TO_ATTACK = {
+    "defensive": 100,
+    "steady":    300,
+    "offensive": 800,
+    "titfortat":   0,
+    "random":    500,
+    "buggy":       0
+}
+
+def pk(prob, rng): # probability in 1000
+    return rng.randint(0, 1000) < prob
+
+
+class RacingBuggy(BuggySpecs):
+
+    NO_RACE_POSITION = -1
+
+    ATTRIB_TYPES = {
+        "algo": str,
+        "antibiotic": bool,
+        "armour": str,
+        "attack": str,
+        "aux_power_type": str,
+        "aux_power_units": int,
+        "banging": bool,
+        "buggy_id": int,
+        "created_at": str, # datetime
+        "fireproof": bool,
+        "flag_color_secondary": str,
+        "flag_color": str,
+        "flag_pattern": str,
+        "hamster_booster": int,
+        "id": int,
+        "insulated": bool,
+        "mass": int,
+        "power_type": str,
+        "power_units": int,
+        "qty_attacks": int,
+        "qty_tyres": int,
+        "qty_wheels": int,
+        "total_cost": int,
+        "tyres": str,
+        "user_id": int,
+        "username": str,
+    }
+
+    def __init__(self, buggy_data):
+        for i, k in enumerate(buggy_data.keys()):
+            if k in RacingBuggy.ATTRIB_TYPES:
+                attr_type = RacingBuggy.ATTRIB_TYPES[k] # e.g., str, int, bool
+                if attr_type == str: # check value is a member
+                    kk = "power_type" if k == "aux_power_type" else k
+                    if kk in RacingBuggy.GAME_DATA: # do we have members?
+                        if buggy_data[k] not in RacingBuggy.GAME_DATA[kk]:
+                            buggy_data[k] = RacingBuggy.DEFAULTS[k]
+                try: # to cast the value to the expected type...
+                    self.__setattr__(k, attr_type(buggy_data[k]))
+                except ValueError: # missing value (or wrong format?)
+                    default = RacingBuggy.DEFAULTS.get(k)
+                    if default is None:
+                        self.__setattr__(k, attr_type()) # empty default
+                    else:
+                      self.__setattr__(k, attr_type(default))
+            else:
+                pass # debug: f"[!] key {k} not in attrib types — ignoring ({i})"
+        for k in RacingBuggy.ATTRIB_TYPES:
+            if k not in vars(self):
+                # unexpected, because we're checking that every column in present
+                # when we load CSV: this is belt-and-braces
+                raise ValueError(f"column/key \"{k}\" is missing from buggy {i}")
+        self.data = buggy_data
+        self.position = RacingBuggy.NO_RACE_POSITION
+        self.qty_good_wheels = self.qty_wheels
+        self.d = 0   # distance from start
+        self.a = 0   # acceleration
+        self.s = 0   # speed
+        self.is_on_aux = False
+        self.is_parked = False
+        self.violations = None
+        self.nom = "[" + self.username + "]"
+        # TODO maybe report if the calculations yield different results
+        #      from the values stored in the CSV?
+        self.calculate_total_cost()
+        self.calculate_mass()
+        self.damage_percent = 0
+
+    def __str__(self):
+        return f"[{self.username}]"
+
+    def result_data(self):
+        """Data for each buggy that is presented in the `results` section of
+        the JSON that is uploaded to the server."""
+
+        return {
+            "username": self.username,
+            "user_id": self.user_id,
+            "flag_color": self.flag_color,
+            "flag_color_secondary": self.flag_color_secondary,
+            "flag_pattern": self.flag_pattern,
+            "cost": self.total_cost,
+            "race_position": self.position,
+            "violations_str": ",".join(self.violations)
+        }
+
+    def power_in_use(self):
+        if self.is_parked:
+            return None
+        elif self.is_on_aux:
+            return None if self.aux_power_type == "none" else self.aux_power_type
+        else:
+            return self.power_type
+
+    def advance(self, power_in_use, rng):
+        if not self.qty_wheels:
+            return
+        good_wheel_ratio = self.qty_good_wheels / self.qty_wheels
+        delta = roll_dice(POWER_DICE[power_in_use], rng)
+        delta *= good_wheel_ratio
+        if pk(100 * self.damage_percent, rng):
+            delta = int(delta / ( 1 + roll_dice(DAMAGE_SLOWDOWN_DICE, rng)/2 ) )
+        self.d += math.ceil(delta)
+
+    def consume_power(self, rng):
+        pwr = self.power_in_use()
+        msg = None
+        if pwr is not None:
+            if BuggySpecs.POWER_TYPES[pwr]['consum']:
+                if self.power_units > 0:
+                    # have not run out of power
+                    self.power_units -= POWER_DATA[pwr]['rate'] * (rng.randint(0, 10)/50)
+                    self.advance(pwr, rng)
+                    if pwr == "hamster" and self.hamster_booster > 0 and pk(300, rng):
+                        self.d += roll_dice(HAMSTER_BOOST_DICE, rng)
+                        self.hamster_booster -= 1
+                        msg = f"employs hamster boost ({self.hamster_booster} left)"
+                    # TODO reduced mass
+                else: # have run out of power
+                    self.power_units = 0
+                    if self.is_on_aux: # no auxiliary power left, race over for this one
+                        if not self.is_parked:
+                            msg = "is out of auxillary power"
+                        self.is_parked = True
+                    elif self.aux_power_type == "none": # didn't pack any auxilliary
+                        if not self.is_parked:
+                            msg = "is out of power (and has no auxillary power)"
+                        self.is_parked = True
+                    else:
+                        self.power_units = self.aux_power_units
+                        self.is_on_aux = True
+                        msg = f"is out of {pwr} power so switches to auxillary ({self.aux_power_type})"
+            else: # non-consumable power source
+                if self.power_units > 0:
+                    self.advance(pwr, rng)
+                else:
+                    self.power_units = 0
+                    if self.is_on_aux: # no auxiliary power left, race over for this one
+                        if not self.is_parked:
+                            msg = "is out of auxillary power"
+                        self.is_parked = True
+                    elif self.aux_power_type == "none": # didn't pack any auxilliary
+                        if not self.is_parked:
+                            msg = "is out of power (and has no auxillary power)"
+                        self.is_parked = True
+        else:
+            pass # power is none
+        return msg
+
+    def suffer_puncture(self):
+        self.qty_tyres -= 1
+        if self.qty_tyres < self.qty_good_wheels:
+            self.qty_good_wheels = self.qty_tyres
+        if self.qty_tyres == 0:
+            self.is_parked = True
+
+    def suffer_attack(self, attack, rng):
+        # if attack == "biohazard":
+        #     # hamsters are the only motive power compromised by bio
+        #     if self.power_type == "hamster" and self.power_units > 0:
+        #         qty_hamsters_lost = min(self.power_units, score_from_dice("2d4"))
+        #         self.power_units = self.power_units - qty_hamsters_lost
+        #     elif self.aux_power_type == "hamster" and self.aux_power_units > 0:
+        #         qty_hamsters_lost = min(self.aux_power_units, score_from_dice("2d4"))
+        #         self.aux_power_units = self.aux_power_units - qty_hamsters_lost
+        self.damage_percent += roll_dice(DAMAGE_DICE, rng)
+        if self.damage_percent >= 100:
+            self.is_parked = True
+
+    def set_rule_violations(self, cost_limit):
+        self.violations = self.get_rule_violations(cost_limit)
+
+    @staticmethod
+    def get_json_list_of_buggies(buggies):
+        return [buggy.result_data()
+            for buggy in sorted(
+                buggies,
+                key=lambda buggy: (buggy.position, buggy.total_cost, buggy.username)
+            )
+        ]
+
+class RaceEvent():
+    def __init__(self, buggy=None, delta=None, event_type=None, msg=None):
+        self.buggy = buggy if buggy else None
+        # if delta is not None and not f"{delta}".isnumeric():
+        #     raise ValueError(f"delta is not number ({delta})")
+        self.delta = delta
+        if event_type is not None and type(event_type) is not EventType:
+            raise ValueError(f"event_type is not valid ({event_type})")
+        self.event_type = event_type.value if event_type else None
+        self.string = msg # it's 's' for string, not 'm' for message
+
+    def to_dict(self):
+        sparse_dict = {}
+        if self.buggy is not None: sparse_dict["b"] = self.buggy.username
+        if self.delta is not None: sparse_dict["d"] = self.delta
+        if self.event_type is not None: sparse_dict["e"] = self.event_type
+        if self.string is not None: sparse_dict["s"] = self.string
+        return sparse_dict
+
+    @staticmethod
+    def get_list_of_events(list_of_events):
+        return [
+            event.to_dict() for event in list_of_events
+        ]
+
+# ---------------------------------------------------------------------
+
+def clean_buggy_data(buggy_data, i=0):
+    """ Tidies one buggy's data as read from a race file or CSV (e.g., CSV
+    dumping gives empty strings for nones, and "True"/"False" for booleans)
+    and returns it: raises ValueError if a key is missing."""
+    for k in BuggySpecs.DEFAULTS:
+        if k not in buggy_data:
+            raise ValueError(f"column/key \"{k}\" is missing from CSV (buggy {i})")
+        if buggy_data[k] == '': # anomaly of CSV dumping: tidy nones
+            buggy_data[k] = None
+        if type(BuggySpecs.DEFAULTS[k]) == bool:
+            if type(buggy_data[k]) != bool:
+                buggy_data[k] = str(buggy_data[k]).lower() == "true"
+    return buggy_data
+
+def get_race_params(race_data, **overrides):
+    """ Returns the parameters for running a race, taken from the race data
+    (i.e., what was in the race file) where it has them, and otherwise from
+    the defaults. Any overrides that are not None win. This is what the
+    interactive runner offers as defaults at its prompts."""
+    lap_length = race_data.get("lap_length") or race_data.get("svg_path_length") or DEFAULT_LAP_LENGTH
+    is_dnf_position = race_data.get("is_dnf_position")
+    params = {
+        "cost_limit": race_data.get("cost_limit") or DEFAULT_COST_LIMIT,
+        "max_laps": race_data.get("max_laps") or DEFAULT_MAX_LAPS,
+        "lap_length": lap_length,
+        "svg_path_length": race_data.get("svg_path_length") or lap_length,
+        "is_dnf_position": DEFAULT_IS_DNF_A_POSITION if is_dnf_position is None else bool(is_dnf_position),
+        "initial_steps": DEFAULT_INITIAL_STEPS,
+        "more_steps": DEFAULT_MORE_STEPS,
+        "max_steps": DEFAULT_MAX_STEPS,
+    }
+    for name, value in overrides.items():
+        if name not in params:
+            raise ValueError(f"unknown race parameter \"{name}\"")
+        if value is not None:
+            params[name] = value
+    return params
+
+def get_puncture_msg(qty_good_wheels, qty_wheels, type="puncture"):
+    if qty_good_wheels == 0:
+        punc_str = "no tyres left: parked"
+    else:
+        punc_str = "use spare: still" if qty_good_wheels == qty_wheels else "now"
+        punc_str += f" running on {qty_good_wheels} of {qty_wheels} wheels"
+    return f"{type}! {punc_str}"
+
+def report_puncture(racelog, buggy, type="puncture"):
+    racelog(
+        buggy=buggy,
+        event_type=EventType.PUNCTURE,
+        msg=get_puncture_msg(buggy.qty_good_wheels, buggy.qty_wheels, type)
+    )
+
+def scrutineer(buggies_entered, cost_limit, say):
+    """ Checks the race rules and returns the buggies that may start (with
+    their position set to 0): the others keep NO_RACE_POSITION"""
+    say("[ ] Scrutineering: checking race rules...")
+    qty_violators = 0
+    buggies = []
+    for buggy in buggies_entered:
+        try:
+            buggy.set_rule_violations(cost_limit)
+        except ValueError as e:
+            say(f"[!] cost problem: {e}")
+            continue
+        if buggy.violations:
+            qty_violators += 1
+            say(f"[ ]    {buggy.nom} {buggy.qty_wheels}×o ({buggy.qty_tyres}) {buggy.flag_color} cost={buggy.total_cost}")
+            say(f"[-]        violates: {'+'.join(buggy.violations)}")
+        else:
+            buggy.position = 0
+            buggies.append(buggy)
+    say(f"[*] {qty_violators} buggies are excluded due to race rule violations")
+    say(f"[ ] next: {len(buggies)} buggies ready to start the race:")
+    say("[ ]       " + ", ".join([b.username for b in buggies]))
+    return buggies
+
+def get_new_seed():
+    """ A seed for a race that wasn't given one: it's recorded in the results,
+    so the race can still be re-run"""
+    return random.SystemRandom().randrange(MAX_SEED)
+
+def get_results(race_data, params, raced_at, buggies_entered, qty_started, qty_finished, events, seed):
+    """ The results dictionary (ready to be dumped as JSON) once the race
+    has been run: events is a list (one per step) of lists of event dicts"""
+    return {
+      "race_file_url": race_data.get("race_file_url") or "",
+      "title": race_data.get("title") or "",
+      "description": race_data.get("description") or "",
+      "cost_limit": params["cost_limit"],
+      "max_laps": params["max_laps"],
+      "track_image_url": race_data.get("track_image_url") or "",
+      "track_svg_url": race_data.get("track_svg_url") or "",
+      "svg_path_length": params["svg_path_length"],
+      "lap_length": params["lap_length"],
+      "league": race_data.get("league"),
+      "start_at": race_data.get("start_at") or "",
+      "raced_at": raced_at,
+      "is_dnf_position": params["is_dnf_position"],
+      "buggies_entered": len(buggies_entered),
+      "buggies_started": qty_started,
+      "buggies_finished": qty_finished,
+      "buggies": RacingBuggy.get_json_list_of_buggies(buggies_entered),
+      "events": events,
+      "seed": seed,
+      "version": RESULTS_VERSION
+    }
+
+def simulate(race_data, params, seed=None, log=None, confirm_start=None, want_more_steps=None, want_events=True):
+    """ Runs one race and returns the results (as a dictionary, ready to be
+    dumped as JSON), or None if the start was not confirmed.
+
+      race_data: as read from the race file; race_data["buggies"] is a list
+                 of buggy data dicts (see clean_buggy_data): RacingBuggy
+                 objects are made fresh from these, so the same race data
+                 can be run again and again
+      params: see get_race_params
+      seed: the race's random number generator is seeded with this (if it's
+            None, a new seed is picked): the seed is in the results, and
+            running the same race data with the same seed and params gives
+            the same race (events and all)
+      log: if not None, called with each line of commentary (e.g., print)
+      confirm_start: if not None, called with the list of buggies that passed
+            scrutineering: if it returns False, the race does not start
+      want_more_steps: if not None, called with the number of steps so far
+            when the race reaches its maximum number of steps but buggies
+            are still moving: returns number of steps to add (0 to stop).
+            Otherwise more_steps are added until max_steps is reached.
+      want_events: if False, the results' events are left empty (e.g., when
+            running lots of races and only the positions matter)
+    """
+    if seed is None:
+        seed = get_new_seed()
+    rng = random.Random(seed)
+
+    def say(msg):
+        if log is not None:
+            log(msg)
+
+    cost_limit = params["cost_limit"]
+    max_laps = params["max_laps"]
+    lap_length = params["lap_length"]
+    is_dnf_a_position = params["is_dnf_position"]
+
+    buggies_entered = [
+        RacingBuggy(dict(buggy_data)) for buggy_data in race_data.get("buggies") or []
+    ]
+    events = [] # into here goes one array for each step
+    events_this_step = []
+    next_finisher_position = 1
+    finishers_this_step = 0
+    steps = 0
+
+    def racelog(**kwargs):
+        if log is None and not want_events:
+            return
+        ev = RaceEvent(**kwargs)
+        if log is not None:
+            buggy_id = ev.buggy.username if ev.buggy else ""
+            show_delta = f"delta: {ev.delta}" if ev.delta else ""
+            log(f"[.] {steps:=5} [{buggy_id}] {show_delta} {ev.string or ''}")
+        if want_events:
+            events_this_step.append(ev)
+
+    say(f"[ ] buggies entered for this race: {len(buggies_entered)}")
+    pretty_race_length = f"{max_laps} lap race"
+    race_start_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    buggies = scrutineer(buggies_entered, cost_limit, say)
+    finishers = []
+    non_finishers = []
+    if len(buggies) == 0:
+        say("[!] looks like this race may need to be abandoned because nobody entered it")
+    else:
+        if confirm_start is not None and not confirm_start(buggies):
+            return None
+        max_steps = params["initial_steps"]
+        qty_attacks_launched = 0
+        while steps < max_steps:
+            events_this_step = []
+            next_finisher_position += finishers_this_step # 2 buggies tie, next one is 3rd
+            finishers_this_step = 0
+            steps += 1
+            say(f"------------------------ step {steps} ------------------------")
+
+            if steps > 1: # no fighting on the start line, it's unsporting
+                # calculate attacks:
+                # doing this before anyone has moved: now we calculate
+                # proximity (caculating attacks during the move loop is unfair
+                # on buggies early/late in the move cycle)
+                # Shufffle the order of the buggies to prevent advantage to
+                # earlier (because a parked buggy won't attack so the order of
+                # attack matters )
+                rng.shuffle(buggies)
+                for buggy in [b for b in buggies if b.qty_attacks > 0 and not b.is_parked]:
+                    if buggy.attack is None or buggy.attack == 'none':
+                        continue
+                    attack_range = DEFAULT_ATTACK_RANGE
+                    targets = []
+                    for target in buggies:
+                        proximity = abs(target.d - buggy.d)
+                        if target != buggy and proximity <= attack_range:
+                            targets.append(target)
+                    if targets:
+                        rng.shuffle(targets)
+                        target = targets[0]
+                        proximity = abs(target.d - buggy.d)
+                        racelog(
+                            buggy=buggy,
+                            event_type=EVENT_BY_ATTACK[buggy.attack],
+                            msg=f"attacks {target} with {buggy.attack}"
+                        )
+                        if buggy.attack == "spike":
+                            pretty_armour = ""
+                            if target.armour != "none":
+                                pretty_armour = f" through {target.armour}"
+                            if pk(PK_SPIKE_VS_ARMOUR[target.armour], rng):
+                                if pk(target.qty_good_wheels * 100, rng) and pk(100 * DEFAULT_PK_OF_PUNCTURE[target.tyres], rng):
+                                    target.suffer_puncture()
+                                    report_puncture(racelog, target, f"spike puncture{pretty_armour}")
+                                else:
+                                    target.suffer_attack(buggy.attack, rng)
+                                    racelog(
+                                        buggy=target,
+                                        event_type=EventType.MESSAGE,
+                                        msg=f"now at {target.damage_percent}% damage"
+                                    )
+                            else:
+                                if target.armour != "none":
+                                    pretty_armour = f"{target.armour} "
+                                racelog(
+                                    buggy=target,
+                                    event_type=EventType.MESSAGE,
+                                    msg=f"{pretty_armour} repels {buggy}'s attack"
+                                )
+                        else: # buggy attack is not-spike
+                            if pk(DEFAULT_PK_OF_KARMIC_INJURY, rng):
+                                buggy.suffer_attack(buggy.attack, rng)
+                                racelog(
+                                    buggy=buggy,
+                                    event_type=EventType.MESSAGE,
+                                    msg=f"suffers karmic self-injury: now {buggy.damage_percent}% damage"
+                                )
+                            else:
+                                defence = BuggySpecs.ATTACK_DEFENCES.get(buggy.attack)
+                                if getattr(target, defence):
+                                    racelog(
+                                        buggy=target,
+                                        event_type=EventType.MESSAGE,
+                                        msg=f"{defence}: immune to {buggy}'s {buggy.attack}"
+                                    )
+                                else:
+                                    target.suffer_attack(buggy.attack, rng)
+                                    racelog(
+                                        buggy=target,
+                                        event_type=EventType.MESSAGE,
+                                        msg=f"now at {target.damage_percent}% damage"
+                                    )
+                        buggy.qty_attacks -= 1
+                        qty_attacks_launched += 1
+                        if buggy.qty_attacks == 0:
+                            racelog(
+                                buggy=buggy,
+                                event_type=EventType.MESSAGE,
+                                msg="has no attacks left"
+                            )
+                        if target.algo == "titfortat":
+                            target.algo == "offensive"
+                            racelog(
+                                buggy=target,
+                                event_type=EventType.MESSAGE,
+                                msg="titfortat algo switched to offensive"
+                            )
+
+            qty_active = 0
+            for buggy in buggies:
+                if buggy.damage_percent > 0:
+                    buggy.damage_percent = max(0, buggy.damage_percent - roll_dice(REPAIR_DICE, rng))
+                    if buggy.damage_percent == 0:
+                        racelog(
+                            buggy=buggy,
+                            event_type=EventType.MESSAGE,
+                            msg="all damage repaired"
+                        )
+                if not buggy.is_parked:
+                    delta = 0
+                    qty_active += 1
+                    if pk(1, rng) and pk(buggy.mass/buggy.qty_wheels, rng):
+                        racelog(
+                            buggy=buggy,
+                            event_type=EventType.CHASSIS_FAIL,
+                            msg="catastrophic chassis failure: buggy breaks."
+                        )
+                        buggy.is_parked = True
+                    else:
+                        power = buggy.power_in_use()
+                        if power is not None:
+                            distance_before = buggy.d
+                            if msg := buggy.consume_power(rng):
+                                racelog(buggy=buggy, msg=msg)
+                            delta = buggy.d - distance_before
+                            if (delta):
+                                racelog(buggy=buggy, delta=delta)
+                        else:
+                            racelog(
+                                buggy=buggy,
+                                msg=f"ran out of {power} power"
+                            )
+                    if delta and pk(DEFAULT_PK_OF_PUNCTURE[buggy.tyres] * buggy.qty_good_wheels, rng):
+                        buggy.suffer_puncture()
+                        report_puncture(racelog, buggy)
+                        #   ? risk of primary power fail?
+                    if max_laps and buggy.d // lap_length >= max_laps:
+                        buggy.is_parked = True
+                        finishers_this_step += 1
+                        buggy.position = next_finisher_position
+                        position_str = get_pretty_position(next_finisher_position)
+                        finishers.append(buggy)
+                        if finishers_this_step > 1:
+                            position_str = f"tied {position_str}"
+                            # whoever crossed first this step didn't know it was a tie
+                            for ev in events_this_step:
+                                if ev.event_type == EventType.FINISH.value:
+                                    ev.string = f"crosses the finish line in {position_str} ({pretty_race_length})"
+                        racelog(
+                            buggy=buggy,
+                            event_type=EventType.FINISH,
+                            msg=f"crosses the finish line in {position_str} ({pretty_race_length})"
+                        )
+                        buggy.d += 4 + roll_dice(FINISH_NUDGE_DICE, rng) # nudge over line
+                else:
+                    pass # buggy is parked
+
+            if qty_active == 0:
+                say("[ ] no buggies moving...")
+                break
+            else:
+                if steps == max_steps:
+                    if want_more_steps is not None:
+                        more_steps = want_more_steps(steps)
+                    else:
+                        more_steps = min(params["more_steps"], params["max_steps"] - steps)
+                    if more_steps > 0:
+                        say(f"[+] running race for another +{more_steps} steps")
+                        max_steps += more_steps
+                    else:
+                        say("[-] no more steps, time is up")
+            if want_events:
+                events.append(events_this_step)
+        say(f"[ ] attacks launched in that race: {qty_attacks_launched}")
+        say(f"[:] race ends after {steps} steps")
+        non_finishers = sorted(
+            [buggy for buggy in buggies if buggy.position == 0 ],
+            key=lambda buggy: buggy.d,
+            reverse=True
+        )
+        if is_dnf_a_position:
+            for buggy in non_finishers:
+                buggy.position = next_finisher_position
+                next_finisher_position += 1
+
+    return get_results(
+        race_data,
+        params,
+        race_start_at,
+        buggies_entered,
+        len(buggies),
+        len(finishers),
+        [RaceEvent.get_list_of_events(events_in_step) for events_in_step in events],
+        seed,
+    )
+
+def get_podium(results):
+    """ Returns list of (buggy result, is_finisher) for the buggies in the
+    results that got a position, in order: finishers always come before
+    the did-not-finishers (which only get positions if DNF is a position)"""
+    placed = sorted(
+        [b for b in results["buggies"] if b["race_position"] > 0],
+        key=lambda b: b["race_position"]
+    )
+    qty_finished = results["buggies_finished"]
+    return [(b, i < qty_finished) for i, b in enumerate(placed)]
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""Race engine with the buggies' state held in NumPy arrays.
+
+This runs the same race as race_engine.simulate (same rules, same
+probabilities, same results and events format) but each step works on whole
+arrays of buggies at once instead of looping over RacingBuggy objects: dice
+are rolled in batches (one call per power type per step) and attack targets
+are found by searching the buggies sorted by distance instead of checking
+every pair of buggies. It's worth it for big fields (a whole cohort, lots of
+laps) and for sweeps: for a handful of buggies the plain engine is fine.
+
+The random numbers are drawn in a different order from race_engine's, so a
+seed gives a different (but statistically equivalent) race here.
+
+NumPy is not in the server's requirements: this module is only imported if
+it's asked for (e.g., run-buggy-race.py --engine numpy).
+"""
+
+from datetime import datetime, timezone
+
+import numpy as np
+
+from buggy_race_server.lib.race_engine import (
+    DAMAGE_DICE,
+    DAMAGE_SLOWDOWN_DICE,
+    DEFAULT_ATTACK_RANGE,
+    DEFAULT_PK_OF_KARMIC_INJURY,
+    DEFAULT_PK_OF_PUNCTURE,
+    EVENT_BY_ATTACK,
+    FINISH_NUDGE_DICE,
+    HAMSTER_BOOST_DICE,
+    PK_SPIKE_VS_ARMOUR,
+    POWER_DATA,
+    POWER_DICE,
+    REPAIR_DICE,
+    EventType,
+    RacingBuggy,
+    get_new_seed,
+    get_pretty_position,
+    get_puncture_msg,
+    get_results,
+    scrutineer,
+)
+from buggy_race_server.lib.race_specs import BuggySpecs
+
+POWER_NAMES = list(POWER_DATA)
+NO_POWER = POWER_NAMES.index("none")
+HAMSTER = POWER_NAMES.index("hamster")
+TYRE_NAMES = list(DEFAULT_PK_OF_PUNCTURE)
+
+POWER_DICE_BY_CODE = [POWER_DICE[pwr] for pwr in POWER_NAMES]
+POWER_RATE = np.array([POWER_DATA[pwr]["rate"] for pwr in POWER_NAMES])
+POWER_IS_CONSUMABLE = np.array([BuggySpecs.POWER_TYPES[pwr]["consum"] for pwr in POWER_NAMES])
+PK_OF_PUNCTURE = np.array([DEFAULT_PK_OF_PUNCTURE[tyres] for tyres in TYRE_NAMES])
+
+
+class RaceField():
+    """The state of every buggy that started the race, as arrays (so buggy i
+    is buggies[i], and its distance is d[i], and so on)"""
+
+    def __init__(self, buggies):
+        def column(attr, dtype=np.int64):
+            return np.array([getattr(b, attr) for b in buggies], dtype=dtype)
+
+        def codes(attr, names):
+            return np.array([names.index(getattr(b, attr)) for b in buggies], dtype=np.int64)
+
+        self.buggies = buggies
+        self.usernames = [b.username for b in buggies]
+        self.d = np.zeros(len(buggies), dtype=np.int64)
+        self.position = np.zeros(len(buggies), dtype=np.int64)
+        self.is_parked = np.zeros(len(buggies), dtype=bool)
+        self.is_on_aux = np.zeros(len(buggies), dtype=bool)
+        self.damage_percent = np.zeros(len(buggies), dtype=np.int64)
+        self.power_units = column("power_units", np.float64)
+        self.aux_power_units = column("aux_power_units")
+        self.power_type = codes("power_type", POWER_NAMES)
+        self.aux_power_type = codes("aux_power_type", POWER_NAMES)
+        self.qty_wheels = column("qty_wheels")
+        self.qty_good_wheels = column("qty_wheels")
+        self.qty_tyres = column("qty_tyres")
+        self.tyres = codes("tyres", TYRE_NAMES)
+        self.mass = column("mass", np.float64)
+        self.hamster_booster = column("hamster_booster")
+        self.qty_attacks = column("qty_attacks")
+        self.can_attack = np.array([b.attack not in (None, "none") for b in buggies], dtype=bool)
+
+    def power_in_use(self):
+        """ Power type code for each buggy (ignores parking) """
+        return np.where(self.is_on_aux, self.aux_power_type, self.power_type)
+
+
+def simulate(race_data, params, seed=None, log=None, confirm_start=None, want_more_steps=None, want_events=True):
+    """ Runs one race and returns the results: the arguments and results are
+    the same as for race_engine.simulate"""
+    if seed is None:
+        seed = get_new_seed()
+    rng = np.random.default_rng(seed)
+
+    def say(msg):
+        if log is not None:
+            log(msg)
+
+    def pk(prob): # probability in 1000: prob can be an array
+        return rng.integers(0, 1001, size=np.shape(prob)) < prob
+
+    def roll(dice, qty): # dice are compiled by race_engine.compile_dice
+        (qty_dice, faces, modifier) = dice
+        if qty_dice == 0:
+            return np.full(qty, modifier, dtype=np.int64)
+        return rng.integers(faces.start, faces.stop, size=(qty, qty_dice)).sum(axis=1) + modifier
+
+    cost_limit = params["cost_limit"]
+    max_laps = params["max_laps"]
+    lap_length = params["lap_length"]
+
+    buggies_entered = [
+        RacingBuggy(dict(buggy_data)) for buggy_data in race_data.get("buggies") or []
+    ]
+    events = []
+    events_this_step = []
+    next_finisher_position = 1
+    qty_finished = 0
+    steps = 0
+
+    def racelog(i=None, delta=None, event_type=None, msg=None):
+        if log is None and not want_events:
+            return
+        event = {}
+        if i is not None: event["b"] = field.usernames[i]
+        if delta is not None: event["d"] = delta
+        if event_type is not None: event["e"] = event_type.value
+        if msg is not None: event["s"] = msg
+        if log is not None:
+            buggy_id = event.get("b", "")
+            show_delta = f"delta: {delta}" if delta else ""
+            log(f"[.] {steps:=5} [{buggy_id}] {show_delta} {msg or ''}")
+        if want_events:
+            events_this_step.append(event)
+
+    def suffer_attack(i):
+        field.damage_percent[i] += roll(DAMAGE_DICE, 1)[0]
+        if field.damage_percent[i] >= 100:
+            field.is_parked[i] = True
+
+    def suffer_punctures(punctured, type):
+        field.qty_tyres[punctured] -= 1
+        field.qty_good_wheels[punctured] = np.minimum(field.qty_good_wheels[punctured], field.qty_tyres[punctured])
+        field.is_parked[punctured[field.qty_tyres[punctured] == 0]] = True
+        for i in punctured.tolist():
+            racelog(
+                i,
+                event_type=EventType.PUNCTURE,
+                msg=get_puncture_msg(int(field.qty_good_wheels[i]), int(field.qty_wheels[i]), type)
+            )
+
+    def run_attacks():
+        attackers = np.flatnonzero((field.qty_attacks > 0) & ~field.is_parked & field.can_attack)
+        if len(attackers) == 0:
+            return 0
+        # attacks don't move anyone, so the distances can be sorted once:
+        # each attacker's targets are within a window of the sorted list
+        by_distance = np.argsort(field.d, kind="stable")
+        sorted_d = field.d[by_distance]
+        window_starts = np.searchsorted(sorted_d, field.d[attackers] - DEFAULT_ATTACK_RANGE, side="left")
+        window_ends = np.searchsorted(sorted_d, field.d[attackers] + DEFAULT_ATTACK_RANGE, side="right")
+        qty_launched = 0
+        for j in rng.permutation(len(attackers)).tolist():
+            i = int(attackers[j])
+            targets = by_distance[window_starts[j]:window_ends[j]]
+            targets = targets[targets != i]
+            if len(targets) == 0:
+                continue
+            t = int(targets[rng.integers(len(targets))])
+            buggy = field.buggies[i]
+            target = field.buggies[t]
+            racelog(
+                i,
+                event_type=EVENT_BY_ATTACK[buggy.attack],
+                msg=f"attacks {target} with {buggy.attack}"
+            )
+            if buggy.attack == "spike":
+                pretty_armour = ""
+                if target.armour != "none":
+                    pretty_armour = f" through {target.armour}"
+                if pk(PK_SPIKE_VS_ARMOUR[target.armour]):
+                    if pk(field.qty_good_wheels[t] * 100) and pk(100 * DEFAULT_PK_OF_PUNCTURE[target.tyres]):
+                        suffer_punctures(np.array([t]), f"spike puncture{pretty_armour}")
+                    else:
+                        suffer_attack(t)
+                        racelog(t, event_type=EventType.MESSAGE, msg=f"now at {field.damage_percent[t]}% damage")
+                else:
+                    if target.armour != "none":
+                        pretty_armour = f"{target.armour} "
+                    racelog(t, event_type=EventType.MESSAGE, msg=f"{pretty_armour} repels {buggy}'s attack")
+            else: # buggy attack is not-spike
+                if pk(DEFAULT_PK_OF_KARMIC_INJURY):
+                    suffer_attack(i)
+                    racelog(
+                        i,
+                        event_type=EventType.MESSAGE,
+                        msg=f"suffers karmic self-injury: now {field.damage_percent[i]}% damage"
+                    )
+                else:
+                    defence = BuggySpecs.ATTACK_DEFENCES.get(buggy.attack)
+                    if getattr(target, defence):
+                        racelog(t, event_type=EventType.MESSAGE, msg=f"{defence}: immune to {buggy}'s {buggy.attack}")
+                    else:
+                        suffer_attack(t)
+                        racelog(t, event_type=EventType.MESSAGE, msg=f"now at {field.damage_percent[t]}% damage")
+            field.qty_attacks[i] -= 1
+            qty_launched += 1
+            if field.qty_attacks[i] == 0:
+                racelog(i, event_type=EventType.MESSAGE, msg="has no attacks left")
+            if target.algo == "titfortat": # (algos don't do anything yet)
+                racelog(t, event_type=EventType.MESSAGE, msg="titfortat algo switched to offensive")
+        return qty_launched
+
+    def run_repairs():
+        damaged = np.flatnonzero(field.damage_percent > 0)
+        if len(damaged):
+            field.damage_percent[damaged] = np.maximum(
+                0, field.damage_percent[damaged] - roll(REPAIR_DICE, len(damaged))
+            )
+            for i in damaged[field.damage_percent[damaged] == 0].tolist():
+                racelog(i, event_type=EventType.MESSAGE, msg="all damage repaired")
+
+    def run_moves(active):
+        """ Moves every active buggy: returns the distance each one moved """
+        distance_before = field.d.copy()
+        is_failing = np.zeros(len(field.d), dtype=bool)
+        is_failing[active] = pk(np.ones(len(active))) & pk(field.mass[active] / field.qty_wheels[active])
+        for i in np.flatnonzero(is_failing).tolist():
+            racelog(i, event_type=EventType.CHASSIS_FAIL, msg="catastrophic chassis failure: buggy breaks.")
+        field.is_parked |= is_failing
+        movers = active[~is_failing[active]]
+        power = field.power_in_use()[movers]
+        is_powerless = power == NO_POWER # only happens on aux, because "none" primary power isn't legal
+        for i in movers[is_powerless].tolist():
+            racelog(i, msg="ran out of None power")
+        movers, power = movers[~is_powerless], power[~is_powerless]
+
+        has_power = field.power_units[movers] > 0
+        goers, goer_power = movers[has_power], power[has_power]
+        is_consumable = POWER_IS_CONSUMABLE[goer_power]
+        field.power_units[goers[is_consumable]] -= (
+            POWER_RATE[goer_power[is_consumable]] * (rng.integers(0, 11, size=is_consumable.sum()) / 50)
+        )
+        # advance: one batch of dice for each type of power in use
+        dice_scores = np.zeros(len(goers), dtype=np.int64)
+        for pwr in np.unique(goer_power).tolist():
+            is_pwr = goer_power == pwr
+            dice_scores[is_pwr] = roll(POWER_DICE_BY_CODE[pwr], is_pwr.sum())
+        qty_wheels = field.qty_wheels[goers]
+        has_wheels = qty_wheels > 0
+        delta = dice_scores * (field.qty_good_wheels[goers] / np.where(has_wheels, qty_wheels, 1))
+        is_hurt = pk(100 * field.damage_percent[goers])
+        delta[is_hurt] = np.trunc(delta[is_hurt] / (1 + roll(DAMAGE_SLOWDOWN_DICE, is_hurt.sum()) / 2))
+        field.d[goers[has_wheels]] += np.ceil(delta[has_wheels]).astype(np.int64)
+
+        is_boosting = is_consumable & (goer_power == HAMSTER) & (field.hamster_booster[goers] > 0)
+        boosters = goers[is_boosting]
+        boosters = boosters[pk(np.full(len(boosters), 300))]
+        field.d[boosters] += roll(HAMSTER_BOOST_DICE, len(boosters))
+        field.hamster_booster[boosters] -= 1
+
+        # messages come before the move (as they do in race_engine)
+        messages = {i: f"employs hamster boost ({field.hamster_booster[i]} left)" for i in boosters.tolist()}
+        empties, empty_power = movers[~has_power], power[~has_power]
+        field.power_units[empties] = 0
+        for i, pwr in zip(empties.tolist(), empty_power.tolist()):
+            if field.is_on_aux[i]: # no auxiliary power left, race over for this one
+                messages[i] = "is out of auxillary power"
+                field.is_parked[i] = True
+            elif field.aux_power_type[i] == NO_POWER: # didn't pack any auxilliary
+                messages[i] = "is out of power (and has no auxillary power)"
+                field.is_parked[i] = True
+            elif POWER_IS_CONSUMABLE[pwr]:
+                field.power_units[i] = field.aux_power_units[i]
+                field.is_on_aux[i] = True
+                messages[i] = (
+                    f"is out of {POWER_NAMES[pwr]} power so switches "
+                    f"to auxillary ({POWER_NAMES[field.aux_power_type[i]]})"
+                )
+        for i, msg in messages.items():
+            racelog(i, msg=msg)
+        return field.d - distance_before
+
+    say(f"[ ] buggies entered for this race: {len(buggies_entered)}")
+    pretty_race_length = f"{max_laps} lap race"
+    race_start_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    buggies = scrutineer(buggies_entered, cost_limit, say)
+    field = RaceField(buggies)
+    if len(buggies) == 0:
+        say("[!] looks like this race may need to be abandoned because nobody entered it")
+    else:
+        if confirm_start is not None and not confirm_start(buggies):
+            return None
+        max_steps = params["initial_steps"]
+        qty_attacks_launched = 0
+        while steps < max_steps:
+            events_this_step = []
+            steps += 1
+            say(f"------------------------ step {steps} ------------------------")
+            if steps > 1: # no fighting on the start line, it's unsporting
+                qty_attacks_launched += run_attacks()
+            run_repairs()
+            active = np.flatnonzero(~field.is_parked)
+            if len(active):
+                delta = run_moves(active)
+                movers = active[delta[active] != 0]
+                for i in movers.tolist():
+                    racelog(i, delta=int(delta[i]))
+                punctured = movers[
+                    pk(PK_OF_PUNCTURE[field.tyres[movers]] * field.qty_good_wheels[movers])
+                ]
+                suffer_punctures(punctured, "puncture")
+                if max_laps:
+                    finishers = active[field.d[active] // lap_length >= max_laps]
+                    field.is_parked[finishers] = True
+                    field.position[finishers] = next_finisher_position
+                    position_str = get_pretty_position(next_finisher_position)
+                    if len(finishers) > 1:
+                        position_str = f"tied {position_str}" # all of them, not just the 2nd on
+                    for i in finishers.tolist():
+                        racelog(
+                            i,
+                            event_type=EventType.FINISH,
+                            msg=f"crosses the finish line in {position_str} ({pretty_race_length})"
+                        )
+                    field.d[finishers] += 4 + roll(FINISH_NUDGE_DICE, len(finishers)) # nudge over line
+                    qty_finished += len(finishers)
+                    next_finisher_position += len(finishers) # 2 buggies tie, next one is 3rd
+            if len(active) == 0:
+                say("[ ] no buggies moving...")
+                break
+            else:
+                if steps == max_steps:
+                    if want_more_steps is not None:
+                        more_steps = want_more_steps(steps)
+                    else:
+                        more_steps = min(params["more_steps"], params["max_steps"] - steps)
+                    if more_steps > 0:
+                        say(f"[+] running race for another +{more_steps} steps")
+                        max_steps += more_steps
+                    else:
+                        say("[-] no more steps, time is up")
+            if want_events:
+                events.append(events_this_step)
+        say(f"[ ] attacks launched in that race: {qty_attacks_launched}")
+        say(f"[:] race ends after {steps} steps")
+        if params["is_dnf_position"]:
+            # furthest first (race_engine breaks ties by the shuffled order
+            # of the buggies: here it's a random permutation)
+            non_finishers = np.flatnonzero(field.position == 0)
+            tie_breaker = rng.permutation(len(non_finishers))
+            non_finishers = non_finishers[np.lexsort((tie_breaker, -field.d[non_finishers]))]
+            field.position[non_finishers] = np.arange(len(non_finishers)) + next_finisher_position
+        for buggy, position in zip(buggies, field.position.tolist()):
+            buggy.position = position
+
+    return get_results(race_data, params, race_start_at, buggies_entered, len(buggies), qty_finished, events, seed)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Race event logs: the events in race results, in either of two formats.
+
+The original ("list") format is a list with one item per step, each a list
+of sparse event dicts (see race_engine.RaceEvent.to_dict):
+
+    [[{"b": "ada", "d": 12}, {"b": "chaz", "e": "f", "s": "crosses..."}], ...]
+
+The compact format is a dict with tables of usernames, event types and
+strings, and one flat list of integers per step: four for each event,
+(buggy index, event type index, delta, string index), where a buggy, event
+type or string that's missing is -1 (and a missing delta is 0):
+
+    {
+      "compact": 1,
+      "buggies": ["ada", "chaz"],
+      "types": ["ab", "ac", ...],
+      "strings": ["crosses...", ...],
+      "steps": [[0, -1, 12, -1, 1, 5, 0, 0], ...]
+    }
+
+Most of a big race's log is deltas, and messages repeat a lot, so this is
+a fraction of the size (and compresses better too). The player and the
+server accept either: use expand_events to get the list format back.
+
+Like race_engine, this doesn't need Flask or the database.
+"""
+
+import gzip
+import io
+import json
+import zlib
+
+from buggy_race_server.lib.json_stream import (
+    JsonStreamReader,
+    RawJSON,
+    dumps_with_raw,
+    iter_raw_items,
+    read_raw,
+)
+from buggy_race_server.lib.race_engine import EventType
+
+COMPACT_EVENTS_VERSION = 1
+COMPACT_EVENT_WIDTH = 4 # integers per event
+DEFAULT_STEPS_PER_CHUNK = 50
+NONE_INDEX = -1
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def is_compact_events(events):
+    return isinstance(events, dict) and "compact" in events
+
+def compact_events(events):
+    """ Returns the compact form of a list-format event log (if the events
+    are already compact, they are returned as they are)"""
+    if is_compact_events(events):
+        return events
+    buggy_indexes = {}
+    string_indexes = {}
+    type_indexes = {event_type.value: i for i, event_type in enumerate(EventType)}
+
+    def index_of(table, value):
+        if value is None:
+            return NONE_INDEX
+        if value not in table:
+            table[value] = len(table)
+        return table[value]
+
+    steps = []
+    for events_in_step in events or []:
+        step = []
+        for event in events_in_step:
+            step.extend((
+                index_of(buggy_indexes, event.get("b")),
+                type_indexes[event["e"]] if "e" in event else NONE_INDEX,
+                event.get("d") or 0,
+                index_of(string_indexes, event.get("s")),
+            ))
+        steps.append(step)
+    return {
+        "compact": COMPACT_EVENTS_VERSION,
+        "buggies": list(buggy_indexes),
+        "types": list(type_indexes),
+        "strings": list(string_indexes),
+        "steps": steps,
+    }
+
+def check_compact_events(events):
+    """ Raises ValueError if the compact events can't be read"""
+    version = events.get("compact")
+    if version != COMPACT_EVENTS_VERSION:
+        raise ValueError(f"unknown version of compact event log ({version})")
+    for key in ("buggies", "types", "strings", "steps"):
+        if not isinstance(events.get(key), (list, RawJSON)):
+            raise ValueError(f"compact event log is missing its \"{key}\" list")
+    if isinstance(events["steps"], RawJSON):
+        return # steps that weren't parsed (see load_results_stream)
+    for i, step in enumerate(events["steps"]):
+        if len(step) % COMPACT_EVENT_WIDTH:
+            raise ValueError(f"compact event log has a broken step ({i})")
+
+def iter_parsed_steps(steps):
+    """ Yields the steps of a raw event log one at a time, parsed: the raw
+    text was only scanned (to find where each step ends), so this is where
+    anything that isn't valid JSON is found. Only one step is parsed at a
+    time, so a long race still doesn't need all its events in memory."""
+    for i, step in enumerate(iter_raw_items(steps)):
+        try:
+            yield json.loads(step)
+        except ValueError as e:
+            raise ValueError(f"event log has a step that isn't valid JSON ({i}): {e}")
+
+def check_events(events):
+    """ Raises ValueError if the events (in either format, raw or not) aren't
+    an event log whose steps are lists: no events at all (None) is fine.
+    Raw steps are parsed (one at a time) to check they are valid JSON,
+    because they are stored and served as they are (see load_results_stream)."""
+    if events is None:
+        return
+    is_compact = is_compact_events(events)
+    if is_compact:
+        check_compact_events(events)
+        steps = events["steps"]
+    elif isinstance(events, (list, RawJSON)):
+        steps = events
+    else:
+        raise ValueError("event log must be a list of steps (or a compact event log)")
+    if isinstance(steps, RawJSON):
+        steps = iter_parsed_steps(steps)
+    for i, step in enumerate(steps):
+        if not isinstance(step, list):
+            raise ValueError(f"event log has a step that isn't a list ({i})")
+        if is_compact and len(step) % COMPACT_EVENT_WIDTH:
+            raise ValueError(f"compact event log has a broken step ({i})")
+
+def expand_events(events):
+    """ Returns the list format of an event log (if the events are already
+    in list format, they are returned as they are)"""
+    if not is_compact_events(events):
+        return events or []
+    check_compact_events(events)
+    buggies = events["buggies"]
+    types = events["types"]
+    strings = events["strings"]
+    expanded = []
+    for step in events["steps"]:
+        events_in_step = []
+        for i in range(0, len(step), COMPACT_EVENT_WIDTH):
+            (b, e, d, s) = step[i:i + COMPACT_EVENT_WIDTH]
+            event = {}
+            if b != NONE_INDEX: event["b"] = buggies[b]
+            if d: event["d"] = d
+            if e != NONE_INDEX: event["e"] = types[e]
+            if s != NONE_INDEX: event["s"] = strings[s]
+            events_in_step.append(event)
+        expanded.append(events_in_step)
+    return expanded
+
+def dump_results(results, is_compact=False, is_gzipped=False):
+    """ Returns results as JSON (bytes if gzipped, otherwise a string): if
+    is_compact, the events are compacted and there's no indentation"""
+    if is_compact:
+        results = dict(results, events=compact_events(results.get("events")))
+        results_json = json.dumps(results, separators=(",", ":"))
+    else:
+        results_json = json.dumps(results, indent=2)
+    if is_gzipped:
+        return gzip.compress(results_json.encode("utf-8"), mtime=0)
+    return results_json
+
+def is_gzip_data(data):
+    return isinstance(data, bytes) and data[:2] == GZIP_MAGIC
+
+def load_results(data):
+    """ Returns the results (or race file) data from JSON, which may be
+    gzipped: data is bytes or a string. Raises ValueError (or one of its
+    subclasses, JSONDecodeError or UnicodeDecodeError) if it can't."""
+    if is_gzip_data(data):
+        try:
+            data = gzip.decompress(data)
+        except (OSError, EOFError, zlib.error) as e:
+            raise ValueError(f"failed to decompress gzipped data: {e}")
+    return json.loads(data)
+
+def read_events_raw(reader):
+    """ Reads an event log without parsing the events: list format events
+    are RawJSON, and compact events are a dict with RawJSON steps (so the
+    version and tables can still be checked)"""
+    if reader.peek() == "{":
+        return reader.read_object({"steps": read_raw})
+    return reader.read_raw_value()
+
+def load_results_stream(binary_file):
+    """ Returns the results data read incrementally from a (binary, seekable)
+    file, which may be gzipped: the events are not parsed but kept as JSON
+    text (see read_events_raw), so a long race doesn't need memory for a
+    Python object for every event. Use json_stream.dumps_with_raw to write
+    the results out again. Raises ValueError if the data can't be read."""
+    is_gzipped = binary_file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    binary_file.seek(0)
+    if is_gzipped:
+        binary_file = gzip.GzipFile(fileobj=binary_file)
+    reader = JsonStreamReader(io.TextIOWrapper(binary_file, encoding="utf-8"))
+    try:
+        results = reader.read_object({"events": read_events_raw})
+        reader.expect_end()
+    except (OSError, EOFError, zlib.error) as e:
+        raise ValueError(f"failed to decompress gzipped data: {e}")
+    return results
+
+def split_events(events, steps_per_chunk=DEFAULT_STEPS_PER_CHUNK):
+    """ Splits an event log (in either format, and raw or not) into chunks of
+    steps, so a replay can start before it has all of them: returns the
+    number of steps and a list of the chunks, each one an event log (as JSON
+    text) in the same format as the events were. Compact chunks each carry
+    the full tables, so they can be expanded on their own."""
+    if is_compact_events(events):
+        steps = events["steps"]
+        tables = {key: value for (key, value) in events.items() if key != "steps"}
+    else:
+        steps = events or []
+        tables = None
+    chunks = []
+    qty_steps = 0
+    chunk_steps = []
+
+    def add_chunk():
+        steps_json = RawJSON("[" + ",".join(chunk_steps) + "]")
+        if tables is None:
+            chunks.append(steps_json)
+        else:
+            chunks.append(dumps_with_raw(dict(tables, steps=steps_json)))
+
+    for step in iter_raw_items(steps):
+        chunk_steps.append(step)
+        qty_steps += 1
+        if len(chunk_steps) == steps_per_chunk:
+            add_chunk()
+            chunk_steps = []
+    if chunk_steps:
+        add_chunk()
+    return (qty_steps, chunks)
@@ -118,6 +118,21 @@ class BuggySpecs:
       'algo':                 "steady"
     }
 
+    # set column ("varchar") max lengths here: this is useful because
+    # it's actually quite fiddly to get this info back out of the model
+    # when we want to truncate user's input
+    STRING_COL_LENGTH = {
+        "algo": 16,
+        "armour": 16,
+        "attack": 16,
+        "aux_power_type": 16,
+        "flag_color_secondary": 32,
+        "flag_color": 32,
+        "flag_pattern": 8,
+        "power_type": 16,
+        "tyres": 16,
+    }
+
     BASE_MASS_PER_WHEEL = 12
 
     GAME_DATA  = {
@@ -0,0 +1,203 @@
+"""Works out costs, masses, and rule violations for a whole batch of buggies.
+
+BuggySpecs does these one buggy (object) at a time: this does the same
+calculations for columns of buggy settings (a dict of lists, one list per
+setting, or NumPy arrays) in one pass, looking up each setting's cost and
+mass in tables built once from BuggySpecs, so scrutineering every buggy in
+a cohort takes milliseconds. The results are the same as BuggySpecs':
+
+  - total_cost: calculate_total_cost's (0 if qty_wheels is None, and None
+    if a setting is of the wrong type or isn't a valid choice)
+  - mass: calculate_mass's (None in the same cases)
+  - violations: a bitmask of the rules broken (see RULE_BITS): use
+    get_violation_names to get get_rule_violations's list back
+
+It doesn't need Flask (or the database) or NumPy.
+"""
+
+from buggy_race_server.lib.race_specs import BuggySpecs, RuleNames
+
+# the settings needed, in the order they are zipped together
+SPEC_COLUMNS = (
+    "qty_wheels",
+    "power_type",
+    "power_units",
+    "aux_power_type",
+    "aux_power_units",
+    "hamster_booster",
+    "tyres",
+    "qty_tyres",
+    "armour",
+    "attack",
+    "qty_attacks",
+    "fireproof",
+    "insulated",
+    "antibiotic",
+    "banging",
+    "algo",
+    "flag_pattern",
+    "flag_color",
+    "flag_color_secondary",
+)
+
+# bits are in the order get_rule_violations checks the rules, so the
+# names come out in the same order too
+RULE_BITS = {
+    rule.name: 1 << i for (i, rule) in enumerate((
+        RuleNames.RACE_COST_THRESHOLD,
+        RuleNames.VALID_ALGO,
+        RuleNames.VALID_ARMOUR,
+        RuleNames.VALID_ATTACK,
+        RuleNames.VALID_POWER,
+        RuleNames.IS_POWERED,
+        RuleNames.VALID_AUX_POWER,
+        RuleNames.VALID_TYRES,
+        RuleNames.VALID_PATTERN,
+        RuleNames.FLAG_COLOURS,
+        RuleNames.MIN_WHEELS,
+        RuleNames.EVEN_WHEELS,
+        RuleNames.ENOUGH_TYRES,
+        RuleNames.SOFTWARE,
+    ))
+}
+
+_COST = "cost"
+_MASS = "mass"
+
+# lookup tables: setting's value -> its cost (or mass)
+_POWER_COST = {name: spec[_COST] for (name, spec) in BuggySpecs.POWER_TYPES.items()}
+_POWER_MASS = {name: spec[_MASS] for (name, spec) in BuggySpecs.POWER_TYPES.items()}
+_TYRE_COST = {name: spec[_COST] for (name, spec) in BuggySpecs.TYRE_TYPES.items()}
+_TYRE_MASS = {name: spec[_MASS] for (name, spec) in BuggySpecs.TYRE_TYPES.items()}
+_ARMOUR_COST = {name: spec[_COST] for (name, spec) in BuggySpecs.ARMOUR_TYPES.items()}
+_ARMOUR_MASS = {name: spec[_MASS] for (name, spec) in BuggySpecs.ARMOUR_TYPES.items()}
+_ATTACK_COST = {name: spec[_COST] for (name, spec) in BuggySpecs.ATTACK_TYPES.items()}
+_ATTACK_MASS = {name: spec[_MASS] for (name, spec) in BuggySpecs.ATTACK_TYPES.items()}
+_SPECIAL_COST = {name: spec[_COST] for (name, spec) in BuggySpecs.SPECIAL_ITEMS.items()}
+_SPECIAL_MASS = {name: spec[_MASS] for (name, spec) in BuggySpecs.SPECIAL_ITEMS.items()}
+
+_ALGOS = frozenset(BuggySpecs.ALGO_TYPES)
+_FLAG_PATTERNS = frozenset(BuggySpecs.FLAG_PATTERNS)
+_MIN_WHEELS = BuggySpecs.DEFAULTS["qty_wheels"]
+_PLAIN_FLAG = BuggySpecs.DEFAULTS["flag_pattern"]
+
+
+def get_violation_names(violations):
+    """ Returns the names of the rules in a violations bitmask (as a list,
+    like get_rule_violations does)"""
+    return [name for (name, bit) in RULE_BITS.items() if violations & bit]
+
+
+def get_columns(buggies):
+    """ Returns the columns of buggy settings evaluate_specs needs, from a
+    list of buggies (objects with the settings as attributes, or dicts)"""
+    if buggies and isinstance(buggies[0], dict):
+        return {name: [buggy.get(name) for buggy in buggies] for name in SPEC_COLUMNS}
+    return {name: [getattr(buggy, name) for buggy in buggies] for name in SPEC_COLUMNS}
+
+
+def evaluate_specs(columns, cost_limit=0):
+    """ Works out the cost, mass, and rule violations of every buggy in
+    columns (a dict with a list, or array, for each of SPEC_COLUMNS): returns
+    a dict of lists, with keys "total_cost", "mass", and "violations" (and
+    buggy i's results are at [i] in each). If the cost_limit is 0, there is
+    no cost limit. Unlike get_rule_violations, a buggy whose cost is None
+    doesn't raise a ValueError: the other rules are still checked, but
+    such a buggy can't be raced."""
+    if cost_limit is None:
+        raise ValueError("missing cost limit for race")
+    power_cost, power_mass = _POWER_COST, _POWER_MASS
+    tyre_cost, tyre_mass = _TYRE_COST, _TYRE_MASS
+    armour_cost, armour_mass = _ARMOUR_COST, _ARMOUR_MASS
+    attack_cost, attack_mass = _ATTACK_COST, _ATTACK_MASS
+    hamster_booster_cost = _SPECIAL_COST["hamster_booster"]
+    hamster_booster_mass = _SPECIAL_MASS["hamster_booster"]
+    fireproof_cost, fireproof_mass = _SPECIAL_COST["fireproof"], _SPECIAL_MASS["fireproof"]
+    insulated_cost, insulated_mass = _SPECIAL_COST["insulated"], _SPECIAL_MASS["insulated"]
+    antibiotic_cost, antibiotic_mass = _SPECIAL_COST["antibiotic"], _SPECIAL_MASS["antibiotic"]
+    banging_cost, banging_mass = _SPECIAL_COST["banging"], _SPECIAL_MASS["banging"]
+    base_mass_per_wheel = BuggySpecs.BASE_MASS_PER_WHEEL
+    bits = RULE_BITS
+    total_costs = []
+    masses = []
+    all_violations = []
+    for (
+        qty_wheels, power_type, power_units, aux_power_type, aux_power_units,
+        hamster_booster, tyres, qty_tyres, armour, attack, qty_attacks,
+        fireproof, insulated, antibiotic, banging,
+        algo, flag_pattern, flag_color, flag_color_secondary,
+    ) in zip(*(columns[name] for name in SPEC_COLUMNS)):
+        try:
+            armour_f = (100 + max(0, qty_wheels - _MIN_WHEELS) * 10) / 100
+            mass = int(
+                qty_wheels * base_mass_per_wheel
+                + power_mass[power_type] * power_units
+                + hamster_booster_mass * hamster_booster
+                + tyre_mass[tyres] * qty_tyres
+                + armour_mass[armour] * armour_f
+                + attack_mass[attack] * qty_attacks
+            )
+            cost = int(
+                power_cost[power_type] * power_units
+                + hamster_booster_cost * hamster_booster
+                + tyre_cost[tyres] * qty_tyres
+                + armour_cost[armour] * armour_f
+                + attack_cost[attack] * qty_attacks
+            )
+            if aux_power_type is not None:
+                cost += power_cost[aux_power_type] * aux_power_units
+                mass += power_mass[aux_power_type] * aux_power_units
+            if fireproof:
+                cost += fireproof_cost
+                mass += fireproof_mass
+            if insulated:
+                cost += insulated_cost
+                mass += insulated_mass
+            if antibiotic:
+                cost += antibiotic_cost
+                mass += antibiotic_mass
+            if banging:
+                cost += banging_cost
+                mass += banging_mass
+        except (TypeError, KeyError):
+            cost = mass = None
+        if qty_wheels is None:
+            cost = 0 # as calculate_total_cost
+        total_costs.append(cost)
+        masses.append(mass)
+
+        violations = 0
+        if cost is not None and cost_limit > 0 and cost > cost_limit:
+            violations |= bits["RACE_COST_THRESHOLD"]
+        if algo not in _ALGOS:
+            violations |= bits["VALID_ALGO"]
+        if armour not in armour_cost:
+            violations |= bits["VALID_ARMOUR"]
+        if attack not in attack_cost:
+            violations |= bits["VALID_ATTACK"]
+        if power_type not in power_cost:
+            violations |= bits["VALID_POWER"]
+        elif power_type == "none": # hardcoded
+            violations |= bits["IS_POWERED"]
+        if aux_power_type not in power_cost:
+            violations |= bits["VALID_AUX_POWER"]
+        if tyres not in tyre_cost:
+            violations |= bits["VALID_TYRES"]
+        if flag_pattern not in _FLAG_PATTERNS:
+            violations |= bits["VALID_PATTERN"]
+        elif flag_pattern != _PLAIN_FLAG and flag_color == flag_color_secondary:
+            violations |= bits["FLAG_COLOURS"]
+        if qty_wheels is None or qty_wheels < _MIN_WHEELS:
+            violations |= bits["MIN_WHEELS"]
+        elif qty_wheels % 2:
+            violations |= bits["EVEN_WHEELS"]
+        if qty_tyres is None or (qty_wheels is not None and qty_tyres < qty_wheels):
+            violations |= bits["ENOUGH_TYRES"]
+        if algo == "buggy": # hardcoded
+            violations |= bits["SOFTWARE"]
+        all_violations.append(violations)
+    return {
+        "total_cost": total_costs,
+        "mass": masses,
+        "violations": all_violations,
+    }
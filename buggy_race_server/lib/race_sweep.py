@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Monte Carlo race sweeps: runs the same race many times and reports how
+each buggy fares (win rate, finishing positions, did-not-finish rate).
+
+One race is a poor answer to "how good is my buggy?", so this runs thousands
+of seeded simulations (see race_engine.simulate) across a process pool.
+Each race gets its own seed derived from the sweep's seed and the race's
+number, so the results of a sweep don't depend on how many workers ran it.
+"""
+
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from buggy_race_server.lib.race_engine import get_podium, simulate
+
+DEFAULT_SWEEP_SEED = 0
+CHUNKS_PER_WORKER = 4 # more chunks than workers evens out the load
+
+class BuggySweepStats():
+    """Running totals for one buggy across many races"""
+
+    def __init__(self, username):
+        self.username = username
+        self.qty_races = 0
+        self.qty_started = 0
+        self.qty_finished = 0
+        self.qty_wins = 0
+        self.positions = Counter() # race position: number of races
+
+    def add_result(self, position, is_finisher):
+        self.qty_races += 1
+        if position == -1:
+            return # didn't start (rule violations)
+        self.qty_started += 1
+        if is_finisher:
+            self.qty_finished += 1
+            if position == 1:
+                self.qty_wins += 1
+        if position > 0:
+            self.positions[position] += 1
+
+    def merge(self, other):
+        self.qty_races += other.qty_races
+        self.qty_started += other.qty_started
+        self.qty_finished += other.qty_finished
+        self.qty_wins += other.qty_wins
+        self.positions.update(other.positions)
+
+    def _rate(self, qty):
+        return qty / self.qty_races if self.qty_races else 0
+
+    @property
+    def win_rate(self):
+        return self._rate(self.qty_wins)
+
+    @property
+    def podium_rate(self):
+        return self._rate(sum(self.positions[pos] for pos in (1, 2, 3)))
+
+    @property
+    def dnf_rate(self):
+        return self._rate(self.qty_started - self.qty_finished)
+
+    @property
+    def non_starter_rate(self):
+        return self._rate(self.qty_races - self.qty_started)
+
+    @property
+    def mean_position(self):
+        qty_placed = sum(self.positions.values())
+        if not qty_placed:
+            return None
+        return sum(pos * qty for pos, qty in self.positions.items()) / qty_placed
+
+    def to_dict(self):
+        return {
+            "username": self.username,
+            "races": self.qty_races,
+            "started": self.qty_started,
+            "finished": self.qty_finished,
+            "wins": self.qty_wins,
+            "win_rate": self.win_rate,
+            "podium_rate": self.podium_rate,
+            "dnf_rate": self.dnf_rate,
+            "non_starter_rate": self.non_starter_rate,
+            "mean_position": self.mean_position,
+            # JSON keys must be strings
+            "positions": {str(pos): qty for pos, qty in sorted(self.positions.items())},
+        }
+
+def get_race_seed(sweep_seed, race_number):
+    """ The seed for one race in a sweep: depends only on the sweep's seed and
+    the race number, so it's the same whichever worker runs it."""
+    return sweep_seed * 1_000_003 + race_number
+
+def _run_races(race_data, params, seeds, simulator=simulate):
+    """ Runs one race per seed and returns the stats keyed on username: this
+    runs in a worker process, so returns totals rather than every result."""
+    stats = {}
+    for seed in seeds:
+        results = simulator(race_data, params, seed=seed, want_events=False)
+        is_finisher_by_username = {
+            buggy["username"]: is_finisher for (buggy, is_finisher) in get_podium(results)
+        }
+        for buggy in results["buggies"]:
+            username = buggy["username"]
+            if username not in stats:
+                stats[username] = BuggySweepStats(username)
+            stats[username].add_result(
+                buggy["race_position"],
+                is_finisher_by_username.get(username, False)
+            )
+    return stats
+
+def _chunk(items, qty_chunks):
+    size, extra = divmod(len(items), qty_chunks)
+    chunks = []
+    start = 0
+    for i in range(qty_chunks):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
+def run_sweep(race_data, params, qty_races, seed=DEFAULT_SWEEP_SEED, max_workers=None, progress=None,
+              simulator=simulate):
+    """ Runs qty_races races (with race_engine.simulate) across a pool of
+    max_workers processes (default: one per core) and returns a list of
+    BuggySweepStats, best win rate first.
+    If max_workers is 1, everything runs in this process (handy for profiling).
+    progress, if not None, is called with the number of races run so far.
+    simulator is the engine's simulate function (e.g., the numpy engine's)."""
+    seeds = [get_race_seed(seed, i) for i in range(qty_races)]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    totals = {}
+
+    def merge(chunk_stats, qty_done):
+        for username, buggy_stats in chunk_stats.items():
+            if username in totals:
+                totals[username].merge(buggy_stats)
+            else:
+                totals[username] = buggy_stats
+        if progress is not None:
+            progress(qty_done)
+
+    if max_workers == 1 or qty_races < 2:
+        merge(_run_races(race_data, params, seeds, simulator), qty_races)
+    else:
+        chunks = _chunk(seeds, max_workers * CHUNKS_PER_WORKER)
+        qty_done = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (executor.submit(_run_races, race_data, params, chunk, simulator), len(chunk))
+                for chunk in chunks
+            ]
+            # merge in submission order: the totals are the same either way,
+            # but this keeps the order of buggies in the report stable
+            for future, qty in futures:
+                qty_done += qty
+                merge(future.result(), qty_done)
+    return sorted(
+        totals.values(),
+        key=lambda s: (-s.win_rate, -s.podium_rate, s.mean_position or float("inf"), s.username)
+    )
+
+def get_sweep_report_lines(sweep_stats, qty_races):
+    """ Plain text report of a sweep, one line per buggy"""
+    lines = [
+        f"Results of {qty_races} races",
+        f"{'username':20} {'win':>7} {'podium':>7} {'DNF':>7} {'no start':>8} {'mean pos':>8}",
+    ]
+    for s in sweep_stats:
+        mean_position = "-" if s.mean_position is None else f"{s.mean_position:.2f}"
+        lines.append(
+            f"{s.username:20} {s.win_rate:7.2%} {s.podium_rate:7.2%} "
+            f"{s.dnf_rate:7.2%} {s.non_starter_rate:8.2%} {mean_position:>8}"
+        )
+    return lines
@@ -28,6 +28,11 @@ const EVENT_TYPE = 'e';
 const EVENT_DELTA = 'd';
 const EVENT_STRING = 's';
 
+// compact event logs (see lib/race_events.py on the race server)
+const COMPACT_EVENTS_VERSION = 1;
+const COMPACT_EVENT_WIDTH = 4; // buggy index, type index, delta, string index
+const COMPACT_NONE_INDEX = -1;
+
 const EVENT_TYPE_FINISH = 'f';
 const EVENT_TYPE_ATTACK_PREFIX = 'a';
 const EVENT_TYPE_BIOHAZARD = EVENT_TYPE_ATTACK_PREFIX + 'b';
@@ -89,6 +94,7 @@ const MAX_STEPS = 100; // used by random race generator, pending real events
 const NAMESPACE_SVG = "http://www.w3.org/2000/svg";
 const NAMESPACE_XLINK = "http://www.w3.org/1999/xlink";
 const PAUSE_BEFORE_PLAY_ENABLE = 2000; // ms
+const WAIT_FOR_EVENTS_MS = 250; // if the replay catches up with the loading
 const PAUSE_BEFORE_TRACK_REVEAL = 500; // ms
 const PLAY_BUTTON = document.getElementById("btn-play");
 const RACE_URL_VAR_NAME = "race";
@@ -253,14 +259,66 @@ function report_event(text, buggy_id){
   RACELOG_DISPLAY.prepend(p);
 }
 
+// events may be in the compact format: if so, expand them to the sparse
+// event objects the replay uses ({b: buggy_id, e: event_type, ...})
+function expand_events(events){
+  if (! events || Array.isArray(events)) {
+    return events || [];
+  }
+  if (events.compact != COMPACT_EVENTS_VERSION) {
+    report("warning: unknown version of compact event log", CSS_SYSTEM);
+    return [];
+  }
+  let expanded = [];
+  for (let step of events.steps) {
+    let events_in_step = [];
+    for (let i = 0; i < step.length; i += COMPACT_EVENT_WIDTH) {
+      let event = {};
+      if (step[i] != COMPACT_NONE_INDEX) { event[EVENT_BUGGY] = events.buggies[step[i]] }
+      if (step[i+1] != COMPACT_NONE_INDEX) { event[EVENT_TYPE] = events.types[step[i+1]] }
+      if (step[i+2]) { event[EVENT_DELTA] = step[i+2] }
+      if (step[i+3] != COMPACT_NONE_INDEX) { event[EVENT_STRING] = events.strings[step[i+3]] }
+      events_in_step.push(event);
+    }
+    expanded.push(events_in_step);
+  }
+  return expanded;
+}
+
+// the race server can serve the events in chunks (race_json.event_chunks
+// has their URLs instead of race_json having the events): fetch them one
+// after the other, so the replay can start before they've all arrived
+function load_event_chunks(urls){
+  let loading = Promise.resolve();
+  for (let url of urls) {
+    loading = loading.then(() => fetch(url)).then((response) => {
+      if (!response.ok) {
+        throw new Error(`HTTP error: ${response.status} fetching race events`);
+      }
+      return response.json();
+    }).then((chunk) => {
+      RACE_INFO.events.push(...expand_events(chunk));
+    });
+  }
+  loading.catch((error) => {
+    report(`cannot load all the race events - ${error}`, CSS_ALERT);
+    RACE_INFO.qty_steps = RACE_INFO.events.length;
+  });
+}
+
 function set_up_race(){
   report("preparing race", CSS_SYSTEM);
   RACE_INFO.title = race_json.title || "Untitled race";
   RACE_INFO.description = race_json.description || "";
-  RACE_INFO.events = race_json.events || [];
-  if (RACE_INFO.events.length > 0) {
-    RACE_INFO.qty_steps = RACE_INFO.events.length;
+  if (race_json.event_chunks) {
+    RACE_INFO.events = [];
+    RACE_INFO.qty_steps = race_json.event_chunks.qty_steps;
+    load_event_chunks(race_json.event_chunks.urls || []);
   } else {
+    RACE_INFO.events = expand_events(race_json.events);
+    RACE_INFO.qty_steps = RACE_INFO.events.length;
+  }
+  if (RACE_INFO.qty_steps == 0) {
     report("race didn't start: no events to replay", CSS_ALERT)
   }
 
@@ -533,6 +591,10 @@ function do_step(){
     end_race("Race ended: no more events in log");
     return;
   }
+  if (step_count >= RACE_INFO.events.length) { // still loading this chunk
+    setTimeout(do_step, WAIT_FOR_EVENTS_MS);
+    return;
+  }
   for (let event of RACE_INFO.events[step_count]) {
     let buggy_id = event[EVENT_BUGGY];
     let buggy = svg_buggies[BUGGY_ID_PREFIX + buggy_id];
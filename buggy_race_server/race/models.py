@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 """Race model."""
 from datetime import datetime, timedelta, timezone
+import io
 import os
 import re
 import json
-from sqlalchemy import delete, insert, sql
+from sqlalchemy import delete, insert, select, sql, union
 
 # get the config settings (without the app context):
 from buggy_race_server.config import ConfigSettings, ConfigSettingNames
@@ -15,11 +16,42 @@ from buggy_race_server.database import (
     SurrogatePK,
     db,
 )
-from buggy_race_server.admin.models import DbFile
+from buggy_race_server.admin.models import CacheVersion, DbFile
+from buggy_race_server.extensions import blob_store, cache
 from buggy_race_server.buggy.models import Buggy
+from buggy_race_server.lib.json_stream import dumps_with_raw
+from buggy_race_server.lib.race_events import (
+    check_events,
+    load_results_stream,
+    split_events,
+)
 from buggy_race_server.lib.race_specs import RuleNames
+from buggy_race_server.lib.race_specs_bulk import evaluate_specs, get_violation_names
 from buggy_race_server.user.models import User
-from buggy_race_server.utils import servertime_str, get_url_protocol, join_to_project_root
+from buggy_race_server.utils import (
+    get_url_protocol,
+    join_to_project_root,
+    make_race_server_url,
+    servertime_str,
+)
+
+def delete_unused_blobs(blob_hashes):
+    """ Deletes the blobs (of the hashes) that no DbFile or racetrack uses
+    any more: blobs are shared by anything with the same contents, so they
+    can't simply be deleted with the row that stopped using them. Call this
+    after the change that stopped using them has been committed (so if it
+    was rolled back, nothing's lost)."""
+    blob_hashes = set(blob_hashes) - {None}
+    if not blob_hashes:
+        return
+    used_hashes = set(db.session.scalars(union(
+        select(DbFile.etag).where(DbFile.etag.in_(blob_hashes)),
+        select(DbFile.gzip_etag).where(DbFile.gzip_etag.in_(blob_hashes)),
+        select(Racetrack.track_image_hash).where(Racetrack.track_image_hash.in_(blob_hashes)),
+    )))
+    for blob_hash in blob_hashes - used_hashes:
+        blob_store.delete(blob_hash)
+    db.session.commit() # if the blobs are in the database
 
 class Racetrack(SurrogatePK, Model):
 
@@ -55,9 +87,9 @@ class Racetrack(SurrogatePK, Model):
     desc = Column(db.Text(), unique=False, nullable=False, default="")
     track_image_url = Column(db.String(255), unique=False, nullable=True)
     track_svg_url = Column(db.String(255), unique=False, nullable=True)
-    track_image = Column(db.LargeBinary(length=None), nullable=True)
+    track_image_hash = Column(db.String(64), nullable=True) # in the blob store
     image_media_type = Column(db.String(32), nullable=True)
-    track_svg = Column(db.Text(), unique=False, nullable=True)
+    track_svg = db.deferred(Column(db.Text(), unique=False, nullable=True))
     svg_path_length = Column(db.Integer, nullable=True)
     lap_length = Column(db.Integer, nullable=True)
     start_offset = Column(db.Integer, nullable=True)
@@ -67,10 +99,21 @@ class Racetrack(SurrogatePK, Model):
         """Create instance."""
         db.Model.__init__(self, **kwargs)
 
+    def set_track_image(self, image_bytes):
+        """ Puts the image in the blob store (None to remove it): the old one
+        is left there (see delete_unused_blobs)"""
+        if image_bytes is None:
+            self.track_image_hash = None
+        else:
+            self.track_image_hash = blob_store.put(image_bytes)
+
 
 class Race(SurrogatePK, Model):
     """A race."""
 
+    REPLAY_STEPS_PER_CHUNK = 50 # steps in each chunk of events for replays
+    SCRUTINEERING_CACHE_TIMEOUT = 24 * 60 * 60 # keys change when buggies do
+
     def get_default_race_time():
         # two minutes to midnight ;-)
         tomorrow = datetime.today() + timedelta(days=1)
@@ -78,6 +121,9 @@ class Race(SurrogatePK, Model):
         return tomorrow
 
     __tablename__ = "races"
+    __table_args__ = (
+        db.Index("ix_races_is_visible_start_at", "is_visible", "start_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = Column(db.String(80), unique=False, nullable=False, default="")
     desc = Column(db.Text(), unique=False, nullable=False, default="")
@@ -246,6 +292,8 @@ class Race(SurrogatePK, Model):
                 "Uploaded race results have different number of laps for this race: "
                 f" expected {self.max_laps}, uploaded {max_laps}"
             )
+        # before anything is saved: store_race_file splits the events later
+        check_events(results_data.get("events")) # raises ValueError if unreadable
         total_buggies_entered = int(results_data.get("buggies_entered") or 0)
         total_buggies_started = int(results_data.get("buggies_started") or 0)
         total_buggies_finished = int(results_data.get("buggies_finished") or 0)
@@ -404,9 +452,73 @@ class Race(SurrogatePK, Model):
                     self.race_file_url = results_data.get("race_file_url")
                 else:
                     warnings.append("Did not overwrite race result log URL (you must explicitly allow this)")
+            CacheVersion.bump(CacheVersion.RACES, commit=False)
             db.session.commit()
         return [ f"Warning: {warning}" for warning in warnings ]
 
+    @staticmethod
+    def get_entrants_fingerprint():
+        """ Returns something that changes whenever any race entrant's buggy
+        does (the number of buggies, their ids, and the latest modified_at),
+        in one aggregate query: it's what race scrutineering is cached on"""
+        (qty_buggies, sum_of_ids, modified_at) = db.session.execute(
+            sql.select(
+                sql.func.count(Buggy.id),
+                sql.func.sum(Buggy.id),
+                sql.func.max(Buggy.modified_at),
+            ).join(User, Buggy.user_id==User.id).where(
+                User.is_active==True,
+                User.is_student==True,
+            )
+        ).one()
+        return f"{qty_buggies}-{sum_of_ids or 0}-{modified_at.timestamp() if modified_at else 0}"
+
+    def get_scrutineering(self):
+        """ Checks every entrant's buggy against this race's rules (as the
+        race runner will, with set_rule_violations) in bulk, and returns a
+        report: a dict with the eligible and ineligible counts, and a list
+        of buggies (with their username, cost, mass, violations_str, and
+        is_eligible). It's cached on the race and the buggies' fingerprint
+        (see get_entrants_fingerprint), so it's only worked out again when a
+        buggy (or the race's cost limit) changes."""
+        cost_limit = self.cost_limit or 0
+        cache_key = (
+          f"race-scrutineering/{self.id}/{cost_limit}/"
+          f"{Race.get_entrants_fingerprint()}"
+        )
+        if (scrutineering := cache.get(cache_key)) is not None:
+            return scrutineering
+        specs = Buggy.get_all_buggy_specs(want_students_only=True)
+        results = evaluate_specs(specs, cost_limit=cost_limit)
+        buggies = [
+            {
+                "username": username,
+                "user_id": user_id,
+                "cost": total_cost,
+                "mass": mass,
+                "violations_str": ",".join(get_violation_names(violations)),
+                # a buggy with no cost can't be raced (see scrutineer)
+                "is_eligible": total_cost is not None and violations == 0,
+            }
+            for (username, user_id, total_cost, mass, violations) in zip(
+                specs["username"], specs["user_id"],
+                results["total_cost"], results["mass"], results["violations"],
+            )
+        ]
+        qty_eligible = sum(1 for buggy in buggies if buggy["is_eligible"])
+        scrutineering = {
+            "cost_limit": cost_limit,
+            "scrutineered_at": servertime_str(
+                current_app.config[ConfigSettingNames.BUGGY_RACE_SERVER_TIMEZONE.name],
+                datetime.now(timezone.utc)
+            ),
+            "qty_eligible": qty_eligible,
+            "qty_ineligible": len(buggies) - qty_eligible,
+            "buggies": buggies,
+        }
+        cache.set(cache_key, scrutineering, timeout=Race.SCRUTINEERING_CACHE_TIMEOUT)
+        return scrutineering
+
     def get_race_data_json(self, want_buggies=False):
         all_results = db.session.query(
             RaceResult, User
@@ -460,26 +572,69 @@ class Race(SurrogatePK, Model):
             ],
             "version": "1.0"
         }
+        if want_buggies:
+            # the runner checks the rules too, but this shows who's eligible now
+            race_data_dict["scrutineering"] = self.get_scrutineering()
         return json.dumps(race_data_dict, indent=1, separators=(',', ': '))
 
 
     def store_race_file(self, race_file_contents):
-        """ check IS_STORING_RACE_FILES_IN_DB before using race files """
-        if type(race_file_contents) != str:
-            race_file_contents = json.dumps(race_file_contents)
+        """ check IS_STORING_RACE_FILES_IN_DB before using race files
+        The events in the race file can be in either format (see
+        lib/race_events.py): they're stored (and served) as uploaded, and
+        if they were read raw (see load_results_stream) they stay raw.
+        Also stores the replay files: the race file without its events (the
+        header), and the events split into chunks, so the player can start
+        before it's downloaded the whole race."""
+        replaced_blob_hashes = self.get_blob_hashes()
+        if type(race_file_contents) == str:
+            race_data = load_results_stream(io.BytesIO(race_file_contents.encode("utf-8")))
+        else:
+            race_data = race_file_contents
+            race_file_contents = dumps_with_raw(race_data)
         race_file_db = DbFile.query.filter_by(
             type=DbFile.RACE_FILE_TYPE,
             item_id=self.id
         ).first()
         if race_file_db is None:
-            race_file_db = DbFile.create(
-                item_id=self.id,
-                type=DbFile.RACE_FILE_TYPE,
-                contents=race_file_contents
-            )
-        else:
-            race_file_db.contents = race_file_contents
-        race_file_db.save()
+            race_file_db = DbFile(item_id=self.id, type=DbFile.RACE_FILE_TYPE)
+        race_file_db.set_contents(race_file_contents)
+        race_file_db.save(commit=False)
+
+        DbFile.query.filter(
+            DbFile.item_id==self.id,
+            DbFile.type.in_([DbFile.REPLAY_HEADER_TYPE, DbFile.REPLAY_CHUNK_TYPE])
+        ).delete(synchronize_session=False)
+        (qty_steps, chunks) = split_events(race_data.get("events"), Race.REPLAY_STEPS_PER_CHUNK)
+        header_data = {key: value for (key, value) in race_data.items() if key != "events"}
+        header_data["event_chunks"] = {
+            "qty_steps": qty_steps,
+            "steps_per_chunk": Race.REPLAY_STEPS_PER_CHUNK,
+            "urls": [
+                make_race_server_url(
+                    url_for("race.serve_replay_chunk", race_id=self.id, chunk=i)
+                )
+                for i in range(len(chunks))
+            ],
+        }
+        header_db = DbFile(item_id=self.id, type=DbFile.REPLAY_HEADER_TYPE)
+        header_db.set_contents(dumps_with_raw(header_data))
+        header_db.save(commit=False)
+        for i, chunk in enumerate(chunks):
+            chunk_db = DbFile(item_id=self.id, type=DbFile.REPLAY_CHUNK_TYPE, name=str(i))
+            chunk_db.set_contents(chunk)
+            chunk_db.save(commit=False)
+        db.session.commit()
+        delete_unused_blobs(replaced_blob_hashes)
+
+    def get_blob_hashes(self):
+        """ The hashes of the blobs of this race's files (the race file and
+        its replay files)"""
+        return [
+            blob_hash
+            for db_file in DbFile.query.filter_by(item_id=self.id)
+            for blob_hash in db_file.get_blob_hashes()
+        ]
 
 class RaceResult(SurrogatePK, Model):
 
@@ -494,8 +649,8 @@ class RaceResult(SurrogatePK, Model):
     """
     __tablename__ = "results"
     id = db.Column(db.Integer, primary_key=True)
-    race_id = db.Column(db.Integer, db.ForeignKey('races.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    race_id = db.Column(db.Integer, db.ForeignKey('races.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     flag_color = db.Column(db.String(32), nullable=False, default=Buggy.DEFAULTS["flag_color"])
     flag_color_secondary = db.Column(db.String(32), nullable=False, default=Buggy.DEFAULTS["flag_color_secondary"])
     flag_pattern = db.Column(db.String(32), nullable=False, default=Buggy.DEFAULTS["flag_pattern"])
@@ -20,8 +20,9 @@ from flask import (
 )
 from flask_login import current_user, login_required
 from buggy_race_server.admin.forms import GeneralSubmitForm, SubmitWithConfirmForm
-from buggy_race_server.admin.models import DbFile
+from buggy_race_server.admin.models import CacheVersion, DbFile
 from buggy_race_server.database import db
+from buggy_race_server.extensions import cache
 from buggy_race_server.race.forms import RaceForm, RaceDeleteForm, RaceResultsForm, RacetrackForm
 from buggy_race_server.race.models import Race, RaceResult, Racetrack
 from buggy_race_server.user.models import User
@@ -34,12 +35,17 @@ from buggy_race_server.utils import (
     get_temp_race_file_info,
     staff_only,
     join_to_project_root,
+    make_race_server_url,
+    send_blob,
     servertime_str,
 )
 from buggy_race_server.config import ConfigSettingNames, ConfigSettings
 
 blueprint = Blueprint("race", __name__, url_prefix="/races", static_folder="../static")
 
+RACE_FILE_MAX_AGE = 60 # seconds browsers (and proxies) may cache public race files
+RACE_CACHE_TIMEOUT = 60 # seconds public race page data is cached on the server
+
 # race assets:
 # Serving statically because it's more robust than trying to
 # figure out how to exclude these from webpack, and even then it's
@@ -62,15 +68,15 @@ def serve_racetrack_custom_image(track_id):
     track = Racetrack.get_by_id(track_id)
     if track is None:
         abort(404)
-    if track.track_image is None or len(track.track_image) == 0 or not track.image_media_type:
+    if track.track_image_hash is None or not track.image_media_type:
         flash("No custom image associated with this track", "danger")
         abort(404)
     ext = re.sub(r'.*/', "", track.image_media_type)
-    response = make_response(track.track_image)
-    response.headers["Content-type"] = track.image_media_type
-    response.headers["Content-disposition"] = f"attachment; filename=racetrack-{track_id}.{ext}"
-    response.headers["Content-length"] = len(track.track_image)
-    return response
+    return send_blob(
+        track.track_image_hash,
+        track.image_media_type,
+        download_name=f"racetrack-{track_id}.{ext}"
+    )
 
 @blueprint.route("/assets/track/<int:track_id>/svg")
 @cors_allow_origin
@@ -110,9 +116,54 @@ def serve_race_player_asset(filename):
         filename
     )
 
-@blueprint.route("/", strict_slashes=False)
-def show_public_races():
-    """Race announcement page."""
+def _get_cached_race_data(key, get_data):
+    """ Public race pages are busy when a race is published, but only change
+    when an admin changes a race: so their data is cached, keyed on the races
+    version (see CacheVersion), which admin changes bump. The data must be
+    plain (not ORM objects, which can't go in the cache). The timeout is
+    because time matters too: races become past races when they start."""
+    cache_key = f"races/{CacheVersion.get_version(CacheVersion.RACES)}/{key}"
+    data = cache.get(cache_key)
+    if data is None:
+        data = get_data()
+        cache.set(cache_key, data, timeout=RACE_CACHE_TIMEOUT)
+    return data
+
+def _get_race_snapshot(race, **extra_fields):
+    """ Returns the race's fields that the public pages use, as a dict
+    (Jinja's race.title works just as well on a dict)"""
+    snapshot = {
+        field: getattr(race, field) for field in (
+            "id",
+            "title",
+            "desc",
+            "cost_limit",
+            "start_at",
+            "start_at_servertime",
+            "is_visible",
+            "is_result_visible",
+            "is_abandoned",
+            "results_uploaded_at",
+            "race_file_url",
+            "buggies_started",
+        )
+    }
+    snapshot.update(extra_fields)
+    return snapshot
+
+def _get_result_snapshot(result):
+    return {
+        field: getattr(result, field) for field in (
+            "race_position",
+            "cost",
+            "flag_color",
+            "flag_color_secondary",
+            "flag_pattern",
+            "violations_str",
+        )
+    }
+
+def _get_public_races_data():
     next_race=Race.query.filter(
         Race.is_visible==True,
         Race.start_at > datetime.now(timezone.utc)
@@ -132,18 +183,28 @@ def show_public_races():
     flag_color_css_defs = get_flag_color_css_defs(
         [result for sublist in results for result in sublist]
     )
+    return {
+        "flag_color_css_defs": flag_color_css_defs,
+        "next_race": _get_race_snapshot(next_race) if next_race else None,
+        "races": [
+            _get_race_snapshot(
+                race,
+                results=[_get_result_snapshot(res) for res in race.results]
+            )
+            for race in races
+        ],
+    }
+
+@blueprint.route("/", strict_slashes=False)
+def show_public_races():
+    """Race announcement page."""
     return render_template(
         "races/index.html",
-        flag_color_css_defs=flag_color_css_defs,
-        next_race=next_race,
-        races=races,
         replay_anchor=Race.get_replay_anchor(),
+        **_get_cached_race_data("index", _get_public_races_data)
     )
 
-@blueprint.route("races.json", strict_slashes=True)
-@cors_allow_origin
-def serve_races_json():
-    filename = get_download_filename("races.json", want_datestamp=True)
+def _get_races_json():
     races=Race.query.filter(
         Race.is_visible==True,
         Race.start_at < datetime.now(timezone.utc)
@@ -163,7 +224,13 @@ def serve_races_json():
         }
         for race in races
     ]
-    json_data = json.dumps(races_list, indent=1, separators=(',', ': '))
+    return json.dumps(races_list, indent=1, separators=(',', ': '))
+
+@blueprint.route("races.json", strict_slashes=True)
+@cors_allow_origin
+def serve_races_json():
+    filename = get_download_filename("races.json", want_datestamp=True)
+    json_data = _get_cached_race_data("races.json", _get_races_json)
     output = make_response(json_data, 200)
     output.headers["Content-Disposition"] = f"attachment; filename={filename}"
     output.headers["Content-type"] = "application/json"
@@ -181,6 +248,11 @@ def replay_race(race_id):
         flash("Race was abandoned: nothing to replay", "warning")
         abort(404)
     race_file_url = race.race_file_url
+    if current_app.config[ConfigSettingNames.IS_STORING_RACE_FILES_IN_DB.name]:
+        if DbFile.query.filter_by(type=DbFile.REPLAY_HEADER_TYPE, item_id=race.id).count():
+            race_file_url = make_race_server_url(
+                url_for("race.serve_replay_header", race_id=race.id)
+            )
     if race_file_url and not (re.match(r"^https?://", race_file_url)):
         race_file_url = url_for(
             "race.serve_race_player_asset",
@@ -200,11 +272,41 @@ def replay_race(race_id):
         race_file_url=race_file_url,
     )
 
+def _get_race_results_data(race_id):
+    """ Returns None if there's no such race"""
+    race = Race.query.filter_by(id=race_id).first()
+    if race is None:
+        return None
+    all_results = db.session.query(
+        RaceResult, User).outerjoin(User).filter(
+            RaceResult.race_id==race.id
+        ).order_by(RaceResult.race_position.asc()).all()
+    flag_color_css_defs = get_flag_color_css_defs([res for (res, _) in all_results])
+    all_results = [
+        (
+            _get_result_snapshot(res),
+            {"id": user.id, "pretty_username": user.pretty_username} if user else None
+        )
+        for (res, user) in all_results
+    ]
+    return {
+        "race": _get_race_snapshot(race),
+        "all_results": all_results,
+        "flag_color_css_defs": flag_color_css_defs,
+    }
+
 @blueprint.route("/<int:race_id>/result")
 def show_race_results(race_id):
-    race = Race.query.filter_by(id=race_id).first_or_404()
+    data = _get_cached_race_data(
+        f"result/{race_id}",
+        lambda: _get_race_results_data(race_id)
+    )
+    if data is None:
+        abort(404)
+    race = data["race"]
+    all_results = data["all_results"]
 
-    if is_preview := not (race.is_visible and race.is_result_visible):
+    if is_preview := not (race["is_visible"] and race["is_result_visible"]):
         if current_user.is_anonymous or not current_user.is_staff:
             flash("Results for this race are not available yet", "danger")
             flash("Either the results haven't been uploaded, or they haven't been published yet (maybe try again later?)", "info")
@@ -212,26 +314,20 @@ def show_race_results(race_id):
         else:
             flash("Results for this race have not been published yet: you're seeing this preview because you're staff", "warning")
 
-    all_results = db.session.query(
-        RaceResult, User).outerjoin(User).filter(
-            RaceResult.race_id==race.id
-        ).order_by(RaceResult.race_position.asc()).all() 
-
-    results_finishers = [(res, user)  for (res, user) in all_results if res.race_position > 0 ]
-    results_nonfinishers = [(res, user) for (res, user) in all_results if res.race_position == 0 ]
-    results_disqualified = [(res, user) for (res, user) in all_results if res.race_position < 0 ]
+    results_finishers = [(res, user)  for (res, user) in all_results if res["race_position"] > 0 ]
+    results_nonfinishers = [(res, user) for (res, user) in all_results if res["race_position"] == 0 ]
+    results_disqualified = [(res, user) for (res, user) in all_results if res["race_position"] < 0 ]
     is_tied = {}
     prev_pos = 0
     for (res, _) in results_finishers:
-        if res.race_position == prev_pos:
+        if res["race_position"] == prev_pos:
             is_tied[prev_pos] = "="
-        prev_pos = res.race_position
-    flag_color_css_defs = get_flag_color_css_defs([res for (res, _) in all_results])
+        prev_pos = res["race_position"]
     return render_template(
         "races/result.html",
         is_preview=is_preview,
         current_user_id=0 if current_user.is_anonymous else current_user.id,
-        flag_color_css_defs=flag_color_css_defs,
+        flag_color_css_defs=data["flag_color_css_defs"],
         is_showing_usernames=current_app.config[ConfigSettingNames.IS_USERNAME_PUBLIC_IN_RESULTS.name],
         is_tied=is_tied,
         race=race,
@@ -242,10 +338,8 @@ def show_race_results(race_id):
         results_nonfinishers=results_nonfinishers,
     )
 
-@blueprint.route("/<int:race_id>/race-file.json")
-@blueprint.route("/<int:race_id>/race-file")
-@cors_allow_origin
-def serve_race_file(race_id):
+def _get_race_for_race_file(race_id):
+    """ Returns the race if its race file can be seen, otherwise aborts """
     race = Race.query.filter_by(id=race_id).first_or_404()
     if not (race.is_visible and race.is_result_visible):
         if current_user.is_anonymous or not current_user.is_staff:
@@ -254,14 +348,49 @@ def serve_race_file(race_id):
     if race.is_abandoned: # don't show race file
         flash("No race file: race was abandoned", "info")
         abort(404)
+    return race
+
+def _serve_db_file_json(db_file, race):
+    """ Serves a (JSON) DbFile from the blob store, gzipped if the client
+    accepts it: the gzipped copy is a blob too, with its own ETag, so
+    conditional requests work for either (but range requests only for the
+    uncompressed one). Published race files can be cached, but staff-only
+    previews can't."""
+    if db_file.etag is None:
+        # the blob store migration moved these, so this shouldn't happen:
+        # serve it from its row (but don't write anything on a GET)
+        current_app.logger.warning(
+            f"Race {race.id}'s {db_file.type} file isn't in the blob store: serving it from the database"
+        )
+        response = make_response(db_file.get_contents())
+        response.mimetype = "application/json"
+    else:
+        is_gzipped = "gzip" in request.accept_encodings
+        response = send_blob(
+            db_file.gzip_etag if is_gzipped else db_file.etag,
+            "application/json",
+            max_age=RACE_FILE_MAX_AGE,
+            content_encoding="gzip" if is_gzipped else None,
+        )
+        response.vary.add("Accept-Encoding")
+    if not (race.is_visible and race.is_result_visible):
+        response.cache_control.public = False
+        response.cache_control.max_age = None
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+@blueprint.route("/<int:race_id>/race-file.json")
+@blueprint.route("/<int:race_id>/race-file")
+@cors_allow_origin
+def serve_race_file(race_id):
+    race = _get_race_for_race_file(race_id)
     if current_app.config[ConfigSettingNames.IS_STORING_RACE_FILES_IN_DB.name]:
         racefile = DbFile.query.filter_by(
             type=DbFile.RACE_FILE_TYPE,
             item_id=race_id
         ).first_or_404()
-        json_response = make_response(racefile.contents)
-        json_response.headers["Content-type"] = "application/json"
-        return json_response
+        return _serve_db_file_json(racefile, race)
     else:
         if not race.race_file_url:
             abort(404)
@@ -269,3 +398,26 @@ def serve_race_file(race_id):
         # MIME-type, but if IS_STORING_RACE_FILES_IN_DB has been turned
         # off, that's perhaps unavoidable:
         return redirect(race.race_file_url)
+
+@blueprint.route("/<int:race_id>/race-file/replay.json")
+@cors_allow_origin
+def serve_replay_header(race_id):
+    """ The race file without its events: instead, event_chunks has the
+    URLs of the events (see Race.store_race_file)"""
+    race = _get_race_for_race_file(race_id)
+    header = DbFile.query.filter_by(
+        type=DbFile.REPLAY_HEADER_TYPE,
+        item_id=race_id
+    ).first_or_404()
+    return _serve_db_file_json(header, race)
+
+@blueprint.route("/<int:race_id>/race-file/events/<int:chunk>.json")
+@cors_allow_origin
+def serve_replay_chunk(race_id, chunk):
+    race = _get_race_for_race_file(race_id)
+    chunk_file = DbFile.query.filter_by(
+        type=DbFile.REPLAY_CHUNK_TYPE,
+        item_id=race_id,
+        name=str(chunk)
+    ).first_or_404()
+    return _serve_db_file_json(chunk_file, race)
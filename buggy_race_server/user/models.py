@@ -3,14 +3,15 @@
 from random import randint
 import json
 import re
+import threading
+import time
 from datetime import datetime, timezone, timedelta
+from http.client import HTTPException
 
 from flask import current_app
 from flask_login import UserMixin
 from sqlalchemy import orm, sql
 
-from socket import gaierror
-
 # get the config settings (without the app context):
 from buggy_race_server.config import ConfigSettings, ConfigSettingNames
 from buggy_race_server.database import (
@@ -21,12 +22,28 @@ from buggy_race_server.database import (
     reference_col,
     relationship,
 )
-from buggy_race_server.extensions import bcrypt
+from buggy_race_server.extensions import bcrypt, cache
 from buggy_race_server.lib.http import Http
 from buggy_race_server.utils import servertime_str
 
 API_KEY_LENGTH = 16
 
+# GitHub asks for a second between requests that create or change things
+# (e.g., when injecting issues), to avoid its secondary rate limits
+GITHUB_WRITE_INTERVAL = 1.0 # seconds
+
+# Whether users have forked the course repo is cached (see
+# has_course_repository): after these many seconds, the cached answer is
+# stale, and is refreshed in the background (but still used until then)
+COURSE_REPO_CACHE_FRESH_FOR = 60 * 60
+COURSE_REPO_CACHE_FRESH_FOR_IF_MISSING = 60 # they might be about to fork it
+COURSE_REPO_CACHE_FRESH_FOR_IF_UNKNOWN = 60 # GitHub didn't answer: don't wait for it again
+COURSE_REPO_CACHE_TIMEOUT = 7 * 24 * 60 * 60 # stale answers are dropped
+COURSE_REPO_LOOKUP_WAIT = 3 # seconds to wait for an answer that isn't cached
+
+_course_repo_lookups = {} # cache key: thread, for lookups in this process
+_course_repo_lookups_lock = threading.Lock()
+
 EXAMPLE_USER_DATA = {
     "ada": {
         "username": "ada",
@@ -50,6 +67,65 @@ EXAMPLE_USER_DATA = {
     },
 }
 
+
+def _cache_course_repository(cache_key, has_repo):
+    """ has_repo is None if GitHub didn't say (so it's not known)"""
+    if has_repo is None:
+        fresh_for = COURSE_REPO_CACHE_FRESH_FOR_IF_UNKNOWN
+    elif has_repo:
+        fresh_for = COURSE_REPO_CACHE_FRESH_FOR
+    else:
+        fresh_for = COURSE_REPO_CACHE_FRESH_FOR_IF_MISSING
+    cache.set(
+        cache_key,
+        {"has_repo": has_repo, "fresh_until": time.time() + fresh_for},
+        timeout=COURSE_REPO_CACHE_TIMEOUT,
+    )
+
+def _look_up_course_repository(app, github, github_username, cache_key):
+    """ Asks GitHub if the user's course repo exists, and caches the answer:
+    if GitHub doesn't say (e.g., it can't be reached, or it's rate-limited
+    us) then a stale answer is left alone, but if there isn't one, "don't
+    know" is cached for a short while, so pages don't keep waiting for
+    GitHub while it's unhappy. This runs in its own thread, so it's given
+    what it needs rather than the user (an ORM object)."""
+    with app.app_context():
+        try:
+            repo_name = app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name]
+            # This only matches on repo name, not if it is a fork of the og repo.
+            try:
+                response = github.get(f"/repos/{github_username}/{repo_name}")
+            except (OSError, HTTPException) as e:
+                # e.g., name address failure: if network connection isn't
+                # possible or GitHub has... gone: try again next time
+                vcs_name = app.config[ConfigSettingNames.VCS_NAME.name]
+                print(f"[!] failed to connect to {vcs_name}: {e}")
+                response = None
+            if response is not None and response.status == 200:
+                _cache_course_repository(cache_key, "html_url" in response.json())
+            elif response is not None and response.status == 404:
+                _cache_course_repository(cache_key, False)
+            elif cache.get(cache_key) is None: # e.g., 403 (rate limit) or 5xx
+                _cache_course_repository(cache_key, None)
+        finally:
+            with _course_repo_lookups_lock:
+                _course_repo_lookups.pop(cache_key, None)
+
+def _start_course_repository_lookup(app, github, github_username, cache_key):
+    """ Returns the thread looking up the course repo (only one lookup per
+    repo runs at a time in each process)"""
+    with _course_repo_lookups_lock:
+        if (lookup := _course_repo_lookups.get(cache_key)) is None:
+            lookup = threading.Thread(
+                target=_look_up_course_repository,
+                args=(app, github, github_username, cache_key),
+                name=f"lookup-{cache_key}",
+                daemon=True,
+            )
+            _course_repo_lookups[cache_key] = lookup
+            lookup.start()
+    return lookup
+
 class Role(SurrogatePK, Model):
     """A role for a user."""
 
@@ -82,6 +158,9 @@ class User(UserMixin, SurrogatePK, Model):
     """A user of the app."""
 
     __tablename__ = "users"
+    __table_args__ = (
+        db.Index("ix_users_is_student_is_active", "is_student", "is_active"),
+    )
     username = Column(db.String(80), unique=True, nullable=False)
     ext_username = Column(db.String(80), unique=True, nullable=True)
     ext_id = Column(db.String(80), unique=True, nullable=True)
@@ -94,7 +173,11 @@ class User(UserMixin, SurrogatePK, Model):
     is_active = Column(db.Boolean(), default=True)
     is_admin = Column(db.Boolean(), default=False)
     access_level = Column(db.Integer, nullable=False, default=0)
-    latest_json = Column(db.Text(), default="")
+    # big text columns are deferred: they aren't loaded with the user (on
+    # every request, for current_user) unless they are read, or the query
+    # undefers them (see query_summaries)
+    latest_json = db.deferred(Column(db.Text(), default=""))
+    json_length = db.query_expression() # only set by query_summaries
     github_username = Column(db.Text(), nullable=True)
     github_access_token = Column(db.Text(), nullable=True)
     is_student = Column(db.Boolean(), default=True)
@@ -107,9 +190,9 @@ class User(UserMixin, SurrogatePK, Model):
     api_secret_count = Column(db.Integer, nullable=False, default=0)
     is_api_secret_otp = Column(db.Boolean, nullable=False, default=False)
     api_key = Column(db.String(30), nullable=True)
-    comment = Column(db.Text(), default=False)
+    comment = db.deferred(Column(db.Text(), default=False))
     is_demo_user = Column(db.Boolean(), default=False)
-    project_notice = Column(db.Text(), nullable=True)
+    project_notice = db.deferred(Column(db.Text(), nullable=True))
     submission_deadline = Column(db.DateTime(timezone=True), nullable=True)
     submission_link = Column(db.String(128), nullable=True)
     buggies = db.relationship("Buggy", backref="users", cascade="all, delete", lazy=True)
@@ -238,9 +321,14 @@ class User(UserMixin, SurrogatePK, Model):
     def is_teaching_assistant(self):
       return self.is_active and self.access_level == User.TEACHING_ASSISTANT
 
+    @staticmethod
+    def get_pretty_username(username):
+        """ For when there's only the username (and not the user) to hand"""
+        return username.title() if current_app.config[ConfigSettingNames.IS_PRETTY_USERNAME_TITLECASE.name] else username
+
     @property
     def pretty_username(self):
-        return self.username.title() if current_app.config[ConfigSettingNames.IS_PRETTY_USERNAME_TITLECASE.name] else self.username
+        return User.get_pretty_username(self.username)
 
     @property
     def full_name(self):
@@ -249,11 +337,44 @@ class User(UserMixin, SurrogatePK, Model):
 
     @property
     def pretty_json_length(self):
-        """pragmatic length of JSON (less than 2 is 0)"""
-        if self.latest_json is not None and len(self.latest_json) > 1:
-            return len(self.latest_json)
-        else:
-            return 0
+        """pragmatic length of JSON (less than 2 is 0): if the query worked
+        out json_length (see query_summaries), the JSON itself isn't loaded"""
+        json_length = self.json_length
+        if json_length is None:
+            json_length = len(self.latest_json or "")
+        return json_length if json_length > 1 else 0
+
+    @staticmethod
+    def get_json_length_expr():
+        return sql.func.coalesce(sql.func.length(User.latest_json), 0)
+
+    @staticmethod
+    def query_summaries(*columns):
+        """ Query for lists of users, which don't need the big text columns:
+        those stay deferred (unless they are in columns, e.g., User.comment)
+        and the database works out the length of the JSON (json_length)"""
+        return User.query.options(
+            orm.with_expression(User.json_length, User.get_json_length_expr()),
+            *[orm.undefer(column) for column in columns],
+        )
+
+    @staticmethod
+    def query_api_auth():
+        """ Query for authenticating API calls, which come in bursts: only
+        loads what the authentication needs (anything else, such as the
+        user's roles, is loaded if it's read)"""
+        return User.query.options(
+            orm.load_only(
+                User.username,
+                User.api_key,
+                User.api_secret,
+                User.api_secret_at,
+                User.api_secret_count,
+                User.is_api_secret_otp,
+                User.is_active,
+                User.access_level,
+            )
+        )
 
     @property
     def is_live_demo_user(self):
@@ -290,27 +411,42 @@ class User(UserMixin, SurrogatePK, Model):
         """Check if the creditals for github exist and are valid"""
         return self.github_access_token is not None
 
-    # Chached for the lifetime of the user object (so, likely only for each
-    # request).
-    def has_course_repository(self):
-        """Check if the course repo exists for this user"""
-        if not self._has_course_repository:
-            # This only matches on repo name, not if it is a fork of the og repo.
-            try:
-                repo = self.github.get(f"/repos/{self.github_username}/{current_app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name]}").json()
-            except gaierror as gaie:
-                # name address failure: if network connection isn't possible or
-                # GitHub has... gone, then Just Say No
-                # This may be temporary, but we'll probably reconnect on next try?
-                vcs_name = current_app.config[ConfigSettingNames.VCS_NAME.name]
-                print(f"[!] failed to connect to {vcs_name}: {gaie}")
-                self._has_course_repository = False 
-                return False
-            else:
-                if not 'html_url' in repo:
-                    return False
-            self._has_course_repository = True
-        return True
+    def _get_course_repository_cache_key(self):
+        repo_name = current_app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name]
+        return f"course-repo/{self.github_username}/{repo_name}"
+
+    def has_course_repository(self, max_wait=COURSE_REPO_LOOKUP_WAIT):
+        """Check if the course repo exists for this user. GitHub's answer is
+        cached in the app's cache (see CACHE_TYPE: only a shared backend,
+        like redis, shares it between workers), keyed on the GitHub username
+        and the repo name. A stale answer is still used, while it's
+        refreshed in the background. If there's no answer at all, this waits
+        up to max_wait seconds for GitHub before saying no (max_wait=None
+        waits as long as it takes, e.g., before forking). If GitHub didn't
+        answer last time, this says no without waiting, until it's time to
+        ask again."""
+        if self._has_course_repository is None:
+            cache_key = self._get_course_repository_cache_key()
+            cached = cache.get(cache_key) if max_wait is not None else None
+            if cached is None or cached["fresh_until"] < time.time():
+                lookup = _start_course_repository_lookup(
+                    current_app._get_current_object(),
+                    self.github,
+                    self.github_username,
+                    cache_key,
+                )
+                if cached is None:
+                    lookup.join(max_wait)
+                    cached = cache.get(cache_key)
+            if cached is None or cached["has_repo"] is None:
+                return False # don't know (yet): not remembered on this object
+            self._has_course_repository = cached["has_repo"]
+        return self._has_course_repository
+
+    def set_has_course_repository(self, has_repo):
+        """Remember the course repo exists (e.g., having just forked it)"""
+        _cache_course_repository(self._get_course_repository_cache_key(), has_repo)
+        self._has_course_repository = has_repo
 
     @property
     def course_repository(self):
@@ -326,6 +462,6 @@ class User(UserMixin, SurrogatePK, Model):
                 'Accept': 'application/json',
                 'Authorization': f"token {self.github_access_token}",
                 'User-Agent': 'Buggy Race Server'
-            }, "https://api.github.com")
+            }, "https://api.github.com", write_interval=GITHUB_WRITE_INTERVAL)
 
         return self._github
@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
 """User views."""
-import time
 from datetime import datetime, timezone
-import threading
 import markdown
 from markupsafe import Markup
 from flask import (
@@ -23,15 +21,14 @@ from functools import wraps
 from wtforms import ValidationError
 
 from buggy_race_server.admin.forms import TaskTextForm, TaskTextDeleteForm
-from buggy_race_server.admin.models import TaskText, Task
+from buggy_race_server.admin.jobs import enqueue_job
+from buggy_race_server.admin.models import Job, TaskText, Task
 from buggy_race_server.buggy.forms import BuggyJsonForm
 from buggy_race_server.config import AnnouncementTypes, ConfigSettings, ConfigSettingNames
-from buggy_race_server.lib.issues import IssueParser
 from buggy_race_server.user.models import User
 from buggy_race_server.user.forms import ChangePasswordForm, ApiSecretForm
 from buggy_race_server.utils import (
     active_user_required,
-    join_to_project_root,
     flash_errors,
     get_download_filename,
     get_pretty_approx_duration,
@@ -150,14 +147,26 @@ def submit_buggy_data():
 @active_user_required
 def setup_course_repository():
     """Create a new fork of the BUGGY_EDITOR_REPO if one doesn't already exist"""
-    if current_user.has_course_repository():
+    if current_user.has_course_repository(max_wait=None): # ask GitHub if need be
         flash("Didn't try to fork: it looks like there's already a repo there", "danger")
         return redirect(url_for('user.home_page'))
 
-    # Forking is async so we assume we're successful and hope for the best!
+    # Forking is async: GitHub says 202 (Accepted) if the fork is under way,
+    # so anything else means there won't be a repo (and it's not cached)
     repo = current_user.github.post(
         f"/repos/{current_app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_OWNER.name]}"
         f"/{current_app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name]}/forks")
+    if repo.status != 202:
+        try:
+            github_message = repo.json().get("message")
+        except (ValueError, AttributeError):
+            github_message = None
+        flash(
+            f"Failed to fork the repo: GitHub said {repo.status}"
+            f"{f' ({github_message})' if github_message else ''}",
+            "danger"
+        )
+        return redirect(url_for('user.home_page'))
 
     # Forks don't get issues by default
     current_user.github.patch(
@@ -165,53 +174,19 @@ def setup_course_repository():
         {},
         { 'has_issues': 'true'}
     )
-
-    # this could probably be cached?
-    # needs to run in current app context (same thread)
-    issues_parser = IssueParser(
-        join_to_project_root(
-          current_app.config[ConfigSettingNames._PUBLISHED_PATH.name],
-          current_app.config[ConfigSettingNames._BUGGY_EDITOR_ISSUES_CSV_FILE.name]
-        ),
-        current_app.config[ConfigSettingNames.BUGGY_EDITOR_ISSUES_CSV_HEADER_ROW.name]
-    )
-
-    def inject_issues_into_repo(user, repo_name, issues_parser):
-        # passing arguments to avoid dependency on app context (this runs in another thread)
-        #
-        # CONTEXT ONY: ---Issues appear in most recent order and we want the first task
-        # to appear as the most recent issue!---
-        #
-        # Except then when the github api rate limits us, the first issues
-        # don't get delivered :(
-        for i, issue in enumerate(issues_parser.parse_issues()):
-            response = user.github.post(
-                f"/repos/{user.github_username}/{repo_name}/issues",
-                {},
-                {
-                    'title': issue['title'],
-                    'body': issue['body'],
-                    'assignees': [user.github_username]
-                }
-            )
-
-            # We were trigger abuse stuff from github so go slowly!
-            # See here: https://docs.github.com/en/rest/guides/best-practices-for-integrators#dealing-with-abuse-rate-limits
-            time.sleep(2.0)
+    current_user.set_has_course_repository(True)
 
     # delay here in case the has_issues patch is taking a while to authenticate...
     # since the repo is always being made but the first 1d6 issues aren't making it
     #
-    # Note: inject_issues_into_repo must will run _without_ an app context
-    threading.Timer(
-        DELAY_BEFORE_INJECTING_ISSUES,
-        inject_issues_into_repo,
-        args=[
-          current_user._get_current_object(),
-          current_app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name],
-          issues_parser,
-        ]
-    ).start()
+    # Note: the issues are injected by a job (which survives this process
+    # being recycled, and carries on from where it was)
+    enqueue_job(
+        Job.INJECT_ISSUES_TYPE,
+        params={"repo_name": current_app.config[ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name]},
+        user=current_user,
+        delay=DELAY_BEFORE_INJECTING_ISSUES,
+    )
 
     return redirect(url_for('user.home_page'))
 
@@ -1,21 +1,22 @@
 # -*- coding: utf-8 -*-
 """Helper utilities and decorators."""
+import io
 import json
 import os # for path
 import re
 import csv
 from collections import defaultdict
 
-from flask import abort, flash, request, redirect, url_for, current_app, render_template, make_response
+from flask import abort, flash, request, redirect, url_for, current_app, render_template, make_response, send_file
 from wtforms import ValidationError
 from functools import wraps, update_wrapper
 from flask_login import current_user, logout_user
 import shutil # for publishing the editor
 
 from buggy_race_server.config import ConfigSettingNames, ConfigSettings, ConfigTypes, DistribMethods
-from buggy_race_server.admin.models import Announcement, DbFile, Setting, Task, TaskText
-from buggy_race_server.extensions import db, bcrypt
-from sqlalchemy import bindparam, insert, update
+from buggy_race_server.admin.models import Announcement, CacheVersion, DbFile, Setting, Task, TaskText
+from buggy_race_server.extensions import db, bcrypt, blob_store, cache
+from sqlalchemy import bindparam, insert, select, update
 from datetime import datetime, timezone
 import subprocess
 
@@ -31,12 +32,66 @@ def cors_allow_origin(func):
         return response
     return decorated_function
 
-def refresh_global_announcements(app):
-  announcements = []
-  # build the list up explicitly, to force the underlying query to execute
-  for ann in Announcement.query.filter_by(is_visible=True):
-      announcements.append(ann)
-  app.config[ConfigSettingNames._CURRENT_ANNOUNCEMENTS.name] = announcements
+def send_blob(blob_hash, mimetype, download_name=None, max_age=None, content_encoding=None):
+    """ Serves a blob from the blob store: the hash is its (strong) ETag, so
+    conditional (and range) requests work. If the blob is a file, send_file
+    lets the server send it without reading it into memory (sendfile).
+    If content_encoding is set (e.g., "gzip"), the blob is the resource in
+    that encoding: conditional requests still work, but range requests are
+    ignored (the whole thing is sent), because the range would be of the
+    encoded bytes, not of the resource the client asked for."""
+    blob_path = blob_store.path_for(blob_hash)
+    if blob_path is not None and os.path.isfile(blob_path):
+        blob_file = blob_path
+    elif (data := blob_store.get(blob_hash)) is not None:
+        blob_file = io.BytesIO(data)
+    else:
+        abort(404)
+    response = send_file(
+        blob_file,
+        mimetype=mimetype,
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        etag=blob_hash,
+        conditional=content_encoding is None,
+        max_age=max_age,
+    )
+    if content_encoding is not None:
+        response.headers["Content-Encoding"] = content_encoding
+        response.make_conditional(request, accept_ranges=False)
+    if download_name is None: # don't offer the hash as a filename
+        del response.headers["Content-Disposition"]
+    return response
+
+def refresh_global_announcements(app, announcements_version=None):
+    """ Loads the visible announcements (as dicts: see Announcement.to_dict)
+        into the app's config, where every page's layout finds them. They
+        are cached, keyed on the announcements version (see CacheVersion),
+        so (with a shared CACHE_TYPE) workers share them: only the first to
+        load a new version needs to query the announcements table."""
+    if announcements_version is None:
+        announcements_version = CacheVersion.get_version(CacheVersion.ANNOUNCEMENTS)
+    cache_key = f"announcements/{announcements_version}"
+    announcements = cache.get(cache_key)
+    if announcements is None:
+        announcements = [
+            ann.to_dict()
+            for ann in Announcement.query.filter_by(is_visible=True).order_by(Announcement.id)
+        ]
+        cache.set(cache_key, announcements)
+    app.config[ConfigSettingNames._CURRENT_ANNOUNCEMENTS.name] = announcements
+    app.config[ConfigSettings.ANNOUNCEMENTS_VERSION_KEY] = announcements_version
+
+def refresh_announcements_if_stale(app, announcements_version=None):
+    """ Like refresh_settings_if_stale, but for the announcements: only
+        reloads them if another worker has changed them"""
+    loaded_version = app.config.get(ConfigSettings.ANNOUNCEMENTS_VERSION_KEY)
+    if loaded_version is None:
+        return # announcements were never loaded (e.g., no table yet)
+    if announcements_version is None:
+        announcements_version = CacheVersion.get_version(CacheVersion.ANNOUNCEMENTS)
+    if announcements_version != loaded_version:
+        refresh_global_announcements(app, announcements_version)
 
 def flash_errors(form, category="warning"):
     """Flash all errors for a form."""
@@ -132,11 +187,14 @@ def save_config_env_overrides_to_db(app):
       the database. This mechanism allows ENV overriding of bad/broken config.
     """
     if not str(app.config.get(ConfigSettings.BYPASSING_DB_CONFIG_KEY))=="1":
+        env_settings = {}
         for name in app.config.get(ConfigSettings.ENV_SETTING_OVERRIDES_KEY):
             value = app.config.get(name) # expecting a value here
             if value is not None:
-                set_and_save_config_setting(app, name, value)
-                print(f"* written {name} config setting (from ENV) into database", flush=True)
+                env_settings[name] = value
+        save_config_settings(app, env_settings)
+        for name in env_settings:
+            print(f"* written {name} config setting (from ENV) into database", flush=True)
 
 def load_settings_from_db(app):
     """ Read settings from db and set the app's config appropriately.
@@ -149,6 +207,9 @@ def load_settings_from_db(app):
 
         Also, this includes non-persistent config settings
     """
+    # read the version first: if settings change while they're loading,
+    # the next refresh_settings_if_stale will catch that
+    settings_version = CacheVersion.get_version(CacheVersion.SETTINGS)
     settings = Setting.query.all()
     names_found_in_db = [setting.id for setting in settings if ConfigSettings.is_valid_name(setting.id)]
     missing_settings = []
@@ -165,16 +226,45 @@ def load_settings_from_db(app):
             )
     if missing_settings:
         db.session.execute(insert(Setting.__table__), missing_settings)
+        CacheVersion.bump(CacheVersion.SETTINGS, commit=False)
         db.session.commit()
+        settings_version += 1
         print(f"* inserted {len(missing_settings)} config settings (with default values) into database", flush=True)
         # now reload settings: this time it won't have any missing
         settings = Setting.query.all()
 
-    for setting in settings:
+    settings_as_dict = Setting.get_dict_from_db(settings)
+    for name, value in settings_as_dict.items():
         # set_config_value casts to correct type (e.g., bool/int/str)
-        ConfigSettings.set_config_value(app, setting.id, setting.value)
-
-    return Setting.get_dict_from_db(settings) # pass the settings back as a dict
+        ConfigSettings.set_config_value(app, name, value)
+    app.config[ConfigSettings.LOADED_SETTINGS_KEY] = dict(settings_as_dict)
+    app.config[ConfigSettings.SETTINGS_VERSION_KEY] = settings_version
+    return settings_as_dict # pass the settings back as a dict
+
+def refresh_settings_if_stale(app, settings_version=None):
+    """ Called on every request: settings are loaded into each worker's config
+        but can be changed by any worker, which bumps the settings version.
+        So this is one cheap query (none, if the caller already has the
+        version), unless the version has changed, in which case only the
+        settings whose values have changed are set again.
+        Returns the names of the settings that changed.
+    """
+    loaded_version = app.config.get(ConfigSettings.SETTINGS_VERSION_KEY)
+    if loaded_version is None:
+        return [] # settings were never loaded from the database (e.g., no table yet)
+    if settings_version is None:
+        settings_version = CacheVersion.get_version(CacheVersion.SETTINGS)
+    if settings_version == loaded_version:
+        return []
+    loaded_settings = app.config[ConfigSettings.LOADED_SETTINGS_KEY]
+    changed_names = []
+    for setting in Setting.query.all():
+        if loaded_settings.get(setting.id) != setting.value:
+            ConfigSettings.set_config_value(app, setting.id, setting.value)
+            loaded_settings[setting.id] = setting.value
+            changed_names.append(setting.id)
+    app.config[ConfigSettings.SETTINGS_VERSION_KEY] = settings_version
+    return changed_names
 
 def is_poster(app):
     """ the PROJECT_POSTER_TYPE setting may depend on the PROJECT_REPORT_TYPE
@@ -188,30 +278,67 @@ def is_poster(app):
 def set_and_save_config_setting(app, name, value):
     # this changes the app's config setting and also saves that
     # change in the database.
-    # This isn't used much because the admin settings page (the
-    # way settings are usually changed) uses bulk updates because
-    # the forms handle groups of settings.
-
-    ConfigSettings.set_config_value(app, name, value)
-
-    if app.config.get(name) is not None:
-        if ConfigSettings.DEFAULTS[name] == ConfigTypes.BOOLEAN:
+    # If you're changing more than one setting, use save_config_settings
+    # instead, which does them all in one go.
+    save_config_settings(app, {name: value})
+
+def save_config_settings(app, settings):
+    """ Saves settings (a dict of name: value) in the database and sets them
+        in the app's config, in one transaction: settings that are already in
+        the database are updated, the rest are inserted. Settings that
+        haven't changed are skipped (so aren't cast again). Bumps the
+        settings version, so other workers reload them (if any changed).
+        Returns the names of the settings that changed.
+    """
+    str_settings = {}
+    for name, value in settings.items():
+        if ConfigSettings.TYPES.get(name) == ConfigTypes.BOOLEAN and isinstance(value, bool):
             value = 1 if value else 0
-    setting = db.session.query(Setting).filter_by(id=name).first()
+        str_settings[name] = str(value)
+    if not str_settings:
+        return []
     settings_table = Setting.__table__
-    if setting is None: # not already in db? then make it
+    values_in_db = dict(
         db.session.execute(
-          insert(settings_table),
-          [ {"id": name, "value": value} ]
-        )
-    else:
+            select(settings_table.c.id, settings_table.c.value)
+              .where(settings_table.c.id.in_(str_settings.keys()))
+        ).all()
+    )
+    settings_to_update = []
+    settings_to_insert = []
+    for name, str_value in str_settings.items():
+        if name not in values_in_db:
+            settings_to_insert.append({"id": name, "value": str_value})
+        elif values_in_db[name] != str_value:
+            settings_to_update.append({"name": name, "value": str_value})
+    if settings_to_update:
         db.session.execute(
           update(settings_table)
             .where(settings_table.c.id == bindparam("name"))
             .values(value=bindparam("value")),
-            [ {"name": name, "value": value} ]
+            settings_to_update
         )
-    db.session.commit()
+    if settings_to_insert:
+        db.session.execute(insert(settings_table), settings_to_insert)
+    changed_names = [setting["name"] for setting in settings_to_update]
+    changed_names += [setting["id"] for setting in settings_to_insert]
+    if changed_names:
+        CacheVersion.bump(CacheVersion.SETTINGS, commit=False)
+        db.session.commit()
+    loaded_settings = app.config.setdefault(ConfigSettings.LOADED_SETTINGS_KEY, {})
+    for name, str_value in str_settings.items():
+        if name in changed_names or loaded_settings.get(name) != str_value:
+            ConfigSettings.set_config_value(app, name, str_value)
+            loaded_settings[name] = str_value
+    return changed_names
+
+def get_settings_as_dict(app):
+    """ Returns the settings as they are in the database (that is, before
+        they're cast to their types), without going to the database: this
+        worker's copy is up to date (see refresh_settings_if_stale)"""
+    if (loaded_settings := app.config.get(ConfigSettings.LOADED_SETTINGS_KEY)) is None:
+        return Setting.get_dict_from_db(Setting.query.all())
+    return dict(loaded_settings)
 
 def load_config_setting(app, name):
     """ loads config setting from database, and returns value """
@@ -484,16 +611,12 @@ def load_tasks_into_db(task_source_filename, app=None, want_overwrite=False):
     db.session.execute(insert(Task.__table__), new_tasks)
     db.session.commit()
     if app is not None:
-        set_and_save_config_setting(
-            app,
-            ConfigSettingNames._TASKS_LOADED_DATETIME.name,
-            datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        )
-        set_and_save_config_setting(
-            app,
-            ConfigSettingNames._TASKS_EDITED_DATETIME.name,
-            "" # reset (clear) edited timestamp
-        )
+        save_config_settings(app, {
+            ConfigSettingNames._TASKS_LOADED_DATETIME.name:
+                datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            ConfigSettingNames._TASKS_EDITED_DATETIME.name:
+                "", # reset (clear) edited timestamp
+        })
     return len(new_tasks)
 
 def parse_task_markdown(task_source_filename):
@@ -626,7 +749,7 @@ def publish_task_list(app=current_app):
             replacement_html_str = hint_match.group(0)
         return replacement_html_str
 
-    tasks_by_phase = Task.get_dict_tasks_by_phase(want_hidden=False)
+    tasks_by_phase = Task.get_dict_tasks_by_phase(want_hidden=False, want_texts=True)
     qty_tasks = sum(len(tasks_by_phase[phase]) for phase in tasks_by_phase)
     created_at = datetime.now(timezone.utc)
     vcs_name=app.config[ConfigSettingNames.VCS_NAME.name]
@@ -699,7 +822,7 @@ def publish_tasks_as_issues_csv(app=current_app):
     is_line_terminator_crlf = app.config[ConfigSettingNames.IS_ISSUES_CSV_CRLF_TERMINATED.name]
     want_reversed = app.config[ConfigSettingNames.IS_ISSUES_CSV_IN_REVERSE_ORDER.name]
     csv = get_tasks_as_issues_csv(
-        Task.query.filter_by(is_enabled=True).order_by(
+        Task.query_with_texts().filter_by(is_enabled=True).order_by(
                 Task.phase.desc() if want_reversed else Task.phase.asc(),
                 Task.sort_position.desc() if want_reversed else Task.sort_position.asc(),
             ).all(),
@@ -0,0 +1,101 @@
+"""indexes for hot lookups, and one buggy per user and one text per task
+
+Revision ID: c93f1e6a2b58
+Revises: a41f7d2c8e65
+Create Date: 2026-10-18 16:12:40.582106
+
+"""
+import logging
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c93f1e6a2b58'
+down_revision = 'a41f7d2c8e65'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+# set this (to anything) to let the upgrade delete duplicate rows
+DELETE_DUPLICATES_ENV_NAME = "DELETE_DUPLICATE_ROWS"
+
+DUPLICATE_COLUMNS = {
+    'buggies': ('user_id',),
+    'tasktexts': ('user_id', 'task_id'),
+}
+
+
+def get_table(table_name):
+    return sa.table(
+        table_name,
+        sa.column("id"),
+        *[sa.column(name) for name in DUPLICATE_COLUMNS[table_name]]
+    )
+
+
+def get_duplicate_ids(table_name):
+    """ Before a unique index can go on, any duplicates must go: the app
+    always found the first (lowest id) row, so that's the one that's kept,
+    and this returns the ids of the rest"""
+    table = get_table(table_name)
+    first_ids = sa.select(sa.func.min(table.c.id)).group_by(
+        *[table.c[name] for name in DUPLICATE_COLUMNS[table_name]]
+    )
+    return op.get_bind().execute(
+        sa.select(table.c.id).where(table.c.id.not_in(first_ids)).order_by(table.c.id)
+    ).scalars().all()
+
+
+def delete_duplicates(duplicate_ids_by_table):
+    """ Duplicates are only deleted if DELETE_DUPLICATE_ROWS is set: otherwise
+    the upgrade stops (before changing anything) and says which rows they are,
+    so they can be checked (and fixed by hand) first"""
+    duplicate_ids_by_table = {
+        table_name: ids for (table_name, ids) in duplicate_ids_by_table.items() if ids
+    }
+    if not duplicate_ids_by_table:
+        return
+    report = "; ".join(
+        f"{len(ids)} in {table_name} (ids: {', '.join(str(id) for id in ids)})"
+        for (table_name, ids) in duplicate_ids_by_table.items()
+    )
+    if not os.environ.get(DELETE_DUPLICATES_ENV_NAME):
+        raise RuntimeError(
+            f"Duplicate rows must go before the unique indexes can be added: {report}. "
+            f"Nothing has been changed: to keep the first (lowest id) of each and "
+            f"delete these, set {DELETE_DUPLICATES_ENV_NAME}=1 and run the upgrade again"
+        )
+    logger.warning(f"Deleting duplicate rows: {report}")
+    for table_name, ids in duplicate_ids_by_table.items():
+        table = get_table(table_name)
+        op.execute(sa.delete(table).where(table.c.id.in_(ids)))
+
+
+def upgrade():
+    delete_duplicates({table_name: get_duplicate_ids(table_name) for table_name in DUPLICATE_COLUMNS})
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_index('ix_buggies_user_id', 'buggies', ['user_id'], unique=True)
+    op.create_index('ix_db_files_type_item_id', 'db_files', ['type', 'item_id'], unique=False)
+    op.create_index('ix_races_is_visible_start_at', 'races', ['is_visible', 'start_at'], unique=False)
+    op.create_index('ix_results_race_id', 'results', ['race_id'], unique=False)
+    op.create_index('ix_results_user_id', 'results', ['user_id'], unique=False)
+    op.create_index('ix_tasktexts_user_id_task_id', 'tasktexts', ['user_id', 'task_id'], unique=True)
+    op.create_index('ix_users_is_student_is_active', 'users', ['is_student', 'is_active'], unique=False)
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index('ix_users_is_student_is_active', table_name='users')
+    op.drop_index('ix_tasktexts_user_id_task_id', table_name='tasktexts')
+    op.drop_index('ix_results_user_id', table_name='results')
+    op.drop_index('ix_results_race_id', table_name='results')
+    op.drop_index('ix_races_is_visible_start_at', table_name='races')
+    op.drop_index('ix_db_files_type_item_id', table_name='db_files')
+    op.drop_index('ix_buggies_user_id', table_name='buggies')
+    # ### end Alembic commands ###
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Helper for checking that queries use the indexes they're meant to.
+
+The plan comes from the database's own EXPLAIN, so this works on SQLite,
+PostgreSQL and MySQL: the tests' tables are tiny, so PostgreSQL is told not
+to bother with sequential scans (which would win on a handful of rows).
+"""
+
+
+def get_query_plan(connection, statement):
+    """ Returns the plan for the statement as a list of strings (one per step
+    or line of the plan), from the database's EXPLAIN """
+    dialect = connection.dialect.name
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    if dialect == "sqlite":
+        return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+    if dialect == "postgresql":
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {sql}")]
+    if dialect in ("mysql", "mariadb"):
+        return [
+            f"{row['table']} key={row['key']} possible_keys={row['possible_keys']} {row['Extra']}"
+            for row in connection.exec_driver_sql(f"EXPLAIN {sql}").mappings()
+        ]
+    raise NotImplementedError(f"don't know how to get query plans from {dialect}")
+
+
+def assert_uses_index(connection, statement, index_name):
+    """ Fails (showing the plan) if the statement's plan doesn't use the index """
+    plan = get_query_plan(connection, statement)
+    if connection.dialect.name in ("mysql", "mariadb"):
+        is_using_index = any(f"key={index_name} " in step for step in plan)
+    else:
+        is_using_index = any(index_name in step for step in plan)
+    assert is_using_index, f"expected plan to use {index_name}:\n" + "\n".join(plan)
+
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""API authentication and batch upload tests."""
+
+from datetime import datetime, timezone
+
+import pytest
+from flask import Response, current_app, request
+
+from buggy_race_server.api.views import get_user_or_response_from_api_post
+from buggy_race_server.buggy.models import Buggy
+from buggy_race_server.buggy.views import save_uploaded_buggies
+from buggy_race_server.config import ConfigSettingNames
+from buggy_race_server.database import db
+from buggy_race_server.user.models import User
+
+
+@pytest.fixture
+def api_user(db, monkeypatch):
+    monkeypatch.setitem(current_app.config, ConfigSettingNames.API_SECRET_TIME_TO_LIVE.name, 3600)
+    return User.create(
+        username="foo",
+        email="foo@bar.com",
+        api_key="ABC123",
+        api_secret="s3cret",
+        api_secret_at=datetime.now(timezone.utc),
+        is_api_secret_otp=True,
+    )
+
+
+def _authenticate(**form):
+    data = {"user": "foo", "key": "ABC123", "secret": "s3cret", **form}
+    with current_app.test_request_context(method="POST", data=data):
+        user_or_response = get_user_or_response_from_api_post(request)
+        if isinstance(user_or_response, Response):
+            return user_or_response.get_json()["error"]
+        db.session.commit()
+        return user_or_response.username
+
+
+class TestApiAuth:
+    """Users are authenticated by their API key and (maybe one-time) secret."""
+
+    def test_wrong_key(self, api_user):
+        assert _authenticate(key="ABC124") == "not authorised (wrong API key for this user)"
+
+    def test_wrong_secret(self, api_user):
+        assert _authenticate(secret="s3cre") == "not authorised (bad secret)"
+
+    def test_one_time_secret_is_used_once(self, api_user):
+        user_id = api_user.id
+        assert _authenticate() == "foo"
+        assert _authenticate() == "one-time secret has already been used"
+        assert db.session.get(User, user_id).api_secret_count == 1
+
+
+class TestBatchUpload:
+    """Buggies are cleaned like single uploads, but saved together."""
+
+    def test_create_and_update(self, api_user):
+        other_user = User.create(username="bar", email="bar@foo.com")
+        Buggy.create(user_id=other_user.id, qty_wheels=8)
+        results = save_uploaded_buggies(
+            [
+                ("foo", '{"qty_wheels": 6, "power_type": "fusion"}'),
+                ("bar", {"qty_tyres": 10, "armour": "cardboard"}),
+                ("nobody", "{}"),
+                ("foo", "{not json"),
+            ],
+            "red",
+        )
+        assert results[0]["ok"] == "buggy created OK"
+        assert results[1]["ok"] == "buggy updated OK"
+        assert results[1]["warnings"] == [
+            'Value for armour was ignored because "cardboard" is not a valid choice'
+        ]
+        assert results[2]["error"] == "no such user"
+        assert results[3]["error"] == "Failed to parse JSON data"
+        buggy = Buggy.query.filter_by(user_id=api_user.id).one()
+        assert (buggy.qty_wheels, buggy.power_type, buggy.flag_color) == (6, "fusion", "red")
+        updated_buggy = Buggy.query.filter_by(user_id=other_user.id).one()
+        assert (updated_buggy.qty_wheels, updated_buggy.qty_tyres) == (4, 10)
+        # totals are worked out, even though bulk statements skip the ORM
+        expected = Buggy(**{**Buggy.DEFAULTS, "qty_tyres": 10})
+        assert (updated_buggy.total_cost, updated_buggy.mass) == (expected.total_cost, expected.mass)
+        assert User.query.filter_by(username="foo").one().latest_json == "{not json"
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Blob store tests (these don't need the app)."""
+
+import sqlalchemy as sa
+import pytest
+
+from buggy_race_server.lib.blob_store import DatabaseBlobs, FilesystemBlobs, get_blob_hash
+
+DATA = b"\x89PNG not really an image"
+
+
+@pytest.fixture(params=["filesystem", "db"])
+def blobs(request, tmp_path):
+    if request.param == "filesystem":
+        yield FilesystemBlobs(str(tmp_path))
+    else:
+        engine = sa.create_engine("sqlite://")
+        with engine.begin() as conn:
+            conn.execute(sa.text("CREATE TABLE blobs (hash VARCHAR(64) PRIMARY KEY, size INTEGER, data BLOB)"))
+            yield DatabaseBlobs(lambda: conn)
+
+
+class TestBlobStore:
+    """Blobs are stored once, under the hash of their contents."""
+
+    def test_put_returns_hash(self, blobs):
+        assert blobs.put(DATA) == get_blob_hash(DATA)
+        assert blobs.has(get_blob_hash(DATA))
+        assert blobs.get(get_blob_hash(DATA)) == DATA
+
+    def test_put_twice_is_harmless(self, blobs):
+        assert blobs.put(DATA) == blobs.put(DATA)
+        assert blobs.get(get_blob_hash(DATA)) == DATA
+
+    def test_missing_blob(self, blobs):
+        missing_hash = get_blob_hash(b"never stored")
+        assert not blobs.has(missing_hash)
+        assert blobs.get(missing_hash) is None
+
+    def test_delete(self, blobs):
+        blob_hash = blobs.put(DATA)
+        blobs.delete(blob_hash)
+        assert not blobs.has(blob_hash)
+        blobs.delete(blob_hash) # already gone: no error
+
+    def test_only_files_have_paths(self, blobs):
+        blob_hash = blobs.put(DATA)
+        if isinstance(blobs, FilesystemBlobs):
+            with open(blobs.path_for(blob_hash), "rb") as f:
+                assert f.read() == DATA
+        else:
+            assert blobs.path_for(blob_hash) is None
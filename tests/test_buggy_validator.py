@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Buggy validator tests (these don't need the app or the database)."""
+
+from buggy_race_server.lib.buggy_validator import (
+    NOTHING_TO_CHANGE_MSG,
+    buggy_validator,
+    get_alphanumeric,
+)
+from buggy_race_server.lib.race_specs import BuggySpecs
+
+
+class TestBuggyValidator:
+    """Uploaded buggy data is cleaned, and the messages say how."""
+
+    def test_clean_data_has_defaults(self):
+        clean, messages = buggy_validator.validate({"qty_wheels": "6", "id": 3}, "red")
+        assert clean == {**BuggySpecs.DEFAULTS, "qty_wheels": 6, "flag_color": "red", "buggy_id": 3}
+        assert messages == [
+            ("1 setting was specified", "info"),
+            (f"{len(BuggySpecs.DEFAULTS) - 1} settings were not specified and got default values instead", "info"),
+        ]
+
+    def test_bad_values_are_ignored(self):
+        clean, messages = buggy_validator.validate(
+            {"power_type": "Fusion!", "armour": "cardboard", "banging": "yes", "qty_tyres": [4], "hat": 1}
+        )
+        assert clean["power_type"] == "fusion"
+        assert clean["armour"] == BuggySpecs.DEFAULTS["armour"]
+        assert clean["banging"] is False
+        assert clean["qty_tyres"] == BuggySpecs.DEFAULTS["qty_tyres"]
+        assert [category for (_, category) in messages[:4]] == ["warning"] * 4
+
+    def test_strings_are_truncated(self):
+        clean, messages = buggy_validator.validate({"flag_color": "#" + "ab" * 20})
+        assert clean["flag_color"] == "#" + "ab" * 15 + "a"
+        assert messages[0] == ("Value for flag_color was truncated to 32 characters", "warning")
+
+    def test_nothing_to_change(self):
+        clean, messages = buggy_validator.validate([{"qty_wheels": 6}])
+        assert clean is None
+        assert messages[-1] == (NOTHING_TO_CHANGE_MSG, "danger")
+
+    def test_alphanumeric(self):
+        assert get_alphanumeric("  #FF-00 aa ") == "#ff00aa"
+        assert get_alphanumeric("\u00c9lan \u212a") == "lank" # the Kelvin sign lowercases to k
+        assert get_alphanumeric("!!!") == ""
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Http client tests, against a stub server (these don't need the app)."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import pytest
+
+from buggy_race_server.lib import http
+from buggy_race_server.lib.http import Http
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.requests.append((self.command, self.path, self.client_address, dict(self.headers)))
+        if self.path == "/big":
+            body = b"x" * 100_000
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), 1000):
+                self.wfile.write(b"%x\r\n%s\r\n" % (1000, body[i:i+1000]))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self._reply(304, headers={"ETag": '"v1"'})
+            else:
+                self._reply(200, b'{"login": "ada"}', {"ETag": '"v1"'})
+        elif self.path == "/forbidden":
+            self._reply(403, b'{"message": "Must have admin rights to Repository."}')
+        elif self.path == "/hang-up":
+            self._reply(200, b'{"ok": true}')
+            self.close_connection = True # without saying so
+        elif stub.rate_limited_replies > 0:
+            stub.rate_limited_replies -= 1
+            self._reply(403, b'{"message": "API rate limit exceeded"}', stub.rate_limit_headers)
+        else:
+            self._reply(200, b'{"ok": true}')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.stub.requests.append((self.command, self.path, self.client_address, json.loads(body)))
+        self._reply(201, b'{"created": true}')
+
+
+class Stub:
+    def __init__(self):
+        self.requests = []
+        self.rate_limited_replies = 0
+        self.rate_limit_headers = {}
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.stub = Stub()
+    server.stub.base_url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.stub
+    Http.pool.clear()
+    Http.etag_cache.clear()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    waits = []
+    monkeypatch.setattr(http, "_sleep", waits.append)
+    return waits
+
+
+class TestHttp:
+    """Connections are reused, and rate limits are waited out."""
+
+    def test_connection_is_kept_alive(self, stub):
+        client = Http({}, stub.base_url)
+        assert client.get("/one").json() == {"ok": True}
+        assert client.post("/two", {}, {"n": 2}).status == 201
+        assert Http({}, stub.base_url).get("/three").status == 200
+        assert len({client_address for _, _, client_address, _ in stub.requests}) == 1
+
+    def test_chunked_body(self, stub):
+        assert Http({}, stub.base_url).get("/big").body == "x" * 100_000
+
+    def test_conditional_get(self, stub):
+        client = Http({"Authorization": "token abc"}, stub.base_url)
+        first = client.get("/etag")
+        second = client.get("/etag")
+        assert second.is_from_cache
+        assert second.status == 200
+        assert second.json() == first.json() == {"login": "ada"}
+        assert stub.requests[1][3]["If-None-Match"] == '"v1"'
+
+    def test_etag_cache_is_per_client(self, stub):
+        Http({"Authorization": "token abc"}, stub.base_url).get("/etag")
+        assert not Http({"Authorization": "token xyz"}, stub.base_url).get("/etag").is_from_cache
+
+    def test_retry_after(self, stub, waits):
+        stub.rate_limited_replies = 2
+        stub.rate_limit_headers = {"Retry-After": "5"}
+        assert Http({}, stub.base_url).get("/limited").status == 200
+        assert len(stub.requests) == 3
+        assert len(waits) == 2
+        assert all(4 < wait <= 5 for wait in waits)
+
+    def test_rate_limit_reset_too_far_away(self, stub, waits):
+        stub.rate_limited_replies = 1
+        stub.rate_limit_headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "9999999999"}
+        response = Http({}, stub.base_url, max_rate_limit_wait=60).get("/limited")
+        assert response.status == 403
+        assert waits == []
+
+    def test_forbidden_is_not_retried(self, stub, waits):
+        assert Http({}, stub.base_url).get("/forbidden").status == 403
+        assert len(stub.requests) == 1
+        assert waits == []
+
+    def test_server_closed_idle_connection(self, stub):
+        client = Http({}, stub.base_url)
+        assert client.get("/hang-up").status == 200
+        assert client.get("/one").status == 200
+        assert len({client_address for _, _, client_address, _ in stub.requests}) == 2
+
+    def test_writes_are_paced(self, stub, waits):
+        client = Http({}, stub.base_url, write_interval=1.0)
+        client.post("/issues", {}, {"title": "one"})
+        client.post("/issues", {}, {"title": "two"})
+        assert len(waits) == 1
+        assert 0 < waits[0] <= 1.0
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Job queue tests."""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from flask import current_app
+
+from buggy_race_server.admin.jobs import (
+    JOB_HEARTBEAT_TIMEOUT,
+    claim_next_job,
+    enqueue_job,
+)
+from buggy_race_server.admin.models import Job
+from buggy_race_server.admin.registration import read_users_from_csv, register_users
+from buggy_race_server.config import ConfigSettings
+from buggy_race_server.database import db
+from buggy_race_server.user.models import User
+
+
+def _make_running_job(job_type, seconds_since_heartbeat=0, attempts=1):
+    now = datetime.now(timezone.utc)
+    return Job(
+        type=job_type,
+        status=Job.RUNNING,
+        attempts=attempts,
+        run_after=now,
+        heartbeat_at=now - timedelta(seconds=seconds_since_heartbeat),
+    ).save()
+
+
+@pytest.mark.usefixtures("db")
+class TestJobQueue:
+    """Jobs are claimed by one worker at a time, and survive workers dying."""
+
+    def test_claim_marks_job_running(self):
+        job_id = enqueue_job(Job.BULK_REGISTER_TYPE, params={"users": []}).id
+        job = claim_next_job("worker-a")
+        assert job.id == job_id
+        assert job.status == Job.RUNNING
+        assert job.worker == "worker-a"
+        assert job.attempts == 1
+        assert claim_next_job("worker-b") is None
+
+    def test_delayed_job_is_not_due(self):
+        enqueue_job(Job.INJECT_ISSUES_TYPE, params={"repo_name": "x"}, delay=60)
+        assert claim_next_job("worker-a") is None
+
+    def test_exclusive_jobs_run_one_at_a_time(self):
+        _make_running_job(Job.PUBLISH_TECH_NOTES_TYPE)
+        enqueue_job(Job.PUBLISH_TECH_NOTES_TYPE)
+        assert claim_next_job("worker-a") is None
+        job_id = enqueue_job(Job.PUBLISH_TASK_LIST_TYPE).id
+        assert claim_next_job("worker-a").id == job_id
+
+    def test_abandoned_job_is_requeued(self):
+        job_id = _make_running_job(
+            Job.BULK_REGISTER_TYPE, seconds_since_heartbeat=JOB_HEARTBEAT_TIMEOUT + 1
+        ).id
+        job = claim_next_job("worker-b")
+        assert job.id == job_id
+        assert job.worker == "worker-b"
+        assert job.attempts == 2
+
+    def test_job_abandoned_too_often_fails(self):
+        job = _make_running_job(
+            Job.BULK_REGISTER_TYPE,
+            seconds_since_heartbeat=JOB_HEARTBEAT_TIMEOUT + 1,
+            attempts=Job.MAX_ATTEMPTS,
+        )
+        assert claim_next_job("worker-b") is None
+        assert job.status == Job.FAILED
+        assert job.is_finished
+
+
+@pytest.fixture
+def default_settings(db, monkeypatch):
+    # settings are usually loaded from the database
+    for name, value in ConfigSettings.DEFAULTS.items():
+        if name not in current_app.config:
+            monkeypatch.setitem(current_app.config, name, value)
+
+
+@pytest.mark.usefixtures("default_settings")
+class TestBulkRegistration:
+    """Passwords are only in the job's parameters encrypted."""
+
+    CSV = ["username,email,password", "ada,ada@example.com,s3cret-ada", "bob,bob@example.com,s3cret-bob"]
+
+    def test_passwords_are_encrypted_in_params(self, monkeypatch):
+        monkeypatch.setitem(current_app.config, "BCRYPT_LOG_ROUNDS", 4)
+        users, errors = read_users_from_csv(self.CSV)
+        assert errors == []
+        job = enqueue_job(Job.BULK_REGISTER_TYPE, params={"users": users})
+        assert "s3cret" not in db.session.get(Job, job.id).params
+        assert register_users(job, **job.get_params()) == "Registered 2 users"
+        assert User.query.filter_by(username="bob").one().check_password("s3cret-bob")
+
+    def test_passwords_need_the_same_secret_key(self, monkeypatch):
+        users, _ = read_users_from_csv(self.CSV)
+        monkeypatch.setitem(current_app.config, "SECRET_KEY", "a-new-secret-key")
+        with pytest.raises(ValueError):
+            register_users(enqueue_job(Job.BULK_REGISTER_TYPE), users)
+        assert User.query.filter_by(username="ada").first() is None
@@ -2,9 +2,20 @@
 """Model unit tests."""
 
 from datetime import datetime
+import threading
+import time
 
 import pytest
+import pytz
+from flask import current_app
 
+from buggy_race_server.admin.models import CacheVersion
+from buggy_race_server.buggy.models import Buggy
+from buggy_race_server.buggy.views import save_uploaded_buggies
+from buggy_race_server.config import ConfigSettingNames
+from buggy_race_server.extensions import blob_store, cache
+from buggy_race_server.lib.blob_store import FilesystemBlobs
+from buggy_race_server.race.models import Race, delete_unused_blobs
 from buggy_race_server.user.models import Role, User
 
 from .factories import UserFactory
@@ -65,3 +76,154 @@ class TestUser:
         user.roles.append(role)
         user.save()
         assert role in user.roles
+
+
+class FakeGitHub:
+    """Stands in for a user's GitHub client: answers with status."""
+
+    class Response:
+        def __init__(self, status):
+            self.status = status
+
+        def json(self):
+            return {"html_url": "https://github.com/..."} if self.status == 200 else {}
+
+    def __init__(self, status):
+        self.status = status
+        self.qty_requests = 0
+
+    def get(self, url_string, params={}):
+        self.qty_requests += 1
+        if self.status is None:
+            raise ConnectionRefusedError("GitHub has gone")
+        return FakeGitHub.Response(self.status)
+
+
+@pytest.fixture
+def repo_settings(db, monkeypatch):
+    monkeypatch.setitem(current_app.config, ConfigSettingNames.BUGGY_EDITOR_REPO_NAME.name, "buggy-race-editor")
+    monkeypatch.setitem(current_app.config, ConfigSettingNames.VCS_NAME.name, "GitHub")
+    cache.clear()
+
+
+@pytest.mark.usefixtures("repo_settings")
+class TestCourseRepository:
+    """GitHub's answer is cached across requests (i.e., user objects)."""
+
+    def _get_user(self, github):
+        user = User.query.filter_by(username="foo").first()
+        if user is None:
+            user = User.create(username="foo", email="foo@bar.com", github_username="foo")
+        user._github = github
+        return user
+
+    def test_answer_is_cached(self):
+        github = FakeGitHub(200)
+        assert self._get_user(github).has_course_repository() is True
+        db_user = self._get_user(github)
+        db_user.init_on_load() # as if it's the next request
+        db_user._github = github
+        assert db_user.has_course_repository() is True
+        assert github.qty_requests == 1
+
+    def test_missing_repo_is_cached(self):
+        github = FakeGitHub(404)
+        assert self._get_user(github).has_course_repository() is False
+        user = self._get_user(github)
+        user.init_on_load()
+        user._github = github
+        assert user.has_course_repository() is False
+        assert github.qty_requests == 1
+
+    @pytest.mark.parametrize("status", [None, 403, 502])
+    def test_no_answer_is_cached_briefly(self, status):
+        github = FakeGitHub(status)
+        assert self._get_user(github).has_course_repository() is False
+        user = self._get_user(github)
+        user.init_on_load()
+        user._github = github
+        assert user.has_course_repository(max_wait=60) is False # doesn't wait
+        assert github.qty_requests == 1
+        cache_key = user._get_course_repository_cache_key()
+        cache.set(cache_key, dict(cache.get(cache_key), fresh_until=time.time() - 1))
+        user.init_on_load()
+        user._github = github
+        assert user.has_course_repository() is False # asks again, in the background
+        for thread in threading.enumerate():
+            if thread.name.startswith("lookup-"):
+                thread.join()
+        assert github.qty_requests == 2
+
+
+@pytest.mark.usefixtures("db")
+class TestCacheVersion:
+    """Cache versions have their rows from the start, so bumping is an UPDATE."""
+
+    def test_rows_are_there_from_the_start(self):
+        assert CacheVersion.get_versions(*CacheVersion.NAMES) == dict.fromkeys(CacheVersion.NAMES, 0)
+        assert CacheVersion.query.count() == len(CacheVersion.NAMES)
+
+    def test_bump(self):
+        CacheVersion.bump(CacheVersion.RACES)
+        CacheVersion.bump(CacheVersion.RACES)
+        assert CacheVersion.get_version(CacheVersion.RACES) == 2
+        assert CacheVersion.get_version(CacheVersion.SETTINGS) == 0
+
+    def test_unknown_name(self):
+        with pytest.raises(ValueError):
+            CacheVersion.bump("nonesuch")
+
+
+@pytest.mark.usefixtures("db")
+class TestRaceScrutineering:
+    """Each race's scrutineering is cached until an entrant's buggy changes."""
+
+    def test_report_follows_buggy_changes(self, monkeypatch):
+        monkeypatch.setitem(current_app.config, ConfigSettingNames.BUGGY_RACE_SERVER_TIMEZONE.name, pytz.utc)
+        cache.clear()
+        user = User.create(username="foo", email="foo@bar.com", is_active=True)
+        Buggy.create(user_id=user.id, qty_wheels=4)
+        race = Race.create(title="Race I", cost_limit=100, league="test")
+        (entrant,) = race.get_scrutineering()["buggies"]
+        assert entrant["is_eligible"]
+        save_uploaded_buggies([("foo", {"qty_wheels": 5})], "white") # bulk UPDATE
+        report = race.get_scrutineering()
+        (entrant,) = report["buggies"]
+        assert entrant["violations_str"] == "EVEN_WHEELS,ENOUGH_TYRES"
+        assert (report["qty_eligible"], report["qty_ineligible"]) == (0, 1)
+
+
+@pytest.mark.usefixtures("db")
+class TestRaceFileBlobs:
+    """Blobs a race no longer uses are deleted, unless something else uses them."""
+
+    @pytest.fixture(autouse=True)
+    def blobs(self, db, monkeypatch, tmp_path):
+        monkeypatch.setitem(current_app.config, ConfigSettingNames.BUGGY_RACE_SERVER_URL.name, "http://localhost")
+        blobs = FilesystemBlobs(str(tmp_path))
+        monkeypatch.setattr(blob_store, "blobs", blobs)
+        return blobs
+
+    def _store(self, race_id, events):
+        with current_app.test_request_context(): # for url_for
+            Race.get_by_id(race_id).store_race_file({"title": "Race", "version": "1.1", "events": events})
+
+    def test_replaced_and_deleted_race_files(self, blobs):
+        events = [[{"b": "ada", "d": 12}]] * 3
+        race_id = Race.create(title="Race I", cost_limit=100, league="test").id
+        other_race_id = Race.create(title="Race II", cost_limit=100, league="test").id
+        self._store(race_id, events)
+        self._store(other_race_id, events) # same events, so the same chunk blobs
+        old_hashes = Race.get_by_id(race_id).get_blob_hashes()
+        self._store(race_id, [[{"b": "chaz", "d": 7}]])
+        race = Race.get_by_id(race_id)
+        new_hashes = race.get_blob_hashes()
+        still_used = set(Race.get_by_id(other_race_id).get_blob_hashes())
+        assert set(old_hashes) & still_used # or this tests nothing
+        assert {h for h in old_hashes if blobs.has(h)} == set(old_hashes) & still_used
+        assert all(blobs.has(h) for h in new_hashes)
+        blob_hashes = race.get_blob_hashes()
+        race.delete()
+        delete_unused_blobs(blob_hashes)
+        assert not any(blobs.has(h) for h in new_hashes)
+        assert all(blobs.has(h) for h in still_used)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Bulk password hashing tests (these don't need the app)."""
+
+import bcrypt
+import pytest
+
+from buggy_race_server.lib.passwords import hash_password, iter_password_hashes
+
+LOG_ROUNDS = 4 # the minimum: these tests aren't about security
+
+
+class TestPasswords:
+    """Hashes are bcrypt's, so they can be checked like Flask-Bcrypt's."""
+
+    def test_hash_checks_out(self):
+        password_hash = hash_password("secR3t89o!W", LOG_ROUNDS)
+        assert password_hash.startswith(b"$2b$04$")
+        assert bcrypt.checkpw(b"secR3t89o!W", password_hash)
+        assert not bcrypt.checkpw(b"wrong", password_hash)
+
+    def test_empty_password_is_refused(self):
+        with pytest.raises(ValueError):
+            hash_password("", LOG_ROUNDS)
+
+    @pytest.mark.parametrize("max_workers", [1, 2])
+    def test_hashes_are_in_order(self, max_workers):
+        passwords = [f"password{i}" for i in range(6)]
+        password_hashes = list(
+            iter_password_hashes(passwords, LOG_ROUNDS, max_workers=max_workers)
+        )
+        assert len(password_hashes) == len(passwords)
+        for password, password_hash in zip(passwords, password_hashes):
+            assert bcrypt.checkpw(password.encode("utf-8"), password_hash)
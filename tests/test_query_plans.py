@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""The hot lookups use their indexes.
+
+These run against SQLite in memory unless QUERY_PLAN_DATABASE_URL is set
+(to an empty PostgreSQL or MySQL database, whose tables are created and
+dropped again)."""
+
+import os
+
+# the models read the app's config, which won't load without a database URL
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import pytest
+import sqlalchemy as sa
+
+from buggy_race_server.admin.models import DbFile, TaskText
+from buggy_race_server.buggy.models import Buggy
+from buggy_race_server.database import db
+from buggy_race_server.race.models import Race, RaceResult
+from buggy_race_server.user.models import User
+
+from .query_plans import assert_uses_index
+
+HOT_LOOKUPS = {
+    "ix_results_race_id": sa.select(RaceResult).where(RaceResult.race_id == 1),
+    "ix_results_user_id": sa.select(RaceResult).where(RaceResult.user_id == 1),
+    "ix_buggies_user_id": sa.select(Buggy).where(Buggy.user_id == 1),
+    "ix_tasktexts_user_id_task_id": sa.select(TaskText).where(
+        TaskText.user_id == 1, TaskText.task_id == 1
+    ),
+    "ix_db_files_type_item_id": sa.select(DbFile.id).where(
+        DbFile.type == DbFile.RACE_FILE_TYPE, DbFile.item_id == 1
+    ),
+    "ix_races_is_visible_start_at": sa.select(Race.id).where(
+        Race.is_visible == True
+    ).order_by(Race.start_at.desc()),
+    "ix_users_is_student_is_active": sa.select(User.id).where(
+        User.is_student == True, User.is_active == True
+    ),
+}
+
+
+@pytest.fixture(scope="module")
+def connection():
+    engine = sa.create_engine(os.environ.get("QUERY_PLAN_DATABASE_URL", "sqlite://"))
+    db.metadata.create_all(engine)
+    with engine.connect() as connection:
+        yield connection
+        connection.rollback()
+    db.metadata.drop_all(engine)
+
+
+@pytest.mark.parametrize("index_name", HOT_LOOKUPS)
+def test_hot_lookup_uses_index(connection, index_name):
+    assert_uses_index(connection, HOT_LOOKUPS[index_name], index_name)
+
+
+@pytest.mark.parametrize("table_name, index_name", [
+    ("buggies", "ix_buggies_user_id"),
+    ("tasktexts", "ix_tasktexts_user_id_task_id"),
+])
+def test_unique_indexes(connection, table_name, index_name):
+    indexes = {index["name"]: index for index in sa.inspect(connection).get_indexes(table_name)}
+    assert indexes[index_name]["unique"]
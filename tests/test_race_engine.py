@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""Race engine tests (these don't need the app or the database)."""
+
+import hashlib
+import io
+import json
+import random
+import time
+
+import pytest
+
+from buggy_race_server.lib.json_stream import JsonStreamReader, RawJSON, dumps_with_raw, read_raw
+from buggy_race_server.lib.race_engine import (
+    EventType,
+    compile_dice,
+    get_podium,
+    get_race_params,
+    roll_dice,
+    simulate,
+)
+from buggy_race_server.lib.race_events import (
+    check_events,
+    compact_events,
+    dump_results,
+    expand_events,
+    is_compact_events,
+    load_results,
+    load_results_stream,
+    split_events,
+)
+from buggy_race_server.lib.race_specs import BuggySpecs
+from buggy_race_server.lib.race_sweep import run_sweep
+
+
+def make_buggy_data(username, user_id, **kwargs):
+    """Buggy data as it appears in a race file."""
+    buggy_data = dict(BuggySpecs.DEFAULTS)
+    buggy_data.update(
+        username=username,
+        user_id=user_id,
+        id=user_id,
+        buggy_id=1,
+        created_at="",
+        mass=0,
+        total_cost=0,
+    )
+    buggy_data.update(kwargs)
+    return buggy_data
+
+
+def make_race_data():
+    return {
+        "title": "Test race",
+        "cost_limit": 250,
+        "max_laps": 1,
+        "lap_length": 100,
+        "is_dnf_position": True,
+        "buggies": [
+            make_buggy_data("ada", 1, power_units=20),
+            make_buggy_data("chaz", 2, power_type="hamster", power_units=10),
+            make_buggy_data("grace", 3, power_units=5, attack="spike", qty_attacks=5),
+            make_buggy_data("alan", 4, power_type="fusion"),  # over cost limit
+        ],
+    }
+
+
+def make_bigger_race_data():
+    """A race with enough buggies that the podium isn't a foregone conclusion."""
+    race_data = make_race_data()
+    race_data["buggies"] = race_data["buggies"][:3] + [
+        make_buggy_data("edsger", 5, power_units=8),
+        make_buggy_data("barbara", 6, power_units=12, tyres="reactive", qty_tyres=5),
+        make_buggy_data("linus", 7, power_type="petrol", power_units=3, attack="charge", qty_attacks=2),
+    ]
+    return race_data
+
+
+def without_timestamp(results):
+    return {k: v for k, v in results.items() if k != "raced_at"}
+
+
+def get_finish_messages_by_step(results):
+    return [
+        [event["s"] for event in step if event.get("e") == EventType.FINISH.value]
+        for step in results["events"]
+    ]
+
+
+class TestDice:
+    """Dice strings are compiled once and then rolled."""
+
+    def test_compile_dice(self):
+        assert compile_dice("3d6+2") == (3, range(1, 7), 2)
+        assert compile_dice("1d4") == (1, range(1, 5), 0)
+
+    def test_not_dice_scores_zero(self):
+        assert roll_dice(compile_dice("none"), random.Random(1)) == 0
+
+    def test_roll_is_in_range(self):
+        dice = compile_dice("2d3+1")
+        rng = random.Random(1)
+        scores = {roll_dice(dice, rng) for _ in range(500)}
+        assert scores == set(range(3, 8))
+
+
+class TestSimulate:
+    """simulate() runs a race without prompting."""
+
+    def test_same_seed_same_race(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        first = simulate(race_data, params, seed=7)
+        second = simulate(race_data, params, seed=7)
+        assert without_timestamp(first) == without_timestamp(second)
+
+    def test_seed_is_in_results(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        results = simulate(race_data, params)
+        assert isinstance(results["seed"], int)
+        replay = simulate(race_data, params, seed=results["seed"])
+        assert without_timestamp(replay) == without_timestamp(results)
+
+    def test_golden_event_stream(self):
+        # if this fails, something changed what the engine does with its
+        # random numbers: that's OK if it was meant to (update the digest)
+        race_data = make_race_data()
+        results = simulate(race_data, get_race_params(race_data), seed=42)
+        assert len(results["events"]) == 22
+        assert hashlib.sha256(json.dumps(results["events"]).encode()).hexdigest() == (
+            "b43bdfd0a6ef2c7bc19fb7b6eb08d5d81d36e59e1bcbdd948803badd2a96355a"
+        )
+
+    def test_race_data_is_reusable(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        simulate(race_data, params, seed=1)
+        assert race_data == make_race_data()
+
+    def test_violator_does_not_start(self):
+        race_data = make_race_data()
+        results = simulate(race_data, get_race_params(race_data), seed=3)
+        positions = {b["username"]: b["race_position"] for b in results["buggies"]}
+        assert positions["alan"] == -1
+        assert results["buggies_entered"] == 4
+        assert results["buggies_started"] == 3
+
+    def test_podium_has_finishers_first(self):
+        race_data = make_race_data()
+        results = simulate(race_data, get_race_params(race_data), seed=5)
+        podium = get_podium(results)
+        assert [is_finisher for (_, is_finisher) in podium] == sorted(
+            [is_finisher for (_, is_finisher) in podium], reverse=True
+        )
+
+    def test_cancelled_start_returns_none(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        assert simulate(race_data, params, confirm_start=lambda buggies: False) is None
+
+
+class TestSweep:
+    """run_sweep() aggregates many seeded races."""
+
+    def test_sweep_does_not_depend_on_workers(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        in_process = run_sweep(race_data, params, 12, seed=2, max_workers=1)
+        in_pool = run_sweep(race_data, params, 12, seed=2, max_workers=2)
+        assert [s.to_dict() for s in in_process] == [s.to_dict() for s in in_pool]
+
+    def test_every_race_is_counted(self):
+        race_data = make_race_data()
+        sweep_stats = run_sweep(race_data, get_race_params(race_data), 10, max_workers=1)
+        assert len(sweep_stats) == 4
+        assert all(s.qty_races == 10 for s in sweep_stats)
+        assert sum(s.qty_wins for s in sweep_stats) >= 10  # ties can share a win
+
+
+class TestNumpyEngine:
+    """race_engine_numpy.simulate() runs the same races on arrays."""
+
+    def setup_method(self):
+        self.engine = pytest.importorskip("buggy_race_server.lib.race_engine_numpy")
+
+    def test_same_seed_same_race(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        first = self.engine.simulate(race_data, params, seed=7)
+        second = self.engine.simulate(race_data, params, seed=7)
+        assert without_timestamp(first) == without_timestamp(second)
+
+    def test_results_match_plain_engine_format(self):
+        race_data = make_race_data()
+        params = get_race_params(race_data)
+        results = self.engine.simulate(race_data, params, seed=3)
+        plain_results = simulate(race_data, params, seed=3)
+        assert results.keys() == plain_results.keys()
+        assert results["buggies_started"] == plain_results["buggies_started"]
+        positions = sorted(b["race_position"] for b in results["buggies"])
+        assert positions[0] == -1  # the violator
+        assert all(position > 0 for position in positions[1:])  # DNF is a position
+        for step in results["events"]:
+            for event in step:
+                assert set(event) <= {"b", "d", "e", "s"}
+
+    def test_sweep_with_numpy_engine(self):
+        race_data = make_race_data()
+        sweep_stats = run_sweep(
+            race_data, get_race_params(race_data), 10, max_workers=1, simulator=self.engine.simulate
+        )
+        assert all(s.qty_races == 10 for s in sweep_stats)
+
+    @pytest.mark.parametrize("engine_name", ["plain", "numpy"])
+    def test_every_buggy_in_a_tie_is_tied(self, engine_name):
+        race_data = make_bigger_race_data()
+        params = get_race_params(race_data)
+        simulator = simulate if engine_name == "plain" else self.engine.simulate
+        qty_ties = 0
+        for seed in range(40):
+            for messages in get_finish_messages_by_step(simulator(race_data, params, seed=seed)):
+                if len(messages) > 1:
+                    qty_ties += 1
+                assert all(("tied" in message) == (len(messages) > 1) for message in messages)
+        assert qty_ties > 0  # otherwise this tested nothing
+
+    def test_same_odds_as_plain_engine(self):
+        # the engines roll different dice, so the same seed doesn't give the
+        # same race: but over many races each buggy's chances should agree
+        # (0.1 is about 3 standard deviations of the difference at 400 races)
+        qty_races = 400
+        tolerance = 0.1
+        race_data = make_bigger_race_data()
+        params = get_race_params(race_data)
+        plain_stats = {
+            s.username: s for s in run_sweep(race_data, params, qty_races, seed=11, max_workers=1)
+        }
+        numpy_stats = {
+            s.username: s for s in run_sweep(
+                race_data, params, qty_races, seed=11, max_workers=1, simulator=self.engine.simulate
+            )
+        }
+        assert plain_stats.keys() == numpy_stats.keys()
+        for username, stats in plain_stats.items():
+            assert stats.win_rate == pytest.approx(numpy_stats[username].win_rate, abs=tolerance)
+            assert stats.podium_rate == pytest.approx(numpy_stats[username].podium_rate, abs=tolerance)
+
+
+class TestRaceEvents:
+    """Event logs can be compacted (and gzipped) and expanded again."""
+
+    def get_results(self):
+        race_data = make_race_data()
+        return simulate(race_data, get_race_params(race_data), seed=42)
+
+    def test_compact_round_trip(self):
+        events = self.get_results()["events"]
+        compacted = compact_events(events)
+        assert is_compact_events(compacted)
+        assert expand_events(compacted) == events
+
+    def test_list_events_pass_through(self):
+        events = self.get_results()["events"]
+        assert expand_events(events) is events
+        assert compact_events(compact_events(events)) == compact_events(events)
+
+    def test_dump_and_load_gzipped_compact_results(self):
+        results = self.get_results()
+        dumped = dump_results(results, is_compact=True, is_gzipped=True)
+        assert len(dumped) < len(dump_results(results))
+        loaded = load_results(dumped)
+        assert loaded["buggies"] == results["buggies"]
+        assert expand_events(loaded["events"]) == results["events"]
+
+    def test_gzipped_results_dont_depend_on_when(self, monkeypatch):
+        # gzip puts the time in its header unless it's told not to: then the
+        # same results would get a different blob (and ETag) every time
+        results = self.get_results()
+        dumped = dump_results(results, is_gzipped=True)
+        monkeypatch.setattr(time, "time", lambda: 1_000_000_000.0)
+        assert dump_results(results, is_gzipped=True) == dumped
+
+    def test_unknown_compact_version(self):
+        events = dict(compact_events(self.get_results()["events"]), compact=99)
+        with pytest.raises(ValueError):
+            expand_events(events)
+
+    def test_bad_gzip_is_value_error(self):
+        with pytest.raises(ValueError):
+            load_results(b"\x1f\x8b not really gzip")
+
+    @pytest.mark.parametrize("is_compact", [False, True])
+    def test_split_raw_events_into_chunks(self, is_compact):
+        results = self.get_results()
+        loaded = load_results_stream(io.BytesIO(dump_results(results, is_compact=is_compact).encode()))
+        (qty_steps, chunks) = split_events(loaded["events"], steps_per_chunk=5)
+        assert qty_steps == len(results["events"])
+        assert len(chunks) == -(-qty_steps // 5)
+        rejoined = [step for chunk in chunks for step in expand_events(json.loads(chunk))]
+        assert rejoined == results["events"]
+
+    @pytest.mark.parametrize("events_json", ["42", '{"steps": 3}', "[[], 7]", '{"compact": 1, "buggies": [], "types": [], "strings": [], "steps": 3}'])
+    def test_events_of_the_wrong_shape(self, events_json):
+        loaded = load_results_stream(io.BytesIO(f'{{"title": "x", "events": {events_json}}}'.encode()))
+        with pytest.raises(ValueError):
+            check_events(loaded["events"])
+        with pytest.raises(ValueError):
+            check_events(json.loads(events_json))
+
+    @pytest.mark.parametrize("events_json", [
+        '[[[1,,2}],[{"a":tru}]]',
+        '[[{"b": "ada"]}]',
+        '[[1, 2], [3 4]]',
+        '{"compact": 1, "buggies": [], "types": [], "strings": [], "steps": [[0, -1, 1, -1], [0, -1, nul, -1]]}',
+        '{"compact": 1, "buggies": [], "types": [], "strings": [], "steps": [[0, -1, 1]]}',
+    ])
+    def test_malformed_raw_events(self, events_json):
+        # the raw events are only scanned when they're read, but they're
+        # stored and served as they are, so they must be checked before that
+        loaded = load_results_stream(io.BytesIO(f'{{"version": "1.1", "events": {events_json}}}'.encode()))
+        with pytest.raises(ValueError):
+            check_events(loaded["events"])
+
+    @pytest.mark.parametrize("is_compact", [False, True])
+    def test_events_of_the_right_shape(self, is_compact):
+        dumped = dump_results(self.get_results(), is_compact=is_compact)
+        check_events(load_results_stream(io.BytesIO(dumped.encode()))["events"])
+        check_events(json.loads(dumped)["events"])
+        check_events(None)
+
+
+class TestJsonStream:
+    """Race results can be read without parsing the events."""
+
+    DOC = {
+        "title": "a \"quoted\" title with [brackets] and {braces}",
+        "buggies": [{"username": "ada", "cost": 12.5, "ok": True, "x": None}],
+        "events": [[{"b": "ada", "s": "back\\slash ]}"}], []],
+        "version": "1.1",
+    }
+
+    def read(self, text, chunk_size):
+        reader = JsonStreamReader(io.StringIO(text), chunk_size=chunk_size)
+        obj = reader.read_object({"events": read_raw})
+        reader.expect_end()
+        return obj
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 5, 1024])
+    def test_events_stay_raw(self, chunk_size):
+        data = self.read(json.dumps(self.DOC, indent=2), chunk_size)
+        assert isinstance(data["events"], RawJSON)
+        assert json.loads(data["events"]) == self.DOC["events"]
+        assert data["buggies"] == self.DOC["buggies"]
+        assert json.loads(dumps_with_raw(data)) == self.DOC
+
+    def test_truncated_json(self):
+        with pytest.raises(ValueError):
+            self.read(json.dumps(self.DOC)[:-20], 16)
+
+    def test_extra_data(self):
+        with pytest.raises(ValueError):
+            self.read(json.dumps(self.DOC) + "{}", 16)
+
+    @pytest.mark.parametrize("is_compact", [False, True])
+    @pytest.mark.parametrize("is_gzipped", [False, True])
+    def test_load_results_stream(self, is_compact, is_gzipped):
+        race_data = make_race_data()
+        results = simulate(race_data, get_race_params(race_data), seed=42)
+        dumped = dump_results(results, is_compact=is_compact, is_gzipped=is_gzipped)
+        if not is_gzipped:
+            dumped = dumped.encode("utf-8")
+        loaded = load_results_stream(io.BytesIO(dumped))
+        assert loaded["buggies"] == results["buggies"]
+        assert load_results(dumps_with_raw(loaded)) == load_results(dumped)
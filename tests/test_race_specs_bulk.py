@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Bulk buggy specs tests (these don't need the app or the database)."""
+
+import random
+
+import pytest
+
+from buggy_race_server.lib.race_specs import BuggySpecs, RuleNames
+from buggy_race_server.lib.race_specs_bulk import (
+    RULE_BITS,
+    evaluate_specs,
+    get_columns,
+    get_violation_names,
+)
+
+
+class SpecsBuggy(BuggySpecs):
+    def __init__(self, **settings):
+        self.id = None
+        self.username = "test"
+        for name, value in {**BuggySpecs.DEFAULTS, **settings}.items():
+            setattr(self, name, value)
+        self.calculate_total_cost()
+        self.calculate_mass()
+
+
+def make_random_buggies(qty_buggies, seed=1):
+    rng = random.Random(seed)
+    choices = {
+        "qty_wheels": [3, 4, 5, 6, 8, 40, None],
+        "power_type": [*BuggySpecs.POWER_TYPES, "warp"],
+        "power_units": [0, 1, 7, 50],
+        "aux_power_type": [*BuggySpecs.POWER_TYPES, None, "warp"],
+        "aux_power_units": [0, 3, 20],
+        "hamster_booster": [0, 2],
+        "tyres": [*BuggySpecs.TYRE_TYPES, "bald"],
+        "qty_tyres": [2, 4, 6, 9, None],
+        "armour": [*BuggySpecs.ARMOUR_TYPES, "cardboard"],
+        "attack": [*BuggySpecs.ATTACK_TYPES, "pie"],
+        "qty_attacks": [0, 1, 5],
+        "fireproof": [True, False],
+        "insulated": [True, False],
+        "antibiotic": [True, False],
+        "banging": [True, False],
+        "algo": [*BuggySpecs.ALGO_TYPES, "dance"],
+        "flag_pattern": [*BuggySpecs.FLAG_PATTERNS, "tartan"],
+        "flag_color": ["red", "black"],
+    }
+    buggies = []
+    while len(buggies) < qty_buggies:
+        settings = {name: rng.choice(values) for name, values in choices.items()}
+        if settings["qty_wheels"] is None and settings["qty_tyres"] is not None:
+            continue # get_rule_violations raises TypeError on these
+        buggies.append(SpecsBuggy(**settings))
+    return buggies
+
+
+class TestEvaluateSpecs:
+    """Bulk results are the same as BuggySpecs' one-buggy-at-a-time ones."""
+
+    def test_same_as_one_at_a_time(self):
+        buggies = make_random_buggies(2000)
+        results = evaluate_specs(get_columns(buggies), cost_limit=200)
+        assert results["total_cost"] == [buggy.total_cost for buggy in buggies]
+        assert results["mass"] == [buggy.mass for buggy in buggies]
+        for buggy, violations in zip(buggies, results["violations"]):
+            if buggy.total_cost is not None:
+                assert get_violation_names(violations) == buggy.get_rule_violations(200)
+
+    def test_defaults_pass(self):
+        columns = get_columns([dict(BuggySpecs.DEFAULTS)])
+        results = evaluate_specs(columns)
+        assert results["violations"] == [0]
+        assert results["total_cost"] == [SpecsBuggy().total_cost]
+
+    def test_violation_bits(self):
+        assert len(RULE_BITS) == len(RuleNames)
+        mask = RULE_BITS["MIN_WHEELS"] | RULE_BITS["SOFTWARE"]
+        assert get_violation_names(mask) == ["MIN_WHEELS", "SOFTWARE"]
+        with pytest.raises(ValueError):
+            evaluate_specs(get_columns([]), cost_limit=None)
+
+    def test_numpy_columns(self):
+        np = pytest.importorskip("numpy")
+        buggies = [SpecsBuggy(qty_wheels=6, qty_tyres=6, armour="wood"), SpecsBuggy(power_type="none")]
+        columns = {name: np.array(column) for name, column in get_columns(buggies).items()}
+        results = evaluate_specs(columns, cost_limit=100)
+        assert results["total_cost"] == [buggy.total_cost for buggy in buggies]
+        assert results["mass"] == [buggy.mass for buggy in buggies]
+        assert [get_violation_names(v) for v in results["violations"]] == [
+            buggy.get_rule_violations(100) for buggy in buggies
+        ]
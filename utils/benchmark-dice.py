@@ -0,0 +1,131 @@
+# benchmark dice
+#================
+#
+# Micro-benchmark for the dice rolling in the race engine: compares parsing
+# the dice string on every roll (which is what score_from_dice used to do)
+# with rolling precompiled dice (race_engine.compile_dice and roll_dice), and
+# times a race step with a field of made-up buggies both ways (before: the
+# engine's rolls go through score_from_dice_by_parsing, after: as it is), e.g.:
+#
+#   python benchmark-dice.py --buggies=300 --steps=200
+#
+# Like run-buggy-race.py, this doesn't need the database (or Flask).
+#
+#------------------------------------------------------------------------------
+
+import optparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+from buggy_race_server.lib import race_engine
+from buggy_race_server.lib.race_engine import (
+    DEFAULT_REPAIR_DICE,
+    DICE_STR_RE,
+    POWER_DATA,
+    compile_dice,
+    get_race_params,
+    roll_dice,
+    simulate,
+)
+from buggy_race_server.lib.race_specs import BuggySpecs
+
+parser = optparse.OptionParser()
+parser.add_option("--rolls", dest="qty_rolls", type="int", default=100000,
+    help="number of rolls of each dice string to time")
+parser.add_option("--buggies", dest="qty_buggies", type="int", default=300,
+    help="number of buggies in the race for timing steps")
+parser.add_option("--steps", dest="qty_steps", type="int", default=200,
+    help="number of steps in the race for timing steps")
+parser.add_option("--repeat", dest="qty_repeats", type="int", default=5,
+    help="number of times to repeat each timing (the best is reported)")
+opts, args = parser.parse_args()
+
+def score_from_dice_by_parsing(dstring):
+    """ parses the dice string every time (the old score_from_dice)"""
+    if m := re.match(DICE_STR_RE, dstring):
+        qty = int(m.group(1))
+        sides = int(m.group(2))
+        total = int(m.group(3)) if m.group(3) else 0
+        for i in range(qty):
+            total += random.randint(1, sides)
+        return total
+    else:
+        return 0
+
+def get_dice_strings():
+    """ the dice strings the engine rolls during a race (see race_engine's
+    compiled dice, e.g., POWER_DICE)"""
+    return sorted(
+        {data["delta"] for data in POWER_DATA.values()}
+        | {DEFAULT_REPAIR_DICE, "3d6", "1d2", "1d6+10", "1d4"}
+    )
+
+def make_roll_dice_by_parsing():
+    """ Returns a stand-in for race_engine.roll_dice that goes back to
+    parsing the dice string on every roll, so a race can be timed as it was
+    before the dice were compiled"""
+    dstring_by_dice = {compile_dice(dstring): dstring for dstring in get_dice_strings()}
+
+    def roll_dice_by_parsing(dice, rng):
+        return score_from_dice_by_parsing(dstring_by_dice[dice])
+    return roll_dice_by_parsing
+
+def get_made_up_race_data(qty_buggies):
+    rng = random.Random(qty_buggies)
+    buggies = []
+    for i in range(qty_buggies):
+        buggy_data = dict(BuggySpecs.DEFAULTS)
+        buggy_data.update(
+            username=f"buggy{i}",
+            user_id=i,
+            id=i,
+            buggy_id=i,
+            created_at="",
+            mass=0,
+            total_cost=0,
+            power_type=rng.choice(["petrol", "bio", "steam", "hamster", "electric"]),
+            power_units=rng.randint(5, 40),
+            attack=rng.choice(["none", "spike", "flame"]),
+            qty_attacks=rng.randint(0, 5),
+        )
+        buggies.append(buggy_data)
+    return {"title": "benchmark", "max_laps": 100, "buggies": buggies}
+
+def best_time(func, number=1):
+    return min(timeit.repeat(func, number=number, repeat=opts.qty_repeats))
+
+def main():
+    dice_strings = get_dice_strings()
+    print(f"[ ] rolling each of {len(dice_strings)} dice strings {opts.qty_rolls} times")
+    print(f"[ ] {'dice':>8} {'parse+roll':>12} {'compiled':>12}")
+    rng = random.Random(1)
+    for dstring in dice_strings:
+        dice = compile_dice(dstring)
+        t_before = best_time(lambda: score_from_dice_by_parsing(dstring), opts.qty_rolls)
+        t_after = best_time(lambda: roll_dice(dice, rng), opts.qty_rolls)
+        print(
+            f"[*] {dstring:>8} {t_before / opts.qty_rolls * 1e9:10.0f}ns "
+            f"{t_after / opts.qty_rolls * 1e9:10.0f}ns"
+        )
+
+    race_data = get_made_up_race_data(opts.qty_buggies)
+    params = get_race_params(race_data, initial_steps=opts.qty_steps, max_steps=opts.qty_steps)
+    run_race = lambda: simulate(race_data, params, seed=1, want_events=False)
+    compiled_roll_dice = race_engine.roll_dice
+    race_engine.roll_dice = make_roll_dice_by_parsing()
+    try:
+        random.seed(1) # score_from_dice_by_parsing uses random, not the race's rng
+        t_before = best_time(run_race)
+    finally:
+        race_engine.roll_dice = compiled_roll_dice
+    t_after = best_time(run_race)
+    print(f"[ ] race with {opts.qty_buggies} buggies ({opts.qty_steps} steps): time per step")
+    print(f"[*] {'parse+roll':>12} {t_before / opts.qty_steps * 1e6:10.0f}µs")
+    print(f"[*] {'compiled':>12} {t_after / opts.qty_steps * 1e6:10.0f}µs")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# benchmark scrutineer
+#======================
+#
+# Micro-benchmark for working out buggies' costs, masses, and rule
+# violations: compares BuggySpecs' one-buggy-at-a-time methods with the
+# bulk evaluator (lib/race_specs_bulk.py), on a made-up cohort, e.g.:
+#
+#   python benchmark-scrutineer.py --buggies=500 --cost-limit=200
+#
+# Like run-buggy-race.py, this doesn't need the database (or Flask).
+#
+#------------------------------------------------------------------------------
+
+import optparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+from buggy_race_server.lib.race_specs import BuggySpecs
+from buggy_race_server.lib.race_specs_bulk import evaluate_specs, get_columns
+
+parser = optparse.OptionParser()
+parser.add_option("--buggies", dest="qty_buggies", type="int", default=500,
+    help="number of made-up buggies to scrutineer")
+parser.add_option("--cost-limit", dest="cost_limit", type="int", default=200,
+    help="race cost limit (0 for none)")
+parser.add_option("--repeat", dest="qty_repeats", type="int", default=5,
+    help="number of times to repeat each timing (the best is reported)")
+opts, args = parser.parse_args()
+
+class SpecsBuggy(BuggySpecs):
+    def __init__(self, settings):
+        self.id = None
+        self.username = None
+        self.total_cost = None
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+def get_made_up_buggies(qty_buggies):
+    """ buggies like students' (mostly legal, some over cost) """
+    rng = random.Random(qty_buggies)
+    buggies = []
+    for i in range(qty_buggies):
+        settings = dict(BuggySpecs.DEFAULTS)
+        settings.update(
+            qty_wheels=rng.choice([4, 6, 8, 7]),
+            power_type=rng.choice(list(BuggySpecs.POWER_TYPES)),
+            power_units=rng.randint(1, 20),
+            armour=rng.choice(list(BuggySpecs.ARMOUR_TYPES)),
+            attack=rng.choice(list(BuggySpecs.ATTACK_TYPES)),
+            qty_attacks=rng.randint(0, 3),
+            banging=rng.random() < 0.2,
+        )
+        buggies.append(SpecsBuggy(settings))
+    return buggies
+
+def scrutineer_one_at_a_time(buggies):
+    for buggy in buggies:
+        buggy.calculate_total_cost()
+        buggy.calculate_mass()
+        if buggy.total_cost is not None:
+            buggy.get_rule_violations(opts.cost_limit)
+
+def best_time(func, number=1):
+    return min(timeit.repeat(func, number=number, repeat=opts.qty_repeats))
+
+def main():
+    buggies = get_made_up_buggies(opts.qty_buggies)
+    columns = get_columns(buggies)
+    print(f"[ ] scrutineering {opts.qty_buggies} made-up buggies")
+    t_before = best_time(lambda: scrutineer_one_at_a_time(buggies))
+    t_after = best_time(lambda: evaluate_specs(columns, opts.cost_limit))
+    print(f"[*] {'one at a time':>13} {t_before * 1000:8.2f} ms")
+    print(f"[*] {'bulk':>13} {t_after * 1000:8.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmark validator
+#=====================
+#
+# Micro-benchmark for cleaning uploaded buggy JSON: compares dispatching on
+# each key's type on every upload (which is what handle_uploaded_json used
+# to do) with the precompiled validator (lib/buggy_validator.py), and
+# reports validations per second on made-up uploads, e.g.:
+#
+#   python benchmark-validator.py --uploads=2000
+#
+# Like run-buggy-race.py, this doesn't need the database (or Flask).
+#
+#------------------------------------------------------------------------------
+
+import optparse
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+from buggy_race_server.lib.buggy_validator import buggy_validator
+from buggy_race_server.lib.race_specs import BuggySpecs
+
+parser = optparse.OptionParser()
+parser.add_option("--uploads", dest="qty_uploads", type="int", default=2000,
+    help="number of made-up uploads to validate")
+parser.add_option("--repeat", dest="qty_repeats", type="int", default=5,
+    help="number of times to repeat each timing (the best is reported)")
+opts, args = parser.parse_args()
+
+def clean_by_dispatching(dirty_buggy_data, default_flag_color):
+    """ dispatches on each key's type every time (the old cleaning, without
+    its flash calls): returns the clean data and how many were specified"""
+    clean_buggy_data = {}
+    for key in dirty_buggy_data:
+        if key == 'id':
+            try:
+                clean_buggy_data['buggy_id'] = int(dirty_buggy_data[key])
+            except (TypeError, ValueError):
+                pass
+        elif key in BuggySpecs.DEFAULTS:
+            if BuggySpecs.DEFAULTS[key] == False and isinstance(BuggySpecs.DEFAULTS[key], bool):
+                if isinstance(dirty_buggy_data[key], bool):
+                    clean_buggy_data[key] = int(dirty_buggy_data[key])
+                else:
+                    dirty_value = str(dirty_buggy_data[key]).strip().lower()
+                    if dirty_value in ('true', '1'):
+                        clean_buggy_data[key] = True
+                    elif dirty_value in ('false', '0'):
+                        clean_buggy_data[key] = False
+            elif isinstance(BuggySpecs.DEFAULTS[key], int):
+                try:
+                    clean_buggy_data[key] = int(dirty_buggy_data[key])
+                except (TypeError, ValueError):
+                    pass
+            else:
+                dirty_value = str(dirty_buggy_data[key]).strip().lower()
+                s = "#" if dirty_value.startswith("#") else ""
+                STRING_CHARS = string.digits + string.ascii_letters
+                s += "".join(c for c in dirty_value if c in STRING_CHARS)
+                if s != "":
+                    if max_str_len := BuggySpecs.STRING_COL_LENGTH.get(key):
+                        s = s[:max_str_len]
+                    if key in BuggySpecs.GAME_DATA:
+                        if s in BuggySpecs.GAME_DATA[key]:
+                            clean_buggy_data[key] = s
+                    else:
+                        clean_buggy_data[key] = s
+    qty_explicits = 0
+    for field_name in BuggySpecs.DEFAULTS:
+        if field_name in clean_buggy_data:
+            qty_explicits += 1
+        elif field_name == "flag_color":
+            clean_buggy_data[field_name] = default_flag_color
+        else:
+            clean_buggy_data[field_name] = BuggySpecs.DEFAULTS[field_name]
+    return clean_buggy_data, qty_explicits
+
+def get_made_up_uploads(qty_uploads):
+    """ uploads like students' (mostly clean, some with mistakes in) """
+    rng = random.Random(qty_uploads)
+    uploads = []
+    for i in range(qty_uploads):
+        buggy_data = dict(BuggySpecs.DEFAULTS)
+        buggy_data.update(
+            id=i,
+            qty_wheels=rng.choice([4, 6, "8", 7]),
+            flag_color=rng.choice(["red", "#FF00AA", "Light Blue", "#00ff00"]),
+            power_type=rng.choice(["petrol", "Fusion", "bio", "nuclear"]),
+            armour=rng.choice(["none", "wood", "titanium", "cardboard"]),
+            banging=rng.choice([True, False, "true", "0"]),
+        )
+        if rng.random() < 0.1:
+            buggy_data["turbo"] = "yes" # not a setting
+        uploads.append(buggy_data)
+    return uploads
+
+def best_time(func, number=1):
+    return min(timeit.repeat(func, number=number, repeat=opts.qty_repeats))
+
+def main():
+    uploads = get_made_up_uploads(opts.qty_uploads)
+    print(f"[ ] validating {opts.qty_uploads} made-up uploads")
+    t_before = best_time(lambda: [clean_by_dispatching(data, "white") for data in uploads])
+    t_after = best_time(lambda: [buggy_validator.validate(data, "white") for data in uploads])
+    print(f"[*] {'dispatching':>12} {opts.qty_uploads / t_before:10.0f} validations/s")
+    print(f"[*] {'precompiled':>12} {opts.qty_uploads / t_after:10.0f} validations/s (with messages)")
+
+if __name__ == "__main__":
+    main()